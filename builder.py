@@ -7,6 +7,7 @@
 import copy
 import curses
 import curses.wrapper
+import hashlib
 import os
 import shutil
 import subprocess
@@ -15,35 +16,93 @@ import tempfile
 import threading
 import time
 
+from bundle import BundleShipper
+from collect import ArtifactCollector
 from config import Configuration
 from config import MachineItem
+from engine import EventLoopEngine
+from engine import ThreadEngine
+from events import *
+from history import BuildHistory
+from logfile import BlockGzipFile
+from logfile import CompressLogfile
+from logindex import LogIndex
 from project import *
+from report import StageReport
+from resolve import BranchResolver
+from scheduler import Scheduler
 
 ## 
 # Buildhost class - oversees the build process for a particular host
 #
 class BuildHost(threading.Thread):
+    # Line written by the command script to report its process group
+    REMOTE_PGID_MARKER = '========================= pbuild remote process group '
+
+    # Number of submodules that git fetches (or clones) at once, if the
+    # version of git on the host supports it
+    SUBMODULE_JOBS = 8
+
+    # Memory (in MB) to allow for each concurrent make job
+    MAKE_JOB_MEMORY = 1024
+
     ##
     # Ctor
     # \param[in] Key to machines hash (to uniquely identify this host entry)
     # \param[in] Configuration class (for pbuild configuration)
-    def __init__(self, machineKey, config):
+    # \param[in] EventQueue class (to post activity and completion to)
+    def __init__(self, machineKey, config, events):
         threading.Thread.__init__(self)
         self.display_line = 0
         self.finished = False
+        self.process = None
+
+        # Process group of the command script on the remote system (reported
+        # by the script), so we can kill the remote build if we abort
+        self.remotePgid = None
 
         self.config = config
+        self.events = events
 
         self.tag = config.machines[machineKey].GetTag()
         self.hostname = config.machines[machineKey].GetHost()
+        self.select = config.machines[machineKey].GetSelect()
+
+        # If we're building several selectors, tags need not be unique, so
+        # qualify them with the selector for display purposes
+        if len(config.GetSelectList()) > 1:
+            self.label = '%s:%s' % (self.select, self.tag)
+        else:
+            self.label = self.tag
 
         self.path = config.machines[machineKey].GetPath()
         self.project = config.machines[machineKey].GetProject()
+        self.branch = config.options.branch or ''
         self.logPrefix = config.GetLogfilePrefix()
         self.deleteLogfiles = config.GetSetting('DeleteLogfiles')
         self.diagnoseErrors = config.GetSetting('DiagnoseErrors')
         self.renameLogfiles = config.GetSetting('LogfileRename')
+        self.compressLogfiles = config.GetSetting('CompressLogfiles')
         self.showProgress = config.GetSetting('Progress')
+        self.streamScript = config.GetSetting('StreamScript')
+        self.transport = config.GetTransport(self.hostname)
+
+        # Git bundles to fetch from (see BundleShipper), as a list of
+        # (repository directory, bundle file, list of refspecs) tuples, or
+        # None to fetch from GitHub (set before the queue is built)
+        self.bundles = None
+
+        # Commits to build (see BranchResolver), as a dictionary of commits
+        # by repository directory ('.' for the project), or None to check out
+        # branches by name (set before the queue is built)
+        self.pins = None
+
+        # Collector of build artifacts (see ArtifactCollector), or None if no
+        # artifacts are to be collected
+        self.collector = None
+
+        # Index of the log file (see LogIndex), once the build has started
+        self.logIndex = None
 
         # Construct the generic project definitions
 
@@ -62,12 +121,38 @@ class BuildHost(threading.Thread):
         #   bLogActivity:   Set to True whenever activity to the log has occurred
         #   cLogSubLines:   Total number of lines written in this section
         #   sActivityText:  Text showing current activity of subprocess
+        #   stages:         List of [stage name, start time] for each stage seen
         #   cActivityTime:  Time of last update (maintained by display code)
+        #   sDisplayText:   Activity text last displayed (maintained by display code)
+        #
+        # All but cActivityTime and sDisplayText are shared with the display
+        # code, and are protected by activityLock.
 
+        self.activityLock = threading.Lock()
         self.bLogActivity = True
         self.cLogSubLines = 0
         self.sActivityText = 'starting up'
+        self.stages = []
         self.tActivityTime = 0
+        self.sDisplayText = ''
+
+        # Timing information (maintained by Builder)
+        #   startTime:          Time the host was started
+        #   expectedDuration:   Expected duration of the build, from prior builds
+        #                       (None if unknown)
+        #   stageTimes:         Timing of each stage, once the host has finished
+
+        self.startTime = None
+        self.expectedDuration = None
+        self.stageTimes = []
+
+        # Results of probing the host before starting (see Builder.ProbeHosts)
+        #   latency:        Time (in seconds) to run a command on the host, or
+        #                   None if not probed (or unreachable)
+        #   unreachable:    True if the host didn't respond to the probe
+
+        self.latency = None
+        self.unreachable = False
 
         # Support for setting 'LogfileSelect'
         #
@@ -75,15 +160,126 @@ class BuildHost(threading.Thread):
         # selector name (if a selector name is known).  This will allow several
         # instances of pbuild to be run concurrently against independent
         # selectors by not conflicting in the log file naming conventions.
+        #
+        # If we're building several selectors, tags need not be unique, so
+        # logfiles are always named with the selector name.
 
         self.selectSpec = ''
 
-        if config.GetSetting('LogfileSelect'):
+        if config.GetSetting('LogfileSelect') or len(config.GetSelectList()) > 1:
             self.selectSpec = '-None'
 
             # If we have a selector specification, use it
-            if config.GetSelectSpecification() != '':
-               self.selectSpec = '-%s' % config.GetSelectSpecification()
+            if self.select != '':
+               self.selectSpec = '-%s' % self.select
+
+    ##
+    # Get the name of a log file for this host
+    #
+    # \param[in] Prefix for the log file name (i.e. 'done-')
+    # \param[in] Directory path (with trailing "/"); defaults to the log directory
+    # \param[in] True for a compressed log file name; defaults to setting
+    #            'CompressLogfiles'
+    #
+    def GetLogfileName(self, prefix, directory=None, compressed=None):
+        if directory == None:
+            directory = self.logPrefix
+
+        if compressed == None:
+            compressed = self.compressLogfiles
+
+        if compressed:
+            suffix = '.log.gz'
+        else:
+            suffix = '.log'
+
+        return '%s%s%s%s%s' % (directory, prefix, self.tag, self.selectSpec, suffix)
+
+    ##
+    # Get the name of the index of a log file for this host (see LogIndex)
+    #
+    # \param[in] Prefix for the log file name (i.e. 'done-')
+    # \param[in] Directory path (with trailing "/"); defaults to the log directory
+    #
+    def GetIndexName(self, prefix, directory=None):
+        if directory == None:
+            directory = self.logPrefix
+
+        return '%s%s%s%s.idx' % (directory, prefix, self.tag, self.selectSpec)
+
+    ##
+    # Record a line of output from the remote system (called from our thread)
+    #
+    # The display code is notified only when it has consumed the prior activity,
+    # so chatty builds don't flood the event queue.
+    #
+    def NoteActivity(self, line):
+        self.activityLock.acquire()
+        try:
+            notify = not self.bLogActivity
+            self.bLogActivity = True
+            self.cLogSubLines += 1
+
+            if line.startswith('========================= Performing '):
+                self.sActivityText = line.rstrip()[37:]
+                self.cLogSubLines = 0
+
+                # Track the start of each stage (ignoring the status of the
+                # final stage, and repeated markers for the same stage)
+                stageName = self.sActivityText.split(';')[0].strip()
+                if len(self.stages) == 0 or self.stages[-1][0] != stageName:
+                    self.stages.append([stageName, time.time()])
+        finally:
+            self.activityLock.release()
+
+        if notify:
+            self.events.Post(EVENT_ACTIVITY, self)
+
+    ##
+    # Get the timing of each stage of the build
+    #
+    # \param[in] Time the last stage ended (normally, the end of the build)
+    #
+    # \returns
+    # List of (stage name, start time, end time) tuples.  The time from when
+    # the host was started until the first stage (copying the command script
+    # and connecting to the host) is reported as stage 'startup'.
+    #
+    def GetStageTimes(self, endTime):
+        self.activityLock.acquire()
+        try:
+            stages = [ list(stage) for stage in self.stages ]
+        finally:
+            self.activityLock.release()
+
+        if self.startTime != None:
+            stages.insert(0, ['startup', self.startTime])
+
+        stageTimes = []
+        for i in range(len(stages)):
+            if i + 1 < len(stages):
+                stageTimes.append((stages[i][0], stages[i][1], stages[i + 1][1]))
+            else:
+                stageTimes.append((stages[i][0], stages[i][1], endTime))
+
+        return stageTimes
+
+    ##
+    # Fetch the current activity for display purposes (called from display code)
+    #
+    # \returns
+    # Tuple of (activity flag, activity text, line count); the activity flag is
+    # cleared in the process
+    #
+    def GetActivity(self):
+        self.activityLock.acquire()
+        try:
+            activity = (self.bLogActivity, self.sActivityText, self.cLogSubLines)
+            self.bLogActivity = False
+        finally:
+            self.activityLock.release()
+
+        return activity
 
     ##
     # Build queue of operations to initialize the environment on destination
@@ -136,6 +332,233 @@ class BuildHost(threading.Thread):
             return
 
 
+    ##
+    # Build queue of operations to define the shell functions that run git
+    # commands in several repositories (submodules) at once
+    #
+    #   parallel_start <dir> <command>:  Start a command (in the background)
+    #                                    in a directory
+    #   parallel_wait:                   Wait for the commands to complete,
+    #                                    and show their output (in the order
+    #                                    they were started).  The status is
+    #                                    that of the first command to fail.
+    #   submodule_parallel <command>:    Run a command in each submodule (like
+    #                                    'git submodule foreach', but at once)
+    #
+    # Also, $PBUILD_GIT_JOBS is set to the git option to fetch or clone
+    # submodules concurrently (if git is new enough to support it).
+    #
+    def BuildQueueParallel(self, queue):
+        queue.append('')
+        queue.append('PBUILD_JOBS=0')
+        queue.append('PBUILD_JOBDIR=/tmp/pbuild_jobs_$$')
+        queue.append('trap \'rm -rf $PBUILD_JOBDIR\' 0')
+        queue.append('parallel_start()')
+        queue.append('{')
+        queue.append('    [ -d $PBUILD_JOBDIR ] || mkdir -p $PBUILD_JOBDIR || return $?')
+        queue.append('    PBUILD_JOBS=`expr $PBUILD_JOBS + 1`')
+        queue.append('    echo "$1" > $PBUILD_JOBDIR/$PBUILD_JOBS.dir')
+        queue.append('    ( cd "$1" && shift && "$@"; echo $? > $PBUILD_JOBDIR/$PBUILD_JOBS.status )'
+                     ' > $PBUILD_JOBDIR/$PBUILD_JOBS.log 2>&1 < /dev/null &')
+        queue.append('}')
+        queue.append('parallel_wait()')
+        queue.append('{')
+        queue.append('    wait')
+        queue.append('    PBUILD_JOB=1')
+        queue.append('    PBUILD_JOB_STATUS=0')
+        queue.append('    while [ $PBUILD_JOB -le $PBUILD_JOBS ]; do')
+        queue.append('        echo "Entering \'`cat $PBUILD_JOBDIR/$PBUILD_JOB.dir`\'"')
+        queue.append('        cat $PBUILD_JOBDIR/$PBUILD_JOB.log 2> /dev/null')
+        queue.append('        STATUS=`cat $PBUILD_JOBDIR/$PBUILD_JOB.status 2> /dev/null`')
+        queue.append('        [ $PBUILD_JOB_STATUS -eq 0 ] && PBUILD_JOB_STATUS=${STATUS:-1}')
+        queue.append('        PBUILD_JOB=`expr $PBUILD_JOB + 1`')
+        queue.append('    done')
+        queue.append('    rm -rf $PBUILD_JOBDIR')
+        queue.append('    PBUILD_JOBS=0')
+        queue.append('    return $PBUILD_JOB_STATUS')
+        queue.append('}')
+        queue.append('submodule_parallel()')
+        queue.append('{')
+        queue.append('    for dir in `git submodule --quiet foreach \'echo $path\'`; do')
+        queue.append('        parallel_start $dir "$@"')
+        queue.append('    done')
+        queue.append('    parallel_wait')
+        queue.append('}')
+        queue.append('')
+        queue.append('# Fetch (or clone) submodules concurrently with git 2.9 and later')
+        queue.append('case `git --version 2> /dev/null | awk \'{ print $3 }\'` in')
+        queue.append('    ""|1.*|2.[0-8]|2.[0-8].*) PBUILD_GIT_JOBS="" ;;')
+        queue.append('    *) PBUILD_GIT_JOBS="--jobs=%d" ;;' % self.SUBMODULE_JOBS)
+        queue.append('esac')
+
+    ##
+    # Build queue of operations to set up build checkpoints (support for
+    # --resume)
+    #
+    # Every build records its progress in .git/pbuild_checkpoint on the host:
+    # the first line is a fingerprint of what's being built (the commits
+    # checked out in the project and in each submodule, the configure options,
+    # debug/release and the make target), and each following line names a
+    # stage that finished ('configure', 'depend', 'make <goal>', 'post <n>').
+    # With --resume, if the fingerprint matches, the stages that finished are
+    # skipped; otherwise (or without --resume) the checkpoint is started over.
+    #
+    # Defines shell functions:
+    #
+    #   checkpoint <stage>:        Record that a stage finished
+    #   checkpoint_done <stage>:   True if we're resuming, and the stage
+    #                              finished in a prior build
+    #
+    # \param[in] Command to generate the fingerprint
+    #
+    def BuildQueueCheckpoint(self, queue, fingerprint):
+        checkpointFile = '%s/.git/pbuild_checkpoint' % self.path
+
+        queue.append('')
+        queue.append('PBUILD_CHECKPOINT=%s' % checkpointFile)
+        queue.append('PBUILD_RESUME_FINGERPRINT="fingerprint `%s`"' % fingerprint)
+        queue.append('checkpoint()')
+        queue.append('{')
+        queue.append('    grep -x "$1" $PBUILD_CHECKPOINT > /dev/null 2>&1 || echo "$1" >> $PBUILD_CHECKPOINT')
+        queue.append('}')
+        queue.append('checkpoint_done()')
+        queue.append('{')
+        queue.append('    [ $PBUILD_RESUME -eq 1 ] && grep -x "$1" $PBUILD_CHECKPOINT > /dev/null 2>&1')
+        queue.append('}')
+
+        if self.config.options.resume:
+            queue.append('if [ "`head -1 $PBUILD_CHECKPOINT 2> /dev/null`" = "$PBUILD_RESUME_FINGERPRINT" ]; then')
+            queue.append('    echo')
+            queue.append('    echo "Resuming build from checkpoint"')
+            queue.append('    tail -n +2 $PBUILD_CHECKPOINT | sed \'s/^/  Finished: /\'')
+            queue.append('    PBUILD_RESUME=1')
+            queue.append('else')
+            queue.append('    echo')
+            queue.append('    echo "No checkpoint for this build; building from the start"')
+            queue.append('    echo "$PBUILD_RESUME_FINGERPRINT" > $PBUILD_CHECKPOINT')
+            queue.append('    PBUILD_RESUME=0')
+            queue.append('fi')
+        else:
+            queue.append('echo "$PBUILD_RESUME_FINGERPRINT" > $PBUILD_CHECKPOINT')
+            queue.append('PBUILD_RESUME=0')
+
+    ##
+    # Build queue of operations to run configure, using the configure cache
+    # (support for setting 'ConfigureCache')
+    #
+    # The cache lives on the host, in ~/.pbuild_cache/configure, with one tar
+    # file of the files generated by configure for each key.  The key covers
+    # the project, the path to it, the configure options, debug/release, the
+    # configure script itself, and the platform (uname).  Since the generated
+    # files also depend on the templates that configure reads, the key covers
+    # the contents of the build directory (in git) and the commits of the
+    # submodules (which configure may read from, too).  On a hit, the files
+    # are restored (with new timestamps, so make doesn't think they're out of
+    # date) rather than running configure.  On a miss, we run configure and
+    # save the files that it created or modified.
+    #
+    # The least recently used entries are removed to keep the cache within
+    # 'configure_cache_size'.  With --clear-configure-cache, all entries for
+    # the project are removed first.
+    #
+    # \param[in] Configure command
+    # \param[in] Configure options
+    #
+    def BuildQueueConfigureCache(self, queue, configure, config_options):
+        project = self.projectDefs.GetProjectName()
+        configuration = hashlib.md5('%s:%s:%s' % (self.path, config_options, self.config.options.debug)).hexdigest()
+        cacheSize = self.config.GetConfigureCacheSize()
+
+        queue.append('PBUILD_CONFIGURE_CACHE=$HOME/.pbuild_cache/configure')
+        queue.append('PBUILD_CONFIGURE_KEY=%s_%s_`( uname -srm; cksum < ./configure; git ls-tree -r HEAD . 2> /dev/null; '
+                     'cd %s && git submodule status 2> /dev/null ) | cksum | awk \'{ print $1 }\'`'
+                     % (project, configuration[:12], self.path))
+        queue.append('PBUILD_CONFIGURE_FILE=$PBUILD_CONFIGURE_CACHE/$PBUILD_CONFIGURE_KEY.tar')
+        if self.config.options.clear_configure_cache:
+            queue.append('echo "Clearing configure cache for project %s"' % project)
+            queue.append('rm -f $PBUILD_CONFIGURE_CACHE/%s_*.tar' % project)
+
+        queue.append('if [ -f $PBUILD_CONFIGURE_FILE ] && ( cd %s && tar xmf $PBUILD_CONFIGURE_FILE ); then' % self.path)
+        queue.append('    echo "Restored configure results from cache ($PBUILD_CONFIGURE_KEY)"')
+        queue.append('    touch $PBUILD_CONFIGURE_FILE')
+        queue.append('    EXITSTATUS=0')
+        queue.append('else')
+        queue.append('    rm -f $PBUILD_CONFIGURE_FILE')
+        queue.append('    mkdir -p $PBUILD_CONFIGURE_CACHE')
+        queue.append('    touch $PBUILD_CONFIGURE_CACHE/stamp.$$')
+        queue.append('    sleep 1')
+        queue.append('    ' + configure)
+        queue.append('    EXITSTATUS=$?')
+        queue.append('    if [ $EXITSTATUS -eq 0 ]; then')
+        queue.append('        PBUILD_CONFIGURE_FILES=`cd %s && find . -name .git -prune -o -type f -newer $PBUILD_CONFIGURE_CACHE/stamp.$$ -print`'
+                     % self.path)
+        queue.append('        if [ -n "$PBUILD_CONFIGURE_FILES" ] \\')
+        queue.append('            && ( cd %s && tar cf $PBUILD_CONFIGURE_FILE.$$ $PBUILD_CONFIGURE_FILES ) \\' % self.path)
+        queue.append('            && mv $PBUILD_CONFIGURE_FILE.$$ $PBUILD_CONFIGURE_FILE; then')
+        queue.append('            echo "Saved configure results to cache ($PBUILD_CONFIGURE_KEY)"')
+        queue.append('        fi')
+        queue.append('        rm -f $PBUILD_CONFIGURE_FILE.$$')
+        if cacheSize:
+            queue.append('        PBUILD_CACHE_KB=0')
+            queue.append('        for file in `ls -t $PBUILD_CONFIGURE_CACHE/*.tar 2> /dev/null`; do')
+            queue.append('            PBUILD_CACHE_KB=`expr $PBUILD_CACHE_KB + \`du -k $file | awk \'{ print $1 }\'\``')
+            queue.append('            [ $PBUILD_CACHE_KB -gt %d ] && rm -f $file' % (cacheSize * 1024))
+            queue.append('        done')
+        queue.append('    fi')
+        queue.append('    rm -f $PBUILD_CONFIGURE_CACHE/stamp.$$')
+        queue.append('fi')
+
+    ##
+    # Build queue of operations to determine the number of concurrent make
+    # jobs ($PBUILD_MAKE_JOBS) and the make flags to use them ($PBUILD_MAKE_FLAGS)
+    #
+    # Unless configured with 'make_jobs', we run one job per CPU, as long as
+    # there's MAKE_JOB_MEMORY of memory for each.  Only GNU make is given
+    # concurrent jobs; other versions of make build serially.
+    #
+    def BuildQueueMakeJobs(self, queue):
+        jobs = self.config.GetMakeJobs(self.hostname, self.projectDefs.GetProjectName())
+
+        if jobs:
+            queue.append('PBUILD_MAKE_JOBS=%d' % jobs)
+            queue.append('echo "Using $PBUILD_MAKE_JOBS make jobs (from configuration)"')
+        else:
+            queue.append('PBUILD_CPUS=`getconf _NPROCESSORS_ONLN 2> /dev/null`')
+            queue.append('case `uname -s` in')
+            queue.append('    AIX)')
+            queue.append('        [ -z "$PBUILD_CPUS" ] && PBUILD_CPUS=`bindprocessor -q 2> /dev/null | awk \'{ print NF - 4 }\'`')
+            queue.append('        PBUILD_MEMORY=`lsattr -El sys0 -a realmem 2> /dev/null | awk \'{ print int($2 / 1024) }\'` ;;')
+            queue.append('    Darwin)')
+            queue.append('        PBUILD_MEMORY=`sysctl -n hw.memsize 2> /dev/null | awk \'{ print int($1 / 1048576) }\'` ;;')
+            queue.append('    HP-UX)')
+            queue.append('        [ -z "$PBUILD_CPUS" ] && PBUILD_CPUS=`ioscan -kFC processor 2> /dev/null | wc -l`')
+            queue.append('        PBUILD_MEMORY=`/usr/contrib/bin/machinfo 2> /dev/null | awk \'/^ *Memory/ { for (i = 2; i <= NF; i++) if ($i + 0 > 0) { print int($i); exit } }\'` ;;')
+            queue.append('    Linux)')
+            queue.append('        PBUILD_MEMORY=`awk \'/^MemTotal:/ { print int($2 / 1024) }\' /proc/meminfo 2> /dev/null` ;;')
+            queue.append('    SunOS)')
+            queue.append('        [ -z "$PBUILD_CPUS" ] && PBUILD_CPUS=`psrinfo 2> /dev/null | grep -c on-line`')
+            queue.append('        PBUILD_MEMORY=`/usr/sbin/prtconf 2> /dev/null | awk \'/^Memory size/ { print $3 }\'` ;;')
+            queue.append('esac')
+            queue.append('PBUILD_CPUS=`echo $PBUILD_CPUS | tr -cd \'0-9\'`')
+            queue.append('PBUILD_MEMORY=`echo $PBUILD_MEMORY | tr -cd \'0-9\'`')
+            queue.append('PBUILD_MAKE_JOBS=${PBUILD_CPUS:-1}')
+            queue.append('if [ -n "$PBUILD_MEMORY" ]; then')
+            queue.append('    [ `expr $PBUILD_MEMORY / %d` -lt $PBUILD_MAKE_JOBS ] && PBUILD_MAKE_JOBS=`expr $PBUILD_MEMORY / %d`'
+                         % (self.MAKE_JOB_MEMORY, self.MAKE_JOB_MEMORY))
+            queue.append('fi')
+            queue.append('[ $PBUILD_MAKE_JOBS -lt 1 ] && PBUILD_MAKE_JOBS=1')
+            queue.append('echo "Using $PBUILD_MAKE_JOBS make jobs (CPUs: ${PBUILD_CPUS:-unknown}, memory: ${PBUILD_MEMORY:-unknown} MB)"')
+
+        queue.append('PBUILD_MAKE_FLAGS=')
+        queue.append('if [ $PBUILD_MAKE_JOBS -gt 1 ]; then')
+        queue.append('    if make --version 2> /dev/null | grep "GNU Make" > /dev/null; then')
+        queue.append('        PBUILD_MAKE_FLAGS=-j$PBUILD_MAKE_JOBS')
+        queue.append('    else')
+        queue.append('        echo "(make is not GNU make; building serially)"')
+        queue.append('    fi')
+        queue.append('fi')
+        queue.append('export PBUILD_MAKE_JOBS')
+
     ##
     # Build queue of operations to clean up writable files on destination
     #
@@ -151,16 +574,184 @@ class BuildHost(threading.Thread):
         #   1. git stash (in each subproject)
         #   2. git fetch (in each subproject)
         queue.append('git stash')
-        queue.append('git submodule foreach git stash')
+        queue.append('submodule_parallel git stash')
         #
-        queue.append('git fetch --recurse-submodules')
+        # (With --bundle, we fetch from the bundles later on; if we already
+        # have the commits we're building, there's nothing to fetch)
+        if self.bundles == None and self.pins:
+            checks = []
+            for repository in sorted(self.pins.keys()):
+                if repository == '.':
+                    checks.insert(0, 'git cat-file -e %s^{commit}' % self.pins[repository])
+                else:
+                    checks.append('( cd %s && git cat-file -e %s^{commit} )' % (repository, self.pins[repository]))
+            queue.append('if %s 2> /dev/null; then' % ' && '.join(checks))
+            queue.append('    echo "Commits to build are present, skipping git fetch"')
+            queue.append('else')
+            queue.append('    git fetch --recurse-submodules $PBUILD_GIT_JOBS')
+            queue.append('fi')
+        elif self.bundles == None:
+            queue.append('git fetch --recurse-submodules $PBUILD_GIT_JOBS')
+
+    ##
+    # Build queue of operations to fetch from the git bundles that were
+    # uploaded to the host (support for --bundle)
+    #
+    # If any fetch fails, we fall back to fetching from GitHub.  Repositories
+    # that don't exist yet (like new submodules) are left alone; they're
+    # fetched from GitHub when they're initialized.
+    #
+    def BuildQueueBundles(self, queue):
+        queue.append('')
+        queue.append('echo')
+        queue.append('echo ========================= Performing git fetch from bundles')
+        queue.append('date')
+        queue.append('PBUILD_BUNDLE_STATUS=0')
+        for (repository, bundle, refspecs) in self.bundles:
+            queue.append('if [ -e %s/.git ]; then' % repository)
+            queue.append('    echo "Fetching %s from %s"' % (repository, bundle))
+            queue.append('    ( cd %s && git fetch -q --no-recurse-submodules %s %s ) || PBUILD_BUNDLE_STATUS=1'
+                         % (repository, bundle, ' '.join(refspecs)))
+            queue.append('fi')
+            queue.append('rm -f %s' % bundle)
+        queue.append('if [ $PBUILD_BUNDLE_STATUS -ne 0 ]; then')
+        queue.append('    echo "WARNING: Unable to fetch from git bundles, fetching from GitHub"')
+        queue.append('    git fetch --recurse-submodules $PBUILD_GIT_JOBS')
+        queue.append('fi')
+
+    ##
+    # Get the name of a git bundle file on the host (support for --bundle)
+    #
+    # \param[in] Index of the bundle (for this host)
+    #
+    def GetBundleName(self, index):
+        return '/tmp/%(LOGNAME)s_%(HOST)s_%(PID)d_%(INDEX)d.bundle' \
+            % {'LOGNAME': os.environ['LOGNAME'], 'HOST': self.tag + self.selectSpec,
+               'PID': os.getpid(), 'INDEX': index }
+
+    ##
+    # Set the git bundles to fetch from (support for --bundle), and rebuild
+    # the queue of commands to match
+    #
+    def SetBundles(self, bundles):
+        self.bundles = bundles
+
+        self.queue = []
+        self.BuildQueue(self.queue)
+
+    ##
+    # Set the commits to build (support for setting 'ResolveBranches'), and
+    # rebuild the queue of commands to match
+    #
+    # \param[in] Dictionary of commits by repository directory ('.' for the
+    #            project); repositories not listed are checked out by name
+    #
+    def SetPins(self, pins):
+        self.pins = pins or None
+
+        self.queue = []
+        self.BuildQueue(self.queue)
+
+    ##
+    # Get the commit to check out for a repository: the resolved commit (if
+    # any), or else the branch on origin
+    #
+    def GetCheckoutRef(self, repository, branch):
+        if self.pins and repository in self.pins:
+            return self.pins[repository]
+
+        return 'origin/' + branch
 
 
+    ##
+    # Build queue of operations to clone the project (defines shell function
+    # 'create_repo_clone')
+    #
+    # Clones may be shallow ('clone_depth'), partial ('clone_filter'), and/or
+    # borrow objects from a reference repository on the host ('clone_reference').
+    # The reference repository is a bare repository shared by every checkout
+    # on the host; it's created as needed, and each repository that we clone
+    # (project and submodules) is fetched into it first, so only new objects
+    # come over the network.  Submodules are cloned with the same options.
+    #
+    def BuildQueueClone(self, queue):
+        project = self.projectDefs.GetProjectName()
+        depth = self.config.GetCloneDepth(self.hostname, project)
+        cloneFilter = self.config.GetCloneFilter(self.hostname, project)
+        reference = self.config.GetCloneReference(self.hostname, project)
+
+        # Shallow clones normally only fetch one branch; we need them all
+        # (for --branch and --subproject)
+        cloneOptions = ''
+        if depth:
+            cloneOptions += ' --depth %d --no-single-branch' % depth
+        if cloneFilter:
+            cloneOptions += ' --filter=%s' % cloneFilter
+        if reference:
+            cloneOptions += ' --reference "$PBUILD_REFERENCE"'
+
+        if reference:
+            # Note: The reference repository is never pruned (or garbage
+            # collected), since clones depend on the objects within it
+            queue.append('PBUILD_REFERENCE=%s' % reference)
+            queue.append('update_repo_reference()')
+            queue.append('{')
+            queue.append('    if [ ! -d "$PBUILD_REFERENCE" ]; then')
+            queue.append('        echo "Creating reference repository $PBUILD_REFERENCE"')
+            queue.append('        git init --bare "$PBUILD_REFERENCE" || exit $?')
+            queue.append('        git --git-dir="$PBUILD_REFERENCE" config gc.auto 0')
+            queue.append('    fi')
+            queue.append('    REMOTE_NAME=`echo "$1" | sed \'s/[^A-Za-z0-9._-]/_/g\'`')
+            queue.append('    git --git-dir="$PBUILD_REFERENCE" config remote.$REMOTE_NAME.url > /dev/null \\')
+            queue.append('        || git --git-dir="$PBUILD_REFERENCE" remote add $REMOTE_NAME "$1"')
+            queue.append('    echo "Updating reference repository from $1"')
+            queue.append('    git --git-dir="$PBUILD_REFERENCE" fetch --quiet $REMOTE_NAME \\')
+            queue.append('        || echo "WARNING: Unable to update reference repository from $1"')
+            queue.append('}')
+
+        if cloneOptions:
+            queue.append('update_repo_submodules()')
+            queue.append('{')
+            queue.append('    git submodule init || exit $?')
+            if reference:
+                queue.append('    for url in `git config --get-regexp \'^submodule\\..*\\.url$\' | awk \'{ print $2 }\'`; do')
+                queue.append('        update_repo_reference $url')
+                queue.append('    done')
+            queue.append('    git submodule update --init%s $PBUILD_GIT_JOBS || exit $?'
+                         % cloneOptions.replace(' --no-single-branch', ''))
+            queue.append('    for dir in `git config --file .gitmodules --get-regexp \'^submodule\\..*\\.path$\' | awk \'{ print $2 }\'`; do')
+            queue.append('        ( cd $dir && update_repo_submodules ) || exit $?')
+            queue.append('    done')
+            queue.append('}')
+
+        queue.append('create_repo_clone()')
+        queue.append('{')
+        queue.append('    echo')
+        queue.append('    echo ========================= Performing git clone')
+        queue.append('    date')
+        queue.append('    echo \'Cloning project %s\'' % self.projectDefs.GetCloneSource())
+        queue.append('    mkdir -p %s' % self.path)
+        queue.append('    sudo rm -rf %s' % self.path)
+
+        if cloneOptions:
+            if reference:
+                queue.append('    update_repo_reference %s' % self.projectDefs.GetCloneSource())
+            queue.append('    git clone%s %s %s || exit $?'
+                         % (cloneOptions, self.projectDefs.GetCloneSource(), self.path))
+            queue.append('    ( cd %s && update_repo_submodules ) || exit $?' % self.path)
+        else:
+            queue.append('    git clone --recursive $PBUILD_GIT_JOBS %s %s || exit $?'
+                         % (self.projectDefs.GetCloneSource(), self.path))
+
+        queue.append('    DID_WE_CLONE=1')
+        queue.append('}')
+
     ##
     # Build queue of operations to perform on the remote systems
     #
     def BuildQueue(self, queue):
         self.BuildQueueInitialize(queue)
+        self.BuildQueueParallel(queue)
 
         # Normally done by 'pbuild --init', but verify in case --init disabled
         # Note that some hosts don't support "-o HashKnownHosts=no", so try twice
@@ -172,18 +763,7 @@ class BuildHost(threading.Thread):
         queue.append('grep github.com, ~/.ssh/known_hosts > /dev/null 2> /dev/null || ssh -o StrictHostKeyChecking=no -T git@github.com')
 
         # If directory doesn't exist, automatically clone
-        queue.append('create_repo_clone()')
-        queue.append('{')
-        queue.append('    echo')
-        queue.append('    echo ========================= Performing git clone')
-        queue.append('    date')
-        queue.append('    echo \'Cloning project %s\'' % self.projectDefs.GetCloneSource())
-        queue.append('    mkdir -p %s' % self.path)
-        queue.append('    sudo rm -rf %s' % self.path)
-        queue.append('    git clone --recursive %s %s || exit $?'
-                            % (self.projectDefs.GetCloneSource(), self.path))
-        queue.append('    DID_WE_CLONE=1')
-        queue.append('}')
+        self.BuildQueueClone(queue)
         queue.append('DID_WE_CLONE=0')
         queue.append('')
         queue.append('if [ ! -d %s -o ! -d %s/.git ]; then' % (self.path, self.path))
@@ -203,17 +783,40 @@ class BuildHost(threading.Thread):
         self.BuildQueueCleanup(queue)
         queue.append('fi')
 
+        if self.bundles != None:
+            self.BuildQueueBundles(queue)
+
         # One way or another, we have a clean repository, so get it in a known state:
         #
         #   1. git checkout origin/master (in each subproject)
         #   2. Apply --branch and --subproject as needed
 
-        queue.append('')
-        queue.append('echo')
-        queue.append('echo ========================= Performing git checkout origin/master')
-        queue.append('date')
-        queue.append('git checkout origin/master')
-        queue.append('git submodule foreach git checkout origin/master')
+        #
+        # (For incremental or resumed builds, skip the checkout of origin/master
+        # if we're applying a branch; files that differ would be rewritten
+        # twice, and thus rebuilt every time)
+
+        if not ((self.config.options.incremental or self.config.options.resume) and self.config.options.branch):
+            queue.append('')
+            queue.append('echo')
+            queue.append('echo ========================= Performing git checkout origin/master')
+            queue.append('date')
+            if self.pins and not self.config.options.branch:
+                # (Check out the resolved commit of each submodule at once)
+                queue.append('git checkout %s || exit $?' % self.GetCheckoutRef('.', 'master'))
+                queue.append('for dir in `git submodule --quiet foreach \'echo $path\'`; do')
+                queue.append('    case $dir in')
+                for repository in sorted(self.pins.keys()):
+                    if repository != '.':
+                        queue.append('        %s) parallel_start $dir git checkout %s ;;'
+                                     % (repository, self.pins[repository]))
+                queue.append('        *) parallel_start $dir git checkout origin/master ;;')
+                queue.append('    esac')
+                queue.append('done')
+                queue.append('parallel_wait || exit $?')
+            else:
+                queue.append('git checkout origin/master')
+                queue.append('submodule_parallel git checkout origin/master')
 
         if self.config.options.branch:
             queue.append('')
@@ -221,11 +824,18 @@ class BuildHost(threading.Thread):
             queue.append('echo ========================= Performing Applying --branch qualifier')
             queue.append('date')
             queue.append('# Applying branch \'origin/%s\' to project' % self.config.options.branch)
-            queue.append('git checkout origin/%s || exit $?' % self.config.options.branch)
-            queue.append('git submodule update --init || exit $?')
+            queue.append('git checkout %s || exit $?' % self.GetCheckoutRef('.', self.config.options.branch))
+            queue.append('git submodule update --init $PBUILD_GIT_JOBS || exit $?')
 
+        # (If we're building several projects, only apply subprojects that are
+        # valid for this project)
+        subprojectList = []
         if self.config.options.subproject:
-            subprojectList = self.config.options.subproject.split(',')
+            for subproject in self.config.options.subproject.split(','):
+                if self.projectDefs.ValidateSubproject(subproject.split(':')[0]):
+                    subprojectList.append(subproject)
+
+        if len(subprojectList):
             queue.append('')
             queue.append('echo')
             queue.append('echo ========================= Performing Applying --subproject qualifier')
@@ -240,11 +850,56 @@ class BuildHost(threading.Thread):
                              % (subproject_dir, subproject))
                 queue.append('    exit 1')
                 queue.append('fi')
-                queue.append('cd %s || exit $?' % subproject_dir)
-                queue.append('git checkout origin/%s || exit $?' % subproject_branch)
-                queue.append('cd %s || exit $?' % self.path)
+            # (Then check out all of the subprojects at once)
+            for subproject in subprojectList:
+                subproject_dir, subproject_branch = subproject.split(':')
+                queue.append('parallel_start %s git checkout %s'
+                             % (subproject_dir, self.GetCheckoutRef(os.path.normpath(subproject_dir), subproject_branch)))
+            queue.append('parallel_wait || exit $?')
             queue.append('echo')
 
+        config_options = self.projectDefs.GetConfigureQualifiers()
+        if self.projectDefs.GetProjectName() in self.config.configure_options:
+            config_options = self.config.configure_options[self.projectDefs.GetProjectName()]
+
+        # Support for --incremental: We fingerprint everything that 'git clean'
+        # and 'configure' depend on (the commits checked out, the configure
+        # options, and debug/release).  If the fingerprint matches the one from
+        # the last build, we skip both of them and go straight to 'make'.
+
+        sources = '( git rev-parse HEAD; git submodule status --recursive; echo %s ) | cksum'
+        fingerprintFile = '%s/.git/pbuild_fingerprint' % self.path
+        if self.config.options.incremental:
+            configuration = hashlib.md5('%s:%s' % (config_options, self.config.options.debug)).hexdigest()
+
+            queue.append('')
+            queue.append('PBUILD_FINGERPRINT=`%s`' % (sources % configuration))
+            queue.append('if [ "$PBUILD_FINGERPRINT" = "`cat %s 2> /dev/null`" ]; then' % fingerprintFile)
+            queue.append('    echo')
+            queue.append('    echo "Fingerprint unchanged: skipping git clean and configure (incremental build)"')
+            queue.append('    PBUILD_SKIP_CONFIGURE=1')
+            queue.append('else')
+            queue.append('    rm -f %s' % fingerprintFile)
+            queue.append('    PBUILD_SKIP_CONFIGURE=0')
+            queue.append('fi')
+
+        # Support for --resume: Each build records a checkpoint as each stage
+        # finishes (see BuildQueueCheckpoint); with --resume, the stages that
+        # finished are skipped if the checkpoint is for the same build.
+
+        self.BuildQueueCheckpoint(queue, sources % hashlib.md5('%s:%s:%s' % (
+                    config_options, self.config.options.debug, self.config.options.target)).hexdigest())
+        if self.config.options.resume:
+            if not self.config.options.incremental:
+                queue.append('PBUILD_SKIP_CONFIGURE=0')
+            queue.append('if checkpoint_done configure; then')
+            queue.append('    echo "Resuming: skipping git clean and configure"')
+            queue.append('    PBUILD_SKIP_CONFIGURE=1')
+            queue.append('fi')
+
+        if self.config.options.incremental or self.config.options.resume:
+            queue.append('if [ $PBUILD_SKIP_CONFIGURE -eq 0 ]; then')
+
         # Clean up the repostories of any existing (unnecessary files)
         # We do this step here to properly handle any changes to .gitignore
 
@@ -253,7 +908,7 @@ class BuildHost(threading.Thread):
         queue.append('echo ========================= Performing git clean')
         queue.append('date')
         queue.append('sudo git clean -fdx || exit $?')
-        queue.append('sudo git submodule foreach git clean -fdx || exit $?')
+        queue.append('submodule_parallel sudo git clean -fdx || exit $?')
 
         # Get ready to build
 
@@ -269,38 +924,54 @@ class BuildHost(threading.Thread):
             queue.append('echo ========================= Performing Determining debug/release')
             queue.append('date')
 
-            config_options = self.projectDefs.GetConfigureQualifiers()
-            if self.projectDefs.GetProjectName() in self.config.configure_options:
-                config_options = self.config.configure_options[self.projectDefs.GetProjectName()]
-
             if self.config.options.debug:
                 queue.append('echo "Performing DEBUG build"')
                 if config_options:
                     queue.append('echo "  (Configuration options: %s --enable-debug)"' % config_options)
-                queue.append('./configure %s --enable-debug' % config_options)
-                queue.append('EXITSTATUS=$?')
+                configure = './configure %s --enable-debug' % config_options
             else:
                 queue.append('echo "Performing RELEASE build"')
                 if config_options:
                     queue.append('echo "  (Configuration options: %s)"' % config_options)
-                queue.append('./configure %s' % config_options)
+                configure = './configure %s' % config_options
+
+            if self.config.GetSetting('ConfigureCache'):
+                self.BuildQueueConfigureCache(queue, configure, config_options)
+            else:
+                queue.append(configure)
                 queue.append('EXITSTATUS=$?')
             queue.append('[ $EXITSTATUS != 0 ] && exit $EXITSTATUS')
 
+        # Record the fingerprint (only once we've successfully configured)
+        if self.config.options.incremental:
+            queue.append('echo "$PBUILD_FINGERPRINT" > %s' % fingerprintFile)
+
+        if self.config.options.incremental or self.config.options.resume:
+            queue.append('else')
+            queue.append('    cd %s || exit $?' % self.projectDefs.GetBuildDirectory())
+            queue.append('fi')
+        queue.append('checkpoint configure')
+
         if self.projectDefs.GetMakeDependencies():
             queue.append('')
-            queue.append('echo')
-            queue.append('echo ========================= Performing make depend')
-            queue.append('date')
-            queue.append('make depend')
-            queue.append('echo')
+            queue.append('if checkpoint_done depend; then')
+            queue.append('    echo "Resuming: skipping make depend"')
+            queue.append('else')
+            queue.append('    echo')
+            queue.append('    echo ========================= Performing make depend')
+            queue.append('    date')
+            queue.append('    make depend && checkpoint depend')
+            queue.append('    echo')
+            queue.append('fi')
 
-        if len(self.config.options.target) != 0:
-            # Our target is?
-            target = self.projectDefs.GetTargets()
-            if self.config.options.target != "target_default":
-                target = self.config.options.target
+        # Our target is?  (Command line, then configuration file, then project default)
+        target = self.projectDefs.GetTargets()
+        if self.config.options.target != "target_default":
+            target = self.config.options.target
+        elif self.projectDefs.GetProjectName() in self.config.make_target:
+            target = self.config.GetMakeTarget(self.projectDefs.GetProjectName())
 
+        if len(target) != 0:
             queue.append('')
             queue.append('echo')
             queue.append('echo \'========================= Performing make ' + target + '\'')
@@ -313,9 +984,25 @@ class BuildHost(threading.Thread):
             if self.config.GetTestList() != '':
                 queue.append('SCX_TESTRUN_NAMES=\"%s\"; export SCX_TESTRUN_NAMES' % self.config.GetTestList())
 
+            self.BuildQueueMakeJobs(queue)
+
+            # With concurrent jobs, make may build several goals at once, so
+            # build the goals one at a time (variable settings apply to all)
+            goals = [word for word in target.split() if '=' not in word] or [ "''" ]
+            variables = ''.join([word + ' ' for word in target.split() if '=' in word])
+
             queue.append('echo \'========================= Performing make %s ' % target + '\'')
-            queue.append('make %s ' % target)
-            queue.append('MAKE_STATUS=$?')
+            queue.append('MAKE_STATUS=0')
+            queue.append('for goal in %s; do' % ' '.join(goals))
+            queue.append('    if checkpoint_done "make $goal"; then')
+            queue.append('        echo "Resuming: skipping make $goal"')
+            queue.append('        continue')
+            queue.append('    fi')
+            queue.append('    make $PBUILD_MAKE_FLAGS %s$goal' % variables)
+            queue.append('    MAKE_STATUS=$?')
+            queue.append('    [ $MAKE_STATUS -ne 0 ] && break')
+            queue.append('    checkpoint "make $goal"')
+            queue.append('done')
             queue.append('if [ $MAKE_STATUS -ne 0 ]; then')
             queue.append('    EXITSTATUS=$MAKE_STATUS')
             queue.append('fi')                
@@ -323,13 +1010,21 @@ class BuildHost(threading.Thread):
 
         if len(self.projectDefs.GetPostBuildCommands()) > 0:
             queue.append('echo \'========================= Performing post build steps\'')
+
+            # Post-build steps that run make use the same number of jobs
+            if len(target) == 0:
+                self.BuildQueueMakeJobs(queue)
+            queue.append('MAKEFLAGS="$PBUILD_MAKE_FLAGS"; export MAKEFLAGS')
             queue.append('POSTSTATUS=0')
-            for command in self.projectDefs.GetPostBuildCommands():
-                queue.append('if [ $POSTSTATUS -eq 0 ]; then')
+            for index, command in enumerate(self.projectDefs.GetPostBuildCommands()):
+                queue.append('if [ $POSTSTATUS -eq 0 ] && checkpoint_done "post %d"; then' % (index + 1))
+                queue.append('    echo "Resuming: skipping post build step %d"' % (index + 1))
+                queue.append('elif [ $POSTSTATUS -eq 0 ]; then')
                 queue.append('    echo \'========================= Performing Executing %s ' % command + '\'')
 
                 queue.append('    ' + command)
                 queue.append('    POSTSTATUS=$?')
+                queue.append('    [ $POSTSTATUS -eq 0 ] && checkpoint "post %d"' % (index + 1))
                 queue.append('fi')
             queue.append('if [ $POSTSTATUS -ne 0 ]; then')
             queue.append('    EXITSTATUS=$POSTSTATUS')
@@ -339,79 +1034,97 @@ class BuildHost(threading.Thread):
         queue.append('echo Ending at:  `date`')
 
     ##
-    # Perform a build on a remote system (execute the command script already copied).
+    # Get the command line to perform the build on the remote system (execute the
+    # command script already copied, or with setting 'StreamScript', the command
+    # script that we write to standard input).
     #
-    # Upon completion, <object>.process.returncode will contain the exit status for
-    # the remote build.
-    def DoBuild(self):
+    def GetBuildCommand(self):
+        if not self.streamScript:
+            command = 'chmod 755 ' + self.destinationName + '; bash ' + self.destinationName
+        elif not self.diagnoseErrors:
+            command = 'bash -s'
+        else:
+            # In case of internal errors, save the command script as we run it
+            command = 'tee ' + self.destinationName + ' | bash -s'
+
+        if self.showProgress:
+            return self.transport.GetCommand(self.hostname, ['-A'], command)
+        else:
+            return self.transport.GetCommand(self.hostname, [], command)
+
+    ##
+    # Open the log file for the build (deleting prior log files as configured)
+    #
+    # \returns
+    # The open log file
+    #
+    def OpenLogfile(self):
         # If we're doing logfile renaming, active logs start as 'active-'
         if self.renameLogfiles:
             activeStr = 'active-'
         else:
             activeStr = ''
 
-        outfname = '%s%s%s%s.log' % (self.logPrefix, activeStr, self.tag, self.selectSpec)
+        self.outfname = self.GetLogfileName(activeStr)
 
+        # (Whether or not they're compressed)
         if self.deleteLogfiles:
-            for prefix in [ '', 'active-', 'done-', 'failed-' ]:
+            prefixes = [ '', 'active-', 'done-', 'failed-' ]
+        else:
+            prefixes = [ activeStr ]
+
+        for prefix in prefixes:
+            for filename in [ self.GetLogfileName(prefix, compressed=False),
+                              self.GetLogfileName(prefix, compressed=True),
+                              self.GetIndexName(prefix) ]:
                 try:
-                    os.remove('%s%s%s%s.log' % (self.logPrefix, prefix, self.tag, self.selectSpec))
+                    os.remove(filename)
                 except OSError:
                     # If the file doesn't exist, that's fine
                     pass
-        else:
-            try:
-                os.remove(outfname)
-            except OSError:
-                # If the file doesn't exist, that's fine
-                pass
 
-        # Open the output file and launch the subprocess
-        #
+        # Index the log as it's written (the index exists from the start, so
+        # readers can tell that the log isn't complete)
+        self.logIndex = LogIndex(self.GetIndexName(activeStr))
+        self.logIndex.Write(False)
+
+        # Compressed log files are compressed as the output streams in
+        if self.compressLogfiles:
+            return BlockGzipFile(self.outfname)
+
         # Slightly different behavior based on "ShowProgress" setting
         # (solely for performance benefit - otherwise not really needed)
         if self.showProgress:
-            outf = open(outfname, 'a+', 1)
-
-            self.process = subprocess.Popen(
-                ['ssh', '-A', self.hostname, 'chmod 755 ' + self.destinationName + '; bash ' + self.destinationName],
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT
-                )
-
-            # Handle output from the subprocess
-            while True:
-                line = self.process.stdout.readline()
-                if line == '':
-                    break
-
-                # Track out line count, save off any "state" lines, and save output
-                self.bLogActivity = True
-                self.cLogSubLines += 1
-
-                if line.startswith('========================= Performing '):
-                    self.sActivityText = line.rstrip()[37:]
-                    self.cLogSubLines = 0
-                outf.write(line)
-
-                if line.startswith("make: warning:  Clock skew detected."):
-                    outf.write("FATAL ERROR: Terminating process due to clock skew!");
-                    outf.write("*** Check destination system to verify remote build was killed! ***")
-                    self.process.terminate()
-
-            self.process.communicate()
+            return open(self.outfname, 'a+', 1)
         else:
-            outf = open(outfname, 'a+')
+            return open(self.outfname, 'a+')
 
-            self.process = subprocess.Popen(
-                ['ssh', self.hostname, 'chmod 755 ' + self.destinationName + '; bash ' + self.destinationName],
-                stdin=subprocess.PIPE,
-                stdout=outf,
-                stderr=outf
-                )
+    ##
+    # Handle a line of output from the remote build
+    #
+    def ProcessLine(self, outf, line):
+        # Track out line count, save off any "state" lines, and save output
+        self.NoteActivity(line)
+        outf.write(line)
+        self.logIndex.AddLine(line)
+
+        if line.startswith(self.REMOTE_PGID_MARKER):
+            pgid = line[len(self.REMOTE_PGID_MARKER):].strip()
+            if pgid.isdigit():
+                self.remotePgid = pgid
+
+        if line.startswith("make: warning:  Clock skew detected."):
+            for message in [ "FATAL ERROR: Terminating process due to clock skew!",
+                             "*** Check destination system to verify remote build was killed! ***" ]:
+                outf.write(message)
+                self.logIndex.AddLine(message)
+            self.process.terminate()
 
-        self.process.wait()
+    ##
+    # Close the log file for the build, renaming it based on completion status
+    # if configured.  The build process must have completed.
+    #
+    def CloseLogfile(self, outf):
         outf.close()
 
         if self.renameLogfiles:
@@ -421,19 +1134,69 @@ class BuildHost(threading.Thread):
             else:
                 completionStr = 'failed-'
 
-            newfname = '%s%s%s%s.log' % (self.logPrefix, completionStr, self.tag, self.selectSpec)
-            os.rename(outfname, newfname)
+            newfname = self.GetLogfileName(completionStr)
+            os.rename(self.outfname, newfname)
+            self.logIndex.Close(self.GetIndexName(completionStr))
+        else:
+            self.logIndex.Close()
 
     ##
-    # Generate a command script to execute a remote build and copy it to the remote system.
-    # This is done by creating a local temporary file, then copying that file to the remote
-    # host.  Upon exit from this function, the local temporary file is deleted.
+    # Perform a build on a remote system (execute the command script already copied).
+    #
+    # Upon completion, <object>.process.returncode will contain the exit status for
+    # the remote build.
+    def DoBuild(self):
+        # Open the output file and launch the subprocess
+        outf = self.OpenLogfile()
+        self.StartBuildProcess()
+
+        # Handle output from the subprocess
+        # (Even without progress updates, we need the output to track the stages)
+        while True:
+            line = self.process.stdout.readline()
+            if line == '':
+                break
+
+            self.ProcessLine(outf, line)
+
+        # (Standard input is already closed if we streamed the command script)
+        if not self.process.stdin.closed:
+            self.process.stdin.close()
+        self.process.wait()
+        self.CloseLogfile(outf)
+
+    ##
+    # Launch the subprocess to perform the build on the remote system.  With
+    # setting 'StreamScript', the command script is written to its input.
+    #
+    def StartBuildProcess(self):
+        if self.streamScript:
+            script = self.GetCommandScript()
+
+        self.process = subprocess.Popen(
+            self.GetBuildCommand(),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            preexec_fn=self.transport.GetPreexecFunction()
+            )
+
+        if self.streamScript:
+            # If the connection fails, the exit status tells the tale
+            try:
+                self.process.stdin.write(script)
+                self.process.stdin.close()
+            except IOError:
+                pass
+
+    ##
+    # Generate the command script to execute a remote build
     #
     # \returns
-    # Status from copy of command script to remote system (normally zero)
-    def GenerateCommandScript(self):
+    # The command script
+    def GetCommandScript(self):
         self.destinationName = '/tmp/%(LOGNAME)s_%(HOST)s_%(PID)d.sh' \
-            % {'LOGNAME': os.environ['LOGNAME'], 'HOST': self.tag, 'PID': os.getpid() }
+            % {'LOGNAME': os.environ['LOGNAME'], 'HOST': self.tag + self.selectSpec, 'PID': os.getpid() }
 
         # Prepend commands to go to the proper directory and delete our
         # temporary command script.
@@ -444,74 +1207,169 @@ class BuildHost(threading.Thread):
         #self.queue.insert(0, 'echo \'-*- mode: compilation -*-\'')
 
         # In case of internal errors, leave temporary command script around
-        if not self.diagnoseErrors:
+        # (When streaming the command script, it's only saved in that case)
+        if self.diagnoseErrors:
+            self.queue.insert(1, 'echo \'Executing script %s\'' % self.destinationName)
+        elif not self.streamScript:
             self.queue.insert(1, 'rm ' + self.destinationName)
         else:
-            self.queue.insert(1, 'echo \'Executing script %s\'' % self.destinationName)
+            self.queue.insert(1, '')
 
         self.queue.insert(2, 'echo "Executing on host $HOSTNAME (%(TAG)s: %(HOST)s)"' \
                               % {'TAG' : self.tag, 'HOST' : self.hostname } )
-        self.queue.insert(3, '')
+
+        # Report our process group (everything we run shares it) so that the
+        # remote build can be killed if we abort (UNIX95 is needed for HP-UX)
+        self.queue.insert(3, 'PBUILD_PGID=`UNIX95=1 ps -o pgid= -p $$ 2>/dev/null | tr -d \' \'`')
+        self.queue.insert(4, 'echo "%s${PBUILD_PGID:-unknown}"' % self.REMOTE_PGID_MARKER)
+        self.queue.insert(5, '')
 
         # We assume that $EXITSTATUS was previously set by project-specific queue code
         self.queue.append('echo ========================= Performing Finishing up\; status=$EXITSTATUS')
         self.queue.append('exit $EXITSTATUS')
 
-        # Generate a temporary file with all of our commands
+        script = ''.join([command + '\n' for command in self.queue])
 
-        tmpfile = tempfile.NamedTemporaryFile()
+        # When streaming the command script to 'bash -s', commands that read
+        # from standard input would consume the rest of the script.  So wrap
+        # the script in a function (bash reads all of it before running it),
+        # and run that with standard input from /dev/null.
+        if self.streamScript:
+            script = 'pbuild_script()\n{\n' + script + '}\n\npbuild_script < /dev/null\n'
 
-        for command in self.queue:
-            tmpfile.write(command + '\n')
+        return script
 
+    ##
+    # Generate a command script to execute a remote build in a local temporary file.
+    #
+    # \returns
+    # The local temporary file (deleted when closed)
+    def WriteCommandScript(self):
+        tmpfile = tempfile.NamedTemporaryFile()
+        tmpfile.write(self.GetCommandScript())
         tmpfile.flush()
 
+        return tmpfile
+
+    ##
+    # Get the command line to kill the remote build (the entire process group
+    # of the command script).  Processes that ignore SIGTERM are killed a few
+    # seconds later.  The build directory is left intact.
+    #
+    # \returns
+    # Command line, or None if the process group isn't known (yet)
+    #
+    def GetKillCommand(self):
+        if self.remotePgid == None:
+            return None
+
+        # Run under bash, since the login shell may not support 'kill --'
+        kill = 'kill -TERM -- -%(PGID)s 2>/dev/null; (sleep 5; kill -KILL -- -%(PGID)s) >/dev/null 2>&1 &' \
+            % { 'PGID': self.remotePgid }
+        return self.transport.GetCommand(self.hostname, [], "bash -c '%s'" % kill)
+
+    ##
+    # Get the command line to copy the command script to the remote system
+    #
+    def GetCopyCommand(self, tmpfname):
+        return self.transport.GetCopyCommand(self.hostname, tmpfname, self.destinationName)
+
+    ##
+    # Generate a command script to execute a remote build and copy it to the remote system.
+    # This is done by creating a local temporary file, then copying that file to the remote
+    # host.  Upon exit from this function, the local temporary file is deleted.
+    #
+    # \returns
+    # Status from copy of command script to remote system (normally zero)
+    def GenerateCommandScript(self):
+        tmpfile = self.WriteCommandScript()
+
         # Copy the temporary command file to the destination host
 
         self.process = subprocess.Popen(
-            ['scp', '-q', tmpfile.name, self.hostname + ':' + self.destinationName],
+            self.GetCopyCommand(tmpfile.name),
             stdin=subprocess.PIPE
             )
-
-        # If the process isn't running yet, the wait() will fail - handle that
-        waitComplete = False
-        for i in range(60):
-            try:
-                self.process.wait()
-                waitComplete = True
-                break
-            except OSError:
-                time.sleep(1)
-
-        # Last try - if this fails, we get a stack trace (which is fine)
-        if waitComplete == False:
-            self.process.wait()
+        self.process.wait()
 
         # Temporary file deleted on exit of this function ...
 
         return self.process.returncode
 
+    ##
+    # We aren't going to run, so create an empty log file with an error in it
+    #
+    def WriteCopyFailure(self):
+        self.WriteFailureLog("ERROR: SCP process did not properly copy script for host: %s\n" % self.hostname)
+
+    ##
+    # We aren't going to run, so create a log file with an error in it
+    #
+    def WriteFailureLog(self, message):
+        if self.renameLogfiles:
+            completionStr = 'failed-'
+        else:
+            completionStr = ''
+
+        outfname = self.GetLogfileName(completionStr)
+        if self.compressLogfiles:
+            outf = BlockGzipFile(outfname, 'w')
+        else:
+            outf = open(outfname, 'w+')
+        outf.write(message)
+        outf.close()
+
     def run(self):
-        if self.GenerateCommandScript() == 0:
+        # Let the display code know we're starting up
+        self.events.Post(EVENT_ACTIVITY, self)
+
+        try:
+            self.RunBuild()
+        finally:
+            self.events.Post(EVENT_FINISHED, self)
+
+    def RunBuild(self):
+        # With setting 'StreamScript', there's no command script to copy
+        if self.streamScript:
+            self.DoBuild()
+        elif self.GenerateCommandScript() == 0:
             self.DoBuild()
         else:
-            # We aren't going to run, so create an empty log file with an error in it
-            if self.renameLogfiles:
-                completionStr = 'failed-'
-            else:
-                completionStr = ''
+            self.WriteCopyFailure()
 
-            outfname = '%s%s%s%s.log' % (self.logPrefix, completionStr, self.tag, self.selectSpec)
-            outf = open(outfname, 'w+')
-            outf.write("ERROR: SCP process did not properly copy script for host: %s\n" % self.hostname)
-            outf.close()
+        self.CollectArtifacts()
 
         return
 
+    ##
+    # Collect the build artifacts from the remote system, once the build has
+    # completed (support for 'collect' and 'collect_failure')
+    #
+    def CollectArtifacts(self):
+        if self.collector == None:
+            return
+
+        # (If the command script couldn't be copied, the build failed too)
+        failed = self.process == None or self.process.returncode != 0
+
+        self.NoteActivity('========================= Performing Collecting artifacts\n')
+        try:
+            self.collector.Collect(self, failed)
+        except (IOError, OSError), e:
+            sys.stderr.write('Unable to collect artifacts from host %s: %s\n' % (self.hostname, e))
+
 ##
 # Builder class - oversees the overall build process
 #
 class Builder:
+    # Time (in seconds) to wait for remote builds to be killed when aborting
+    ABORT_TIMEOUT = 15
+
+    # Probing hosts before starting: Time (in seconds) to wait for a host to
+    # respond, and the time after which we warn that a host is slow
+    PROBE_TIMEOUT = 10
+    PROBE_SLOW = 2.0
+
     ##
     # Ctor.
     # \param[in] Configuration class
@@ -545,7 +1403,7 @@ class Builder:
     ##
     # Move log files to prior log directory if desired
     #
-    def MoveLogfiles(self):
+    def MoveLogfiles(self, hosts):
         # Just return if we're not doing logfile moving
         if self.config.GetLogfilePriorPrefix() == '':
             return
@@ -556,8 +1414,9 @@ class Builder:
         else:
             prefixStr = [ '' ]
 
-        # For each machine/prefix combination, move the log file
-        for machine in sorted(self.config.machines.keys()):
+        # For each host/prefix combination, move the log file
+        # (Log files are named by tag, and by selector if configured)
+        for host in hosts:
             # To keep the prior log directory from becoming a garbage dump, we
             # delete prior logs if we'll be moving any existing logs (based on
             # configuration setting 'DeleteLogFiles')
@@ -566,35 +1425,277 @@ class Builder:
                 # Do we have any existing log files to move for this host?
                 existingLogs = False
                 for prefix in prefixStr:
-                    srcfname = '%s%s%s.log' % (self.config.GetLogfilePrefix(), prefix, machine)
+                    for compressed in [ False, True ]:
+                        srcfname = host.GetLogfileName(prefix, compressed=compressed)
+                        if os.path.exists(srcfname):
+                            existingLogs = True
+
+                # If so, then delete all variations of the log file from prior ...
+                if existingLogs:
+                    for prefix in prefixStr:
+                        for dstfname in [ host.GetLogfileName(prefix, self.config.GetLogfilePriorPrefix(), False),
+                                          host.GetLogfileName(prefix, self.config.GetLogfilePriorPrefix(), True),
+                                          host.GetIndexName(prefix, self.config.GetLogfilePriorPrefix()) ]:
+                            try:
+                                os.remove(dstfname)
+                            except OSError:
+                                # If the file doesn't exist, that's fine
+                                pass
+
+            # And finally, move the 'current' logs (whether or not they're
+            # compressed) and their indexes to the prior directory
+            for prefix in prefixStr:
+                for (srcfname, dstfname) in [
+                    (host.GetLogfileName(prefix, compressed=False),
+                     host.GetLogfileName(prefix, self.config.GetLogfilePriorPrefix(), False)),
+                    (host.GetLogfileName(prefix, compressed=True),
+                     host.GetLogfileName(prefix, self.config.GetLogfilePriorPrefix(), True)),
+                    (host.GetIndexName(prefix),
+                     host.GetIndexName(prefix, self.config.GetLogfilePriorPrefix())) ]:
                     try:
-                        os.stat(srcfname)
-                        existingLogs = True
-                        break
+                        os.rename(srcfname, dstfname)
                     except OSError:
                         # If the file doesn't exist, that's fine
                         pass
 
-                # If so, then delete all variations of the log file from prior ...
-                if existingLogs:
-                    for prefix in prefixStr:
-                        dstfname = '%s%s%s.log' % (self.config.GetLogfilePriorPrefix(), prefix, machine)
+            # With setting 'CompressLogfiles', compress the prior logs that
+            # aren't compressed yet (unless there's a newer compressed one)
+            if self.config.GetSetting('CompressLogfiles'):
+                for prefix in prefixStr:
+                    plainfname = host.GetLogfileName(prefix, self.config.GetLogfilePriorPrefix(), False)
+                    dstfname = host.GetLogfileName(prefix, self.config.GetLogfilePriorPrefix(), True)
+                    if os.path.exists(plainfname) and not os.path.exists(dstfname):
                         try:
-                            os.remove(dstfname)
-                        except OSError:
-                            # If the file doesn't exist, that's fine
-                            pass
+                            CompressLogfile(plainfname, dstfname)
+                        except (IOError, OSError), e:
+                            print "WARNING: Unable to compress log file %s: %s" % (plainfname, e)
 
-            # And finally, move the 'current' logs to the prior directory
-            for prefix in prefixStr:
-                srcfname = '%s%s%s.log' % (self.config.GetLogfilePrefix(), prefix, machine)
-                dstfname = '%s%s%s.log' % (self.config.GetLogfilePriorPrefix(), prefix, machine)
+    ##
+    # Start any queued hosts that now have a free slot
+    #
+    # \returns
+    # List of hosts that were started
+    #
+    def DispatchHosts(self, scheduler):
+        started = scheduler.Dispatch()
+        for host in started:
+            host.startTime = time.time()
+            self.engine.Start(host)
 
-                try:
-                    os.rename(srcfname, dstfname)
-                except OSError:
-                    # If the file doesn't exist, that's fine
-                    pass
+        return started
+
+    ##
+    # Finish up a host that has completed (and record it in the build history)
+    #
+    # \returns
+    # True if the host built successfully, False otherwise
+    #
+    def FinishHost(self, scheduler, host):
+        self.engine.Join(host)
+        host.finished = True
+        scheduler.Release(host)
+
+        # (If something went wrong before the build process was started, or
+        # before it completed, the host failed)
+        returncode = -1
+        if host.process != None and host.process.returncode != None:
+            returncode = host.process.returncode
+
+        endTime = time.time()
+        host.stageTimes = host.GetStageTimes(endTime)
+        self.history.RecordBuild(host, returncode, host.startTime, endTime - host.startTime,
+                                 host.stageTimes)
+
+        return returncode == 0
+
+    ##
+    # Probe the hosts (concurrently) before starting any builds
+    #
+    # We measure the time to connect to each host and run a trivial command
+    # (over a new connection, not a shared one, so the SSH handshake counts).
+    # Hosts that don't respond within PROBE_TIMEOUT seconds are marked as
+    # unreachable (and finished, so they're never started), and we warn about
+    # hosts that take more than PROBE_SLOW seconds.
+    #
+    # \returns
+    # List of unreachable hosts
+    #
+    def ProbeHosts(self, hosts):
+        hostnames = sorted(set([host.hostname for host in hosts]))
+        print "Probing %d hosts ..." % len(hostnames)
+
+        devnull = open(os.devnull, 'r+')
+        probes = {}
+        startTime = time.time()
+        for hostname in hostnames:
+            probes[hostname] = subprocess.Popen(
+                self.config.GetTransport(hostname).GetCommand(
+                    hostname,
+                    ['-o', 'BatchMode=yes', '-o', 'ConnectTimeout=%d' % self.PROBE_TIMEOUT],
+                    'true',
+                    shared=False),
+                stdin=devnull,
+                stdout=devnull,
+                stderr=devnull
+                )
+        devnull.close()
+
+        # Wait for the probes, noting when each completes
+        latency = {}
+        deadline = startTime + self.PROBE_TIMEOUT
+        while len(latency) < len(probes) and time.time() < deadline:
+            for hostname in hostnames:
+                if hostname not in latency and probes[hostname].poll() != None:
+                    latency[hostname] = time.time() - startTime
+            time.sleep(0.01)
+
+        # (A probe may have completed since we last looked)
+        reachable = {}
+        for hostname in hostnames:
+            if probes[hostname].poll() == None:
+                probes[hostname].kill()
+                probes[hostname].wait()
+                reachable[hostname] = False
+            else:
+                latency.setdefault(hostname, time.time() - startTime)
+                reachable[hostname] = (probes[hostname].returncode == 0)
+
+        unreachable = []
+        for host in hosts:
+            if reachable[host.hostname]:
+                host.latency = latency[host.hostname]
+            else:
+                host.unreachable = True
+                host.finished = True
+                host.completionStatus = "Unreachable"
+                host.WriteFailureLog("ERROR: Host %s is unreachable\n" % host.hostname)
+                unreachable.append(host)
+
+        for hostname in hostnames:
+            if not reachable[hostname]:
+                print "WARNING: Host %s is unreachable, skipping it" % hostname
+            elif latency[hostname] > self.PROBE_SLOW:
+                print "WARNING: Host %s is slow to respond (%.1f seconds)" % (hostname, latency[hostname])
+
+        return unreachable
+
+    ##
+    # Abort all hosts that haven't finished (support for --abortOnError)
+    #
+    # Hosts that haven't started yet are simply never started.  For running
+    # hosts, the remote process group is killed (in parallel for all hosts),
+    # so nothing is left running on the remote systems.  Finally, the local
+    # processes are terminated, and we wait (for a while) for the hosts to
+    # finish, so that their log files are closed (and renamed) properly.
+    #
+    # \param[in] Scheduler class
+    # \param[in] List of BuildHost objects (hosts that have finished are ignored)
+    #
+    def AbortHosts(self, scheduler, hosts):
+        cancelled = scheduler.Cancel()
+
+        devnull = open(os.devnull, 'w')
+        killers = []
+        for host in hosts:
+            if not host.finished and host not in cancelled:
+                command = host.GetKillCommand()
+                if command != None:
+                    killers.append(subprocess.Popen(command, stdin=subprocess.PIPE,
+                                                    stdout=devnull, stderr=devnull))
+
+        # Give the remote kills a chance to complete (but don't wait forever)
+        deadline = time.time() + self.ABORT_TIMEOUT
+        for killer in killers:
+            while killer.poll() == None and time.time() < deadline:
+                time.sleep(0.1)
+            if killer.poll() == None:
+                killer.terminate()
+        devnull.close()
+
+        aborted = set()
+        for host in hosts:
+            if not host.finished and host not in cancelled and host.process != None:
+                aborted.add(host)
+                if host.process.poll() == None:
+                    host.process.terminate()
+
+        deadline = time.time() + self.ABORT_TIMEOUT
+        while len(aborted) and time.time() < deadline:
+            (events, ready) = self.events.Wait(max(deadline - time.time(), 0))
+            for (event, host) in events:
+                if event == EVENT_FINISHED:
+                    aborted.discard(host)
+
+    ##
+    # Order the hosts for dispatch
+    #
+    # Hosts are dispatched in tag order, unless setting 'LongestFirst' is set.
+    # In that case, hosts expected to take the longest (based on prior builds)
+    # are dispatched first, so the slowest builds don't start late and stretch
+    # out the run.  Hosts with no history are dispatched before the others,
+    # since they may well be slow.
+    #
+    def OrderHosts(self, hosts):
+        if not self.config.GetSetting('LongestFirst'):
+            return hosts
+
+        unknown = [host for host in hosts if host.expectedDuration == None]
+        known = [host for host in hosts if host.expectedDuration != None]
+
+        return unknown + sorted(known, key=lambda host: host.expectedDuration, reverse=True)
+
+    ##
+    # Format a time (in seconds) for display
+    #
+    def FormatTime(self, seconds):
+        hostHH = int(seconds / 60 / 60)
+        seconds = seconds - (hostHH * 60 * 60)
+        hostMM = int(seconds / 60)
+        hostSS = seconds - (hostMM * 60)
+        if hostHH:
+            return '%02d:%02d:%02d' % (hostHH, hostMM, hostSS)
+        else:
+            return '%02d:%02d' % (hostMM, hostSS)
+
+    ##
+    # Get the estimated time remaining (in seconds) for a running host
+    #
+    # \returns
+    # Time remaining (zero if the host is taking longer than expected), or
+    # None if we have no estimate for the host
+    #
+    def GetRemainingTime(self, host):
+        if host.expectedDuration == None:
+            return None
+
+        return max(host.expectedDuration - (time.time() - host.startTime), 0)
+
+    ##
+    # Get the estimated time remaining (in seconds) for the entire run
+    #
+    # \returns
+    # Time remaining, or None if we have no estimate for some host
+    #
+    def GetRunRemainingTime(self, scheduler, hosts):
+        remaining = {}
+        for host in hosts:
+            if not host.finished and not scheduler.IsPending(host):
+                remaining[host] = self.GetRemainingTime(host)
+
+        return scheduler.EstimateCompletion(remaining)
+
+    ##
+    # Display the activity of a host, along with the estimated time remaining
+    #
+    def DisplayActivity(self, stdscr, host, column, statusLen):
+        etaString = ''
+        remaining = self.GetRemainingTime(host)
+        if remaining != None:
+            etaString = ' ETA %s' % self.FormatTime(remaining)
+
+        textLen = statusLen - 2 - len(etaString)
+        stdscr.addstr(host.display_line, column,
+                      "- %-*.*s%s" % (textLen, textLen, host.sDisplayText, etaString))
 
     ##
     # Perform processing (and screen updates)
@@ -610,6 +1711,7 @@ class Builder:
         #    . "Selector"
         #    . "Command Line" * 2
         #    . "Elapsed Time"
+        #    . "Remaining"
         #    . A "home" line for the cursor
         lastLine = 0
         hostCount = 0
@@ -617,14 +1719,17 @@ class Builder:
             lastLine = max(lastLine, host.display_line)
             hostCount = hostCount + 1
 
-        lastLine += 9
+        lastLine += 10
         if height < lastLine or width < 80:
             return -1
 
         # Indentation locations:
+        # (Widen the tag column if tags are qualified by selector)
         IndentTag = 0
-        IndentHost = 20
-        IndentStatus = 45
+        IndentHost = max([20] + [len(host.label) + 1 for host in hosts])
+        IndentStatus = IndentHost + 25
+        if width < IndentStatus + 20:
+            return -1
         statusLen = width - IndentStatus - 1
 
         # Print the headings on the screen
@@ -632,14 +1737,24 @@ class Builder:
         stdscr.addstr(0, IndentHost, "Host Name", curses.A_UNDERLINE)
         stdscr.addstr(0, IndentStatus, "Status", curses.A_UNDERLINE)
 
-        # Begin processing on each of our hosts
+        # Begin processing on each of our hosts (as the scheduler allows)
+        # (Unreachable hosts are already finished, and are never started)
+        scheduler = Scheduler(self.config, [host for host in hosts if not host.finished])
         lastLine = 0
         for host in hosts:
-            host.start()
-            stdscr.addstr(host.display_line, IndentTag,  host.tag[0:IndentHost-IndentTag-1])
+            stdscr.addstr(host.display_line, IndentTag,  host.label[0:IndentHost-IndentTag-1])
             stdscr.addstr(host.display_line, IndentHost, host.hostname[0:IndentStatus-IndentHost-1])
+            if host.unreachable:
+                stdscr.addstr(host.display_line, IndentStatus, host.completionStatus, curses.A_BOLD)
             lastLine = max(lastLine, host.display_line)
 
+        for host in self.DispatchHosts(scheduler):
+            host.tActivityTime = time.time() - startTime
+
+        for host in hosts:
+            if scheduler.IsPending(host):
+                stdscr.addstr(host.display_line, IndentStatus, "Queued")
+
         lastLine = lastLine + 2
         stdscr.addstr(lastLine, 0, 'Host Count:')
         stdscr.addstr(lastLine, 15, '%d' % hostCount)
@@ -660,88 +1775,101 @@ class Builder:
         lastLine = lastLine + 1
         stdscr.addstr(lastLine, 0, 'Elapsed Time:')
         stdscr.addstr(lastLine, 15, '00:00')
-        stdscr.addstr(lastLine + 1, 0, '')
+        stdscr.addstr(lastLine + 1, 0, 'Remaining:')
+        stdscr.addstr(lastLine + 2, 0, '')
         stdscr.refresh()
 
         # Wait for each of the hosts to complete processing
+        #
+        # We sleep until a host posts an event, a key is pressed, or it's time
+        # to update the elapsed time.  Hosts are only looked at when they have
+        # something to report (other than the occasional check for stalls).
         failCount = 0
-        while True:
-            time.sleep(1)
+        finishedCount = len([host for host in hosts if host.finished])
+        nextStallCheck = 0
+        while finishedCount < len(hosts):
+            (events, ready) = self.events.Wait(1.0 - ((time.time() - startTime) % 1.0),
+                                               [ sys.stdin.fileno() ])
 
             # See if we have some user input
             #   "r":	Refresh screen
 
-            c = stdscr.getch()
-            if c == ord('R') or c == ord('r'):
-                stdscr.clearok(1)
+            if len(ready):
+                c = stdscr.getch()
+                if c == ord('R') or c == ord('r'):
+                    stdscr.clearok(1)
 
             # Come up with a pretty way to display elapsed time
-            currentTime = hostTime = (time.time() - startTime) + 0.5
-            hostHH = int(hostTime / 60 / 60)
-            hostTime = hostTime - (hostHH * 60 * 60)
-            hostMM = int(hostTime / 60)
-            hostSS = hostTime - (hostMM * 60)
-            if hostHH:
-                timeDisplay = '%02d:%02d:%02d' % (hostHH, hostMM, hostSS)
-            else:
-                timeDisplay = '%02d:%02d' % (hostMM, hostSS)
+            currentTime = (time.time() - startTime) + 0.5
+            timeDisplay = self.FormatTime(currentTime)
 
-            # See if we can finish up any threads
-            threadsLeft = False
-            for host in hosts:
-                if not host.finished and not host.isAlive():
-                    host.join()
-                    host.finished = True
-                    if host.process.returncode == 0:
+            for (event, host) in events:
+                if host.finished:
+                    continue
+
+                # Finish up any threads that have completed
+                if event == EVENT_FINISHED:
+                    finishedCount += 1
+                    if self.FinishHost(scheduler, host):
                         host.completionStatus = "Done (%s)" % timeDisplay
                         stdscr.addstr(host.display_line, IndentStatus,
                                       "%-*.*s" % (statusLen, statusLen, host.completionStatus))
                     else:
                         failCount += 1
                         host.completionStatus = "Failed (%s)" % timeDisplay
-                        stdscr.addstr(host.display_line, IndentTag,  host.tag, curses.A_BOLD)
+                        stdscr.addstr(host.display_line, IndentTag,  host.label[0:IndentHost-IndentTag-1], curses.A_BOLD)
                         stdscr.addstr(host.display_line, IndentHost, host.hostname, curses.A_BOLD)
                         stdscr.addstr(host.display_line, IndentStatus,
                                       "%-*.*s" % (statusLen, statusLen, host.completionStatus),
                                       curses.A_BOLD)
 
-                if not host.finished:
-                    threadsLeft = True
+                # Any activity on host?  Update display if requested ...
+                elif event == EVENT_ACTIVITY and host.showProgress:
+                    (activity, activityText, activityLines) = host.GetActivity()
+                    if activity:
+                        host.tActivityTime = currentTime
+                        host.sDisplayText = "%s (%d)" % (activityText, activityLines)
+                        self.DisplayActivity(stdscr, host, IndentStatus, statusLen)
+
+            # Every few seconds, update the estimated time remaining, and check
+            # for hosts with no activity for a long time (indicate that ...)
+            if currentTime >= nextStallCheck:
+                nextStallCheck = currentTime + 5
+                for host in hosts:
+                    if host.showProgress and not host.finished and not scheduler.IsPending(host):
+                        self.DisplayActivity(stdscr, host, IndentStatus, statusLen)
+                        if currentTime > (host.tActivityTime + 30):
+                            stdscr.addstr(host.display_line, IndentStatus, "?")
 
-                    # Any activity on host?  Update display if requested ...
-                    if host.showProgress:
-                        if host.bLogActivity:
-                            host.bLogActivity = False
-                            host.tActivityTime = currentTime
+                remaining = self.GetRunRemainingTime(scheduler, hosts)
+                if remaining != None:
+                    stdscr.addstr(lastLine + 1, 15, "%-*s" % (width - 16, self.FormatTime(remaining)))
+                else:
+                    stdscr.addstr(lastLine + 1, 15, "%-*s" % (width - 16, "unknown"))
 
-                            displayString = "%s (%d)" % (host.sActivityText, host.cLogSubLines)
-                            stdscr.addstr(host.display_line, IndentStatus,
-                                          "- %-*.*s" % (statusLen-2, statusLen-2, displayString))
-                        elif currentTime > (host.tActivityTime + 30):
-                            # No activity for a long time?  Indicate that ...
-                            stdscr.addstr(host.display_line, IndentStatus, "?")
+            # Start any queued hosts that now have a free slot
+            if not self.config.options.abort or failCount == 0:
+                for host in self.DispatchHosts(scheduler):
+                    host.tActivityTime = currentTime
 
             stdscr.addstr(lastLine, 15, timeDisplay)
-            stdscr.addstr(lastLine + 1, 0, '')
+            stdscr.addstr(lastLine + 2, 0, '')
             stdscr.refresh()
 
             # Support --abortOnError behavior
             if self.config.options.abort and failCount != 0:
-                # Mark all remaining hosts as "Aborted"
+                # Mark all remaining hosts as "Aborted" (before killing them,
+                # which may take a while)
                 for host in hosts:
                     if not host.finished:
                         host.completionStatus = "Aborted (%s)" % timeDisplay
                         stdscr.addstr(host.display_line, IndentStatus,
                                       "%-*.*s" % (statusLen, statusLen, host.completionStatus))
-                        host.process.terminate()
                 stdscr.refresh()
 
+                self.AbortHosts(scheduler, hosts)
                 return failCount
 
-            # Check if any threads are left
-            if not threadsLeft:
-                break
-
         # All done
         return failCount
 
@@ -749,34 +1877,31 @@ class Builder:
     # Perform processing (without curses)
     #
     def ProcessUpdatesWithoutCurses(self, hosts):
-        # Begin processing on each of our hosts
-        lastLine = 0
-        for host in hosts:
-            host.start()
-            print "Starting host %s (%s)" % (host.hostname, host.tag)
+        # Begin processing on each of our hosts (as the scheduler allows)
+        # (Unreachable hosts are already finished, and are never started)
+        scheduler = Scheduler(self.config, [host for host in hosts if not host.finished])
+        for host in self.DispatchHosts(scheduler):
+            print "Starting host %s (%s)" % (host.hostname, host.label)
 
         # Wait for each of the hosts to complete processing
+        # (We only care about completions; nothing else to do until then)
         failCount = 0
-        while True:
-            time.sleep(1)
+        finishedCount = len([host for host in hosts if host.finished])
+        while finishedCount < len(hosts):
+            (events, ready) = self.events.Wait()
 
             # See if we can finish up any threads
-            threadsLeft = False
-            for host in hosts:
-                if not host.finished and not host.isAlive():
-                    host.join()
-                    host.finished = True
-                    if host.process.returncode == 0:
-                        print "Completed host %s (%s)" % (host.hostname, host.tag)
+            for (event, host) in events:
+                if event == EVENT_FINISHED and not host.finished:
+                    finishedCount += 1
+                    if self.FinishHost(scheduler, host):
+                        print "Completed host %s (%s)" % (host.hostname, host.label)
                         host.completionStatus = "Done"
                     else:
                         failCount += 1
-                        print "FAILED: Host %s (%s)" % (host.hostname, host.tag)
+                        print "FAILED: Host %s (%s)" % (host.hostname, host.label)
                         host.completionStatus = "Failed"
 
-                if not host.finished:
-                    threadsLeft = True
-
             # Support --abortOnError behavior
             if self.config.options.abort and failCount != 0:
                 print "ABORTING due to failed build and --abortOnError"
@@ -785,13 +1910,13 @@ class Builder:
                 for host in hosts:
                     if not host.finished:
                         host.completionStatus = "Aborted"
-                        host.process.terminate()
 
+                self.AbortHosts(scheduler, hosts)
                 return failCount
 
-            # Check if any threads are left
-            if not threadsLeft:
-                break
+            # Start any queued hosts that now have a free slot
+            for host in self.DispatchHosts(scheduler):
+                print "Starting host %s (%s)" % (host.hostname, host.label)
 
         # All done
         return failCount
@@ -802,35 +1927,81 @@ class Builder:
     def StartBuild(self):
         # Build the host list:
         # Either the one specified at launch, or all of the machines in configuraiton
+        # (Hosts post their progress and completion to our event queue)
+        self.events = EventQueue()
+
+        # Choose how hosts are run: a thread per host, or one event loop for all
+        if self.config.GetSetting('EventLoop'):
+            self.engine = EventLoopEngine(self.events)
+        else:
+            self.engine = ThreadEngine()
+
         hosts = []
         if len(self.config.machineKeys):
             for entry in sorted(self.config.machineKeys):
-                hosts.append( BuildHost(entry, self.config) )
+                hosts.append( BuildHost(entry, self.config, self.events) )
         else:
             for key in sorted(self.config.machines.keys()):
-                hosts.append( BuildHost(key, self.config) )
+                hosts.append( BuildHost(key, self.config, self.events) )
 
         # Figure out where each host will display it's data (sort by tag)
         tags = []
         for host in hosts:
-            tags.append( host.tag )
+            tags.append( host.label )
         tags = sorted(tags)
 
         for host in hosts:
-            host.display_line = tags.index(host.tag) + 2
+            host.display_line = tags.index(host.label) + 2
 
         # Sanity check - each host should have a non-zero display line
         for host in hosts:
             assert host.display_line != 0
 
+        # Resolve the branches to build to commits, so every host builds the
+        # same commits (exits if a branch doesn't exist)
+        if self.config.GetSetting('ResolveBranches'):
+            pins = BranchResolver(self.config).Resolve(set([host.project for host in hosts]))
+            for host in hosts:
+                host.SetPins(pins.get(host.project))
+
         # Move the log files to the prior log file directory
-        self.MoveLogfiles()
+        self.MoveLogfiles(hosts)
+
+        # Estimate how long each host will take (from prior builds), and
+        # decide which hosts to start first (matters if concurrency is limited)
+        self.history = BuildHistory(self.config)
+        for host in hosts:
+            host.expectedDuration = self.history.GetExpectedDuration(host.tag, host.project)
+
+        hosts = self.OrderHosts(hosts)
+
+        # Skip hosts that aren't reachable (they count as failures)
+        unreachable = []
+        if self.config.GetSetting('ProbeHosts'):
+            unreachable = self.ProbeHosts(hosts)
+
+        # Open shared SSH connections to the (reachable) hosts, if not already
+        # open
+        for transport in self.config.GetTransports():
+            transport.Connect([host.hostname for host in hosts if host.transport == transport and not host.finished])
+
+        # Ship git objects from the local clones to the hosts
+        if self.config.options.bundle:
+            BundleShipper(self.config).Ship([host for host in hosts if not host.finished])
+
+        # Collect build artifacts from each host once its build completes
+        collector = None
+        if self.config.HasCollectPaths():
+            collector = ArtifactCollector(self.config)
+            for host in hosts:
+                host.collector = collector
 
         #
         # Go perform the build (and update the screen with progress)
         #
 
         failCount = 0
+        startTime = time.time()
         if not self.config.options.nocurses:
             failCount = curses.wrapper(self.ProcessUpdates, hosts)
             if failCount == -1:
@@ -840,6 +2011,17 @@ class Builder:
             failCount = self.ProcessUpdatesWithoutCurses(hosts)
             print
 
+        failCount += len(unreachable)
+
+        self.engine.Shutdown()
+        self.history.Close()
+        for transport in self.config.GetTransports():
+            transport.Close()
+
+        # Write the stage timing report
+        report = StageReport(self.config, hosts, startTime)
+        report.Write()
+
         # Print final completion status if configured
 
         if self.config.GetSetting('SummaryScreen'):
@@ -848,11 +2030,30 @@ class Builder:
             # We really prefer to list sorted by tags, so do so
             hosts_byTag = {}
             for host in hosts:
-                hosts_byTag[host.tag] = host
+                hosts_byTag[host.label] = host
             for key in sorted(hosts_byTag.keys()):
-                print "%-19s %-25s %s" % (hosts_byTag[key].tag, hosts_byTag[key].hostname, hosts_byTag[key].completionStatus)
+                host = hosts_byTag[key]
+                if host.latency != None:
+                    latency = '%.2fs' % host.latency
+                    if host.latency > self.PROBE_SLOW:
+                        latency += ' (slow)'
+                    print "%-19s %-25s %-20s %s" % (host.label, host.hostname, host.completionStatus, latency)
+                else:
+                    print "%-19s %-25s %s" % (host.label, host.hostname, host.completionStatus)
+
+                # For failed builds, show the first error in the log
+                if host.completionStatus.startswith('Failed') and host.logIndex != None:
+                    error = host.logIndex.GetFirstError()
+                    if error != None:
+                        print "%-19s First error (line %d, %s): %s" \
+                            % ('', error['line'], error['stage'], error['text'][:80])
             print
 
+            report.PrintTable()
+
+        if collector != None:
+            collector.PrintSummary()
+
         # All done
 
         return failCount
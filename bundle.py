@@ -0,0 +1,358 @@
+# coding: utf-8
+#
+# Copyright (c) Microsoft Corporation.  All rights reserved.
+#
+##
+# Module containing support for shipping git objects to the hosts (--bundle)
+#
+# Normally, each host fetches the project (and its submodules) from GitHub.
+# With --bundle, pbuild instead ships the objects from the developer's local
+# clone of the project (configured with 'local_clone : <project> : <path>'):
+#
+#   1. Each host is asked (concurrently) which commits its repositories have,
+#   2. For each repository (project and submodules), one git bundle is made
+#      from the local clone, holding only the commits that the hosts lack,
+#   3. The bundles are uploaded to the hosts (concurrently), and the command
+#      script fetches from them rather than from GitHub.
+#
+# The bundles carry the local clone's 'origin' branches (as last fetched by
+# the developer), and the local branches named by --branch or --subproject
+# (so unpushed local branches can be built).  If anything goes wrong, the
+# host simply fetches from GitHub.
+#
+
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+##
+# BundleShipper class - makes git bundles from local clones, and uploads them
+#
+class BundleShipper:
+    # Time (in seconds) to wait for hosts to report the commits they have
+    QUERY_TIMEOUT = 60
+
+    # Time (in seconds) to wait for the bundles to be uploaded
+    UPLOAD_TIMEOUT = 600
+
+    # Maximum number of uploads to run at once
+    UPLOAD_LIMIT = 16
+
+    # Reference (on the hosts) to the commit checked out in the local clone
+    HEAD_REF = 'refs/pbuild/head'
+
+    ##
+    # Ctor.
+    # \param[in] Configuration class (for pbuild configuration)
+    #
+    def __init__(self, config):
+        self.config = config
+        self.bundleDir = None
+
+    ##
+    # Run a git command in a local repository
+    #
+    # \returns
+    # Output of the command (or None if the command failed)
+    #
+    def RunGit(self, directory, arguments, input=None):
+        try:
+            process = subprocess.Popen([ 'git' ] + arguments, cwd=directory,
+                                       stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            (output, errors) = process.communicate(input)
+        except OSError:
+            return None
+
+        if process.returncode != 0:
+            return None
+
+        return output
+
+    ##
+    # Get the repositories (project and submodules, recursively) of a local
+    # clone
+    #
+    # \returns
+    # List of directories, relative to the local clone ('.' for the project)
+    #
+    def GetRepositories(self, localClone):
+        output = self.RunGit(localClone, [ 'submodule', '--quiet', 'foreach', '--recursive',
+                                           'echo "$toplevel/$path"' ])
+        top = self.RunGit(localClone, [ 'rev-parse', '--show-toplevel' ])
+        if output == None or top == None:
+            return [ '.' ]
+
+        return [ '.' ] + [ os.path.relpath(line, top.strip()) for line in output.splitlines() ]
+
+    ##
+    # Get the branch (if any) that will be built in a repository, as specified
+    # with --branch (project) or --subproject (submodules)
+    #
+    def GetBranch(self, host, repository):
+        if repository == '.':
+            return self.config.options.branch
+
+        if self.config.options.subproject:
+            for subproject in self.config.options.subproject.split(','):
+                (subprojectDir, subprojectBranch) = subproject.split(':')
+                if os.path.normpath(subprojectDir) == repository:
+                    return subprojectBranch
+
+        return None
+
+    ##
+    # Ask the hosts (concurrently) which commits their repositories have
+    #
+    # \returns
+    # Dictionary (by host) of dictionaries (by repository) of dictionaries
+    # (by reference) of commits.  Hosts that didn't answer are omitted.
+    #
+    def QueryHosts(self, hosts):
+        # List the references of each repository, by absolute path
+        refs = 'refs/remotes/origin refs/pbuild'
+        command = 'cd %s 2> /dev/null || exit 0; ' \
+                  'echo "root - `git rev-parse --show-toplevel`"; ' \
+                  'git for-each-ref --format="%%(objectname) %%(refname) `git rev-parse --show-toplevel`" %s; ' \
+                  'git submodule --quiet foreach --recursive \'git for-each-ref --format="%%(objectname) %%(refname) $toplevel/$path" %s\''
+
+        devnull = open(os.devnull, 'r+')
+        queries = {}
+        for host in hosts:
+            output = tempfile.TemporaryFile()
+            process = subprocess.Popen(
+                host.transport.GetCommand(host.hostname, [ '-o', 'BatchMode=yes' ], command % (host.path, refs, refs)),
+                stdin=devnull,
+                stdout=output,
+                stderr=devnull
+                )
+            queries[host] = (output, process)
+        devnull.close()
+
+        deadline = time.time() + self.QUERY_TIMEOUT
+        while time.time() < deadline and None in [ process.poll() for (output, process) in queries.values() ]:
+            time.sleep(0.05)
+
+        commits = {}
+        for host in hosts:
+            (output, process) = queries[host]
+            if process.poll() == None:
+                process.kill()
+                process.wait()
+
+            if process.returncode == 0:
+                commits[host] = {}
+                output.seek(0)
+                root = None
+                for line in output.read().splitlines():
+                    fields = line.split(' ', 2)
+                    if len(fields) != 3:
+                        continue
+                    (sha, ref, path) = fields
+                    if sha == 'root':
+                        root = path
+                    elif root != None:
+                        repository = os.path.relpath(path, root)
+                        commits[host].setdefault(repository, {})[ref] = sha
+
+            output.close()
+
+        return commits
+
+    ##
+    # Get the references to ship for a repository
+    #
+    # \returns
+    # List of (reference, reference on the hosts, commit) tuples
+    #
+    def GetRefs(self, directory, branch):
+        output = self.RunGit(directory, [ 'for-each-ref', '--format=%(objectname) %(refname)', 'refs/remotes/origin' ])
+        if output == None:
+            return []
+
+        refs = []
+        for line in output.splitlines():
+            (sha, ref) = line.split(' ', 1)
+            if ref != 'refs/remotes/origin/HEAD':
+                refs.append((ref, ref, sha))
+
+        # A local branch that we're building wins over the origin branch
+        if branch:
+            sha = self.RunGit(directory, [ 'rev-parse', '--verify', '-q', 'refs/heads/%s^{commit}' % branch ])
+            if sha != None:
+                refs = [ (ref, destination, commit) for (ref, destination, commit) in refs
+                         if destination != 'refs/remotes/origin/' + branch ]
+                refs.append(('refs/heads/' + branch, 'refs/remotes/origin/' + branch, sha.strip()))
+
+        sha = self.RunGit(directory, [ 'rev-parse', '--verify', '-q', 'HEAD^{commit}' ])
+        if sha != None:
+            refs.append(('HEAD', self.HEAD_REF, sha.strip()))
+
+        return refs
+
+    ##
+    # Make the bundle for a repository of a local clone
+    #
+    # \param[in] Directory of the repository
+    # \param[in] List of (reference, reference on the hosts, commit) tuples to ship
+    # \param[in] Set of commits that every host has
+    # \param[in] Bundle file name
+    #
+    # \returns
+    # True if the bundle was made
+    #
+    def MakeBundle(self, directory, refs, common, filename):
+        # We can only exclude commits that we have ourselves
+        output = self.RunGit(directory, [ 'cat-file', '--batch-check' ], ''.join([ sha + '\n' for sha in common ]))
+        if output == None:
+            return False
+        known = [ line.split()[0] for line in output.splitlines() if line.split()[1] == 'commit' ]
+
+        # A commit that we're shipping as-is would leave the bundle empty (and
+        # the reference wouldn't be updated), so just exclude its parents
+        shipping = [ sha for (ref, destination, sha) in refs ]
+        exclude = []
+        for sha in known:
+            if sha in shipping:
+                exclude.append(sha + '^@')
+            else:
+                exclude.append(sha)
+
+        return self.RunGit(directory, [ 'bundle', 'create', filename ]
+                           + [ ref for (ref, destination, sha) in refs ]
+                           + [ '--not' ] + exclude) != None
+
+    ##
+    # Upload files to the hosts (concurrently, but no more than UPLOAD_LIMIT
+    # at a time)
+    #
+    # \param[in] List of (host, local file name, remote file name) tuples
+    #
+    # \returns
+    # Set of hosts that had an upload fail
+    #
+    def Upload(self, uploads):
+        devnull = open(os.devnull, 'r+')
+        pending = list(uploads)
+        running = []
+        failed = set()
+
+        deadline = time.time() + self.UPLOAD_TIMEOUT
+        while len(pending) or len(running):
+            while len(pending) and len(running) < self.UPLOAD_LIMIT:
+                (host, source, destination) = pending.pop(0)
+                running.append((host, subprocess.Popen(
+                            host.transport.GetCopyCommand(host.hostname, source, destination),
+                            stdin=devnull,
+                            stdout=devnull,
+                            stderr=devnull
+                            )))
+
+            for (host, process) in list(running):
+                if process.poll() == None and time.time() >= deadline:
+                    process.kill()
+                    process.wait()
+
+                if process.poll() != None:
+                    running.remove((host, process))
+                    if process.returncode != 0:
+                        failed.add(host)
+
+            time.sleep(0.05)
+
+        devnull.close()
+        return failed
+
+    ##
+    # Make and upload the bundles for a list of hosts.  Each host is told the
+    # bundles it should fetch from (see BuildHost.SetBundles); hosts without
+    # a local clone (or that we couldn't upload to) fetch from GitHub.
+    #
+    def Ship(self, hosts):
+        projects = sorted(set([ host.project for host in hosts ]))
+        for project in projects:
+            if self.config.GetLocalClone(project) == '':
+                print "WARNING: No local clone configured for project %s, fetching from GitHub" % project
+
+        hosts = [ host for host in hosts if self.config.GetLocalClone(host.project) != '' ]
+        if len(hosts) == 0:
+            return
+
+        print "Querying %d hosts for git objects ..." % len(hosts)
+        commits = self.QueryHosts(hosts)
+
+        self.bundleDir = tempfile.mkdtemp(prefix='pbuild')
+        try:
+            uploads = []
+            bundles = dict([ (host, []) for host in hosts ])
+            for project in projects:
+                localClone = self.config.GetLocalClone(project)
+                projectHosts = [ host for host in hosts if host.project == project ]
+
+                for repository in self.GetRepositories(localClone):
+                    self.ShipRepository(os.path.join(localClone, repository), repository,
+                                        projectHosts, commits, bundles, uploads)
+
+            size = sum([ os.path.getsize(os.path.join(self.bundleDir, name)) for name in os.listdir(self.bundleDir) ])
+            print "Uploading %d git bundles (%d KB) ..." % (len(uploads), (size + 1023) / 1024)
+            failed = self.Upload(uploads)
+
+            for host in hosts:
+                if host in failed:
+                    print "WARNING: Unable to upload git bundles to host %s, fetching from GitHub" % host.hostname
+                    host.SetBundles(None)
+                else:
+                    host.SetBundles(bundles[host])
+        finally:
+            shutil.rmtree(self.bundleDir, True)
+            self.bundleDir = None
+
+    ##
+    # Make the bundles for one repository of a local clone, and queue them
+    # for upload
+    #
+    # \param[in] Directory of the repository
+    # \param[in] Directory of the repository, relative to the local clone
+    # \param[in] List of hosts building the project
+    # \param[in] Commits on each host (from QueryHosts)
+    # \param[in,out] Dictionary (by host) of lists of bundles for each host
+    # \param[in,out] List of uploads to perform
+    #
+    def ShipRepository(self, directory, repository, hosts, commits, bundles, uploads):
+        # Commits that every host (that has the repository) has
+        common = None
+        for host in hosts:
+            if host in commits and repository in commits[host]:
+                if common == None:
+                    common = set(commits[host][repository].values())
+                else:
+                    common &= set(commits[host][repository].values())
+
+        # Hosts building different branches need different bundles
+        made = {}
+        for host in hosts:
+            branch = self.GetBranch(host, repository)
+            refs = self.GetRefs(directory, branch)
+            if len(refs) == 0:
+                continue
+
+            # Nothing to ship if the host is already up to date
+            if host in commits and repository in commits[host]:
+                hostRefs = commits[host][repository]
+                if len([ sha for (ref, destination, sha) in refs if hostRefs.get(destination) != sha ]) == 0:
+                    continue
+
+            if branch not in made:
+                filename = os.path.join(self.bundleDir, '%d.bundle' % len(os.listdir(self.bundleDir)))
+                if self.MakeBundle(directory, refs, common or set(), filename):
+                    made[branch] = filename
+                else:
+                    print "WARNING: Unable to make git bundle from %s" % directory
+                    made[branch] = None
+
+            if made[branch] != None:
+                remoteName = host.GetBundleName(len(bundles[host]))
+                bundles[host].append((repository, remoteName,
+                                      [ '+%s:%s' % (ref, destination) for (ref, destination, sha) in refs ]))
+                uploads.append((host, made[branch], remoteName))
@@ -0,0 +1,204 @@
+# coding: utf-8
+#
+# Copyright (c) Microsoft Corporation.  All rights reserved.
+#
+##
+# Module containing support for collecting build artifacts from the hosts
+#
+# Build products (like packages) and failure evidence (like config.log, test
+# output, or core files) are left on each host.  With 'collect' (and
+# 'collect_failure') entries in the configuration file, each host, once its
+# build completes, streams a compressed tar archive of those paths back to
+# this system:
+#
+#   collect : <project> : <paths>           Collected after every build
+#   collect_failure : <project> : <paths>   Collected after failed builds
+#
+# Paths are relative to the host's directory for the project, and may contain
+# shell wildcards.  Archives are written to a new directory for each run
+# ('pbuild_collect/<date>-<time>' in the log directory), one per host.  All
+# hosts collect concurrently, but share the bandwidth set with
+# 'collect_bandwidth' (in KB per second; zero means no limit).
+#
+
+import os
+import subprocess
+import threading
+import time
+
+##
+# RateLimiter class - limits the combined rate of several (threaded) streams
+#
+# Each chunk of data reserves the next slot of time on a shared clock; a
+# stream waits until its slot comes up.
+#
+class RateLimiter:
+    # Time (in seconds) that streams may run ahead of the limit (to absorb
+    # the jitter of waking up)
+    BURST_TIME = 0.5
+
+    ##
+    # Ctor.
+    # \param[in] Limit (in bytes per second; zero means no limit)
+    #
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.clock = time.time()
+
+    ##
+    # Account for data transferred, waiting as needed to stay within the limit
+    # (may be called from any thread)
+    #
+    # \param[in] Number of bytes transferred
+    #
+    def Consume(self, count):
+        if self.rate == 0:
+            return
+
+        self.lock.acquire()
+        try:
+            now = time.time()
+            self.clock = max(self.clock, now - self.BURST_TIME) + float(count) / self.rate
+            delay = self.clock - now - self.BURST_TIME
+        finally:
+            self.lock.release()
+
+        if delay > 0:
+            time.sleep(delay)
+
+##
+# ArtifactCollector class - collects archives of build artifacts from hosts
+#
+class ArtifactCollector:
+    # Size of each read from a host
+    CHUNK_SIZE = 65536
+
+    ##
+    # Ctor.
+    # \param[in] Configuration class (for pbuild configuration)
+    #
+    def __init__(self, config):
+        self.config = config
+        self.limiter = RateLimiter(config.GetCollectBandwidth() * 1024)
+        self.directory = os.path.join(config.GetLogfilePrefix() + 'pbuild_collect',
+                                      time.strftime('%Y%m%d-%H%M%S'))
+
+        # Archives written (by host label); failures are noted as None (with
+        # the reason in failures)
+        self.lock = threading.Lock()
+        self.archives = {}
+        self.failures = {}
+
+    ##
+    # Get the command to archive a list of paths on a host
+    #
+    # Old hosts may lack gzip (or a tar that can compress), so compression is
+    # done with gzip when we can; the archive is named to match what we got.
+    # Old shells lack 'pipefail', so the exit status of tar (and gzip, should
+    # it fail) is passed out of the pipeline on file descriptor 4.
+    #
+    def GetArchiveCommand(self, path, paths):
+        return 'cd %s || exit 1; ' \
+               'FILES=`ls -d %s 2> /dev/null`; ' \
+               '[ -z "$FILES" ] && exit 0; ' \
+               'if type gzip > /dev/null 2>&1; then ' \
+               'exec 3>&1; ' \
+               'STATUS=`( ( tar cf - $FILES; echo $? >&4 ) | gzip -c >&3 || echo 1 >&4 ) 4>&1`; ' \
+               'exec 3>&-; ' \
+               'for S in $STATUS; do [ $S -eq 0 ] || exit $S; done; exit 0; ' \
+               'else tar cf - $FILES; fi' \
+               % (path, ' '.join(paths))
+
+    ##
+    # Collect the artifacts from a host whose build has completed (called from
+    # the host's thread, or a thread started by the event loop engine)
+    #
+    # \param[in] BuildHost object
+    # \param[in] True if the build failed
+    #
+    def Collect(self, host, failed):
+        paths = self.config.GetCollectPaths(host.project, failed)
+        if len(paths) == 0:
+            return
+
+        self.lock.acquire()
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+        finally:
+            self.lock.release()
+
+        basename = os.path.join(self.directory, '%s%s' % (host.tag, host.selectSpec))
+        partial = basename + '.partial'
+
+        devnull = open(os.devnull, 'r+')
+        process = subprocess.Popen(
+            host.transport.GetCommand(host.hostname, [], self.GetArchiveCommand(host.path, paths)),
+            stdin=devnull,
+            stdout=subprocess.PIPE,
+            stderr=devnull,
+            preexec_fn=host.transport.GetPreexecFunction()
+            )
+        devnull.close()
+
+        outf = open(partial, 'wb')
+        header = ''
+        size = 0
+        try:
+            while True:
+                data = os.read(process.stdout.fileno(), self.CHUNK_SIZE)
+                if data == '':
+                    break
+
+                if len(header) < 2:
+                    header += data[:2]
+                outf.write(data)
+                size += len(data)
+                self.limiter.Consume(len(data))
+        finally:
+            outf.close()
+            process.stdout.close()
+            process.wait()
+
+        # If tar (or the connection) failed, the archive is incomplete: we
+        # leave it with its partial name
+        failure = None
+        if process.returncode != 0:
+            archive = None
+            if size == 0:
+                os.remove(partial)
+                failure = 'exit status %d' % process.returncode
+            else:
+                failure = 'exit status %d, incomplete archive left in %s' % (process.returncode, partial)
+        elif size == 0:
+            # Nothing matched: no archive
+            os.remove(partial)
+            archive = None
+        else:
+            if header.startswith('\x1f\x8b'):
+                archive = basename + '.tar.gz'
+            else:
+                archive = basename + '.tar'
+            os.rename(partial, archive)
+
+        self.lock.acquire()
+        try:
+            self.archives[host.label] = archive
+            if failure != None:
+                self.failures[host.label] = failure
+        finally:
+            self.lock.release()
+
+    ##
+    # Print where the archives were written (with the final status)
+    #
+    def PrintSummary(self):
+        if len(self.archives) == 0:
+            return
+
+        for label in sorted(self.failures.keys()):
+            print "WARNING: Unable to collect artifacts from host %s (%s)" % (label, self.failures[label])
+
+        written = len([ archive for archive in self.archives.values() if archive != None ])
+        print "Artifacts collected from %d of %d hosts into %s\n" % (written, len(self.archives), self.directory)
@@ -8,11 +8,17 @@
 # Date:   2008-11-14
 #
 
+import json
 import os
-import stat
 from project import *
+import re
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+from transport import LocalTransport
+from transport import SSHTransport
 
 ##
 # Class containing machine defitions
@@ -23,11 +29,14 @@ class MachineItem:
     # \param[in] Host key
     # \param[in] Machine address
     # \param[in] Destination path
-    def __init__(self, tag, host, path, project):
+    # \param[in] Project
+    # \param[in] Selector
+    def __init__(self, tag, host, path, project, select=""):
         self.tag = tag
         self.host = host
         self.path = path
         self.project = project
+        self.select = select
 
     ##
     # Return the tag name associated with an entry
@@ -53,11 +62,34 @@ class MachineItem:
     def GetProject(self):
         return self.project
 
+    ##
+    # Return the selector associated with an entry
+    #
+    def GetSelect(self):
+        return self.select
+
 
 ##
 # Class containing generic logic for loading and handling configuration file
 #
 class Configuration:
+    # Host verification (InitializeSSH): number of hosts verified at once,
+    # and time (in seconds) to allow for each host
+    VERIFY_WORKERS = 16
+    VERIFY_TIMEOUT = 60
+
+    # SSH errors that verifying a host interactively (where SSH can prompt to
+    # accept a new host key, or for a password) may get past
+    VERIFY_PROMPT_ERRORS = re.compile(r'Host key verification failed|Permission denied|No more authentication methods')
+
+    # Command run on each host to verify it (and to add github.com to the
+    # host's known_hosts file)
+    VERIFY_COMMAND = 'grep github.com, ~/.ssh/known_hosts > /dev/null 2> /dev/null || ssh -o StrictHostKeyChecking=no -o HashKnownHosts=no -T git@github.com; grep github.com, ~/.ssh/known_hosts > /dev/null 2> /dev/null || ssh -o StrictHostKeyChecking=no -T git@github.com'
+
+    # Version of the host verification; if the verification changes, bump
+    # this so that all hosts are verified again
+    VERIFY_VERSION = 1
+
     ##
     # Ctor.
     # \param[in] configuration Configuration map.
@@ -74,6 +106,20 @@ class Configuration:
         self.test_attr = ''
         self.test_list = ''
         self.configure_options = {}
+        self.make_target = {}
+        self.local_clone = {}
+        self.collect = {}
+        self.collectFailure = {}
+        self.collectBandwidth = 0
+        self.maxParallel = 0
+        self.hostSlots = {}
+        self.hostTransport = {}
+        self.verifyExpiry = 0
+        self.configureCacheSize = 1024
+        self.cloneDepth = {}
+        self.cloneFilter = {}
+        self.cloneReference = {}
+        self.makeJobs = {}
 
         if self.options.select != None:
             self.select = self.options.select
@@ -85,8 +131,8 @@ class Configuration:
         #   1. Configuration file
         #   2. Command line option
 
-        self.validSettings = [ 'checkvalidity', 'debug', 'deletelogfiles', 'diagnoseerrors', 'logfilerename', 'logfileselect', 'progress', 'summaryscreen' ]
-        self.ParseSettings('defaults', 'CheckValidity,Debug,DeleteLogfiles,NoDiagnoseErrors,NoLogfileRename,NoLogfileSelect,Progress,SummaryScreen')
+        self.validSettings = [ 'checkvalidity', 'compresslogfiles', 'configurecache', 'debug', 'deletelogfiles', 'diagnoseerrors', 'eventloop', 'logfilerename', 'logfileselect', 'longestfirst', 'probehosts', 'progress', 'resolvebranches', 'sshmultiplex', 'streamscript', 'summaryscreen' ]
+        self.ParseSettings('defaults', 'CheckValidity,NoCompressLogfiles,NoConfigureCache,Debug,DeleteLogfiles,NoDiagnoseErrors,NoEventLoop,NoLogfileRename,NoLogfileSelect,LongestFirst,ProbeHosts,Progress,ResolveBranches,SSHMultiplex,StreamScript,SummaryScreen')
 
         # Default location for PBUILD logfiles (include trailing "/" in path)
         self.logfilePrefix = os.path.join(os.path.expanduser('~'), '')
@@ -109,6 +155,13 @@ class Configuration:
     def GetSelectSpecification(self):
         return self.select.lower()
 
+    ##
+    # Get the list of selectors to build.  Several selectors may be built in
+    # one run by separating them with commas (i.e. "om,oms,docker").
+    #
+    def GetSelectList(self):
+        return [ entry.strip() for entry in self.GetSelectSpecification().split(',') if entry.strip() != '' ]
+
     ##
     # Get the configuration filename.  Controlled by environment variable
     # 'PBUILD', defaults to '~./pbuild'.
@@ -135,6 +188,136 @@ class Configuration:
     def GetLogfilePriorPrefix(self):
         return self.logfilePriorPrefix
 
+    ##
+    # Get the transport used to run commands on a host (by host name, not tag)
+    #
+    def GetTransport(self, hostname):
+        return self.transports[self.GetTransportName(hostname)]
+
+    ##
+    # Get the name of the transport used to run commands on a host
+    #
+    def GetTransportName(self, hostname):
+        return self.hostTransport.get(hostname, 'ssh')
+
+    ##
+    # Get all of the transports
+    #
+    def GetTransports(self):
+        return self.transports.values()
+
+    ##
+    # Get the maximum number of hosts to build concurrently (zero means no limit)
+    #
+    def GetMaxParallel(self):
+        return self.maxParallel
+
+    ##
+    # Get the number of concurrent builds allowed on a physical host (zero
+    # means no limit).  This is keyed on the host name, not the tag.
+    #
+    # By default, a physical host builds one thing at a time.  This only
+    # matters when several selectors are built at once (otherwise each host
+    # only appears once).
+    #
+    def GetHostSlots(self, hostname):
+        if hostname in self.hostSlots:
+            return self.hostSlots[hostname]
+
+        return 1
+
+    ##
+    # Get a setting for a host building a project, for settings that may be
+    # keyed on the host name (not the tag) or on the project.  A setting for
+    # the host wins over a setting for the project.
+    #
+    def GetHostOrProjectSetting(self, settings, hostname, project, default):
+        if hostname in settings:
+            return settings[hostname]
+        if project in settings:
+            return settings[project]
+
+        return default
+
+    ##
+    # Get the depth of new clones (zero means a full clone)
+    #
+    def GetCloneDepth(self, hostname, project):
+        return self.GetHostOrProjectSetting(self.cloneDepth, hostname, project, 0)
+
+    ##
+    # Get the filter for new (partial) clones (or empty string for none)
+    #
+    def GetCloneFilter(self, hostname, project):
+        return self.GetHostOrProjectSetting(self.cloneFilter, hostname, project, '')
+
+    ##
+    # Get the path (on the build host) of the reference repository used for
+    # new clones (or empty string for none)
+    #
+    def GetCloneReference(self, hostname, project):
+        return self.GetHostOrProjectSetting(self.cloneReference, hostname, project, '')
+
+    ##
+    # Get the number of concurrent make jobs (zero means to choose based on
+    # the CPUs and memory of the host)
+    #
+    def GetMakeJobs(self, hostname, project):
+        return self.GetHostOrProjectSetting(self.makeJobs, hostname, project, 0)
+
+    ##
+    # Get the size limit (in MB) of the configure cache on each host (zero
+    # means no limit)
+    #
+    def GetConfigureCacheSize(self):
+        return self.configureCacheSize
+
+    ##
+    # Get the make target for a project (or empty string if not configured)
+    #
+    def GetMakeTarget(self, project):
+        if project in self.make_target:
+            return self.make_target[project]
+
+        return ''
+
+    ##
+    # Get the path to the local clone of a project (or empty string if not
+    # configured); used with --bundle
+    #
+    def GetLocalClone(self, project):
+        if project in self.local_clone:
+            return self.local_clone[project]
+
+        return ''
+
+    ##
+    # Get the paths to collect from the hosts building a project (see
+    # ArtifactCollector)
+    #
+    # \param[in] Project name
+    # \param[in] True if the build failed (to include 'collect_failure' paths)
+    #
+    def GetCollectPaths(self, project, failed):
+        paths = list(self.collect.get(project, []))
+        if failed:
+            paths += self.collectFailure.get(project, [])
+
+        return paths
+
+    ##
+    # Determine if any paths are to be collected from the hosts
+    #
+    def HasCollectPaths(self):
+        return len(self.collect) != 0 or len(self.collectFailure) != 0
+
+    ##
+    # Get the limit (in KB per second) on the bandwidth used to collect
+    # artifacts from all hosts (zero means no limit)
+    #
+    def GetCollectBandwidth(self):
+        return self.collectBandwidth
+
     ##
     # Get a settings value
     # \throw if setting is not valid
@@ -157,6 +340,21 @@ class Configuration:
     def GetTestList(self):
         return self.test_list
 
+    ##
+    # Parse a count (non-negative integer) from the configuration file or the
+    # command line
+    #
+    def ParseCount(self, source, keyword, value):
+        try:
+            count = int(value)
+            if count >= 0:
+                return count
+        except ValueError:
+            pass
+
+        sys.stderr.write('Invalid value for %s found in %s: %s\n' % (keyword, source, value))
+        sys.exit(-1)
+
     ##
     # Parse a settings string and set the appropriate settings
     #
@@ -217,7 +415,7 @@ class Configuration:
                 raise IOError('Bad project in configuration file - offending line: \'' + line.rstrip() + '\'')
 
             # No match for this selector?  Just skip the host entry ...
-            if entrySelect.lower() != self.GetSelectSpecification():
+            if entrySelect.lower() not in self.GetSelectList():
                 # But first: Add this machine to the list of machines for all selectors
                 select_key = "%s<>select_sep<>%s" % (entrySelect, entryTag)
 
@@ -234,11 +432,16 @@ class Configuration:
         else:
             raise IOError('Bad configuration file - offending line: \'' + line.rstrip() + '\'')
 
-        if entryTag in taglist:
+        # Tags and hosts must be unique within a selector (but the same host
+        # may appear under several selectors if we're building several)
+        machine_key = "%s<>select_sep<>%s" % (entrySelect.lower(), entryTag)
+        host_key = "%s<>select_sep<>%s" % (entrySelect.lower(), entryHost)
+
+        if machine_key in taglist:
             sys.stderr.write('Duplicate key "%s" found in configuration\n' % entryTag)
             sys.exit(-1)
 
-        if entryHost in hostlist:
+        if host_key in hostlist:
             sys.stderr.write('Duplicate host "%s" found in configuration\n' % entryHost)
             sys.exit(-1)
 
@@ -254,9 +457,9 @@ class Configuration:
         self.machines_allselects[select_key] = MachineItem(entryTag, entryHost, entryDirPath, "")
 
         # Add to list of machines to process (selector-specific)
-        taglist.append(entryTag)
-        hostlist.append(entryHost)
-        self.machines[entryHost] = MachineItem(entryTag, entryHost, entryDirPath, entryProject)
+        taglist.append(machine_key)
+        hostlist.append(host_key)
+        self.machines[machine_key] = MachineItem(entryTag, entryHost, entryDirPath, entryProject, entrySelect.lower())
 
     ##
     # Parse a test attribute string and set the appropriate settings
@@ -273,6 +476,17 @@ class Configuration:
             sys.stderr.write('Invalid test attribute found in %s: %s\n' % (source, attributes))
             sys.exit(-1)
 
+    ##
+    # Get the key for an option that may be keyed on project or host name
+    # (project names are case insensitive, host names are taken as is)
+    #
+    def GetHostOrProjectKey(self, key):
+        key = key.strip()
+        if self.VerifyProjectName(key.lower()):
+            return key.lower()
+
+        return key
+
     ##
     # Read and parse the configuration file
     #
@@ -330,6 +544,22 @@ class Configuration:
                         else:
                             self.options.nodebug = True
 
+                # Allow "max_parallel:" to limit the number of hosts built concurrently
+                elif len(elements) == 2 and elements[0].strip().lower() == "max_parallel":
+                    self.maxParallel = self.ParseCount("configuration file", "max_parallel", elements[1].strip())
+
+                # Allow "verify_expiry:" to verify hosts again after some number of days
+                elif len(elements) == 2 and elements[0].strip().lower() == "verify_expiry":
+                    self.verifyExpiry = self.ParseCount("configuration file", "verify_expiry", elements[1].strip())
+
+                # Allow "configure_cache_size:" to limit the size of the configure cache
+                elif len(elements) == 2 and elements[0].strip().lower() == "configure_cache_size":
+                    self.configureCacheSize = self.ParseCount("configuration file", "configure_cache_size", elements[1].strip())
+
+                # Allow "collect_bandwidth:" to limit the bandwidth used to collect artifacts
+                elif len(elements) == 2 and elements[0].strip().lower() == "collect_bandwidth":
+                    self.collectBandwidth = self.ParseCount("configuration file", "collect_bandwidth", elements[1].strip())
+
                 # Allow "test_attributes:" to specify the test attributes to use
                 elif len(elements) == 2 and elements[0].strip().lower() == "test_attributes":
                     self.ParseTestAttributes("configuration file", elements[1].strip())
@@ -349,9 +579,8 @@ class Configuration:
                     if not self.VerifyProjectName(elements[1]):
                         raise IOError('Bad project name in configuration file - offending line: \'' + line.rstrip() + '\'')
 
-                    # If target wasn't overridden on command line, replace it with value from configuration file
-                    if self.options.target == "target_default":
-                        self.options.target = elements[2]
+                    # Used if target wasn't overridden on command line
+                    self.make_target[elements[1]] = elements[2].strip()
 
                 elif len(elements) == 3 and elements[0].strip().lower() == "configure_options":
                     # Validate the project name
@@ -361,6 +590,60 @@ class Configuration:
 
                     self.configure_options[elements[1]] = elements[2]
 
+                elif len(elements) == 3 and elements[0].strip().lower() == "local_clone":
+                    # Validate the project name
+                    elements[1] = elements[1].strip().lower()
+                    if not self.VerifyProjectName(elements[1]):
+                        raise IOError('Bad project name in configuration file - offending line: \'' + line.rstrip() + '\'')
+
+                    self.local_clone[elements[1]] = os.path.expanduser(elements[2].strip())
+
+                elif len(elements) == 3 and elements[0].strip().lower() in [ "collect", "collect_failure" ]:
+                    # Validate the project name
+                    elements[1] = elements[1].strip().lower()
+                    if not self.VerifyProjectName(elements[1]):
+                        raise IOError('Bad project name in configuration file - offending line: \'' + line.rstrip() + '\'')
+
+                    # Paths may be separated by commas or spaces
+                    if elements[0].strip().lower() == "collect":
+                        self.collect[elements[1]] = elements[2].replace(',', ' ').split()
+                    else:
+                        self.collectFailure[elements[1]] = elements[2].replace(',', ' ').split()
+
+                # Per-host configuration options ...
+                #
+                # Format of these should be:
+                #	keyword:<Host Name>:<value>
+
+                elif len(elements) == 3 and elements[0].strip().lower() == "host_slots":
+                    self.hostSlots[elements[1].strip()] = self.ParseCount("configuration file", "host_slots", elements[2].strip())
+
+                elif len(elements) == 3 and elements[0].strip().lower() == "transport":
+                    transport = elements[2].strip().lower()
+                    if transport not in ['ssh', 'local']:
+                        sys.stderr.write('Invalid transport found in configuration file: %s\n' % elements[2].strip())
+                        sys.exit(-1)
+                    self.hostTransport[elements[1].strip()] = transport
+
+                # Per-project or per-host options (clone and make options) ...
+                #
+                # Format of these should be:
+                #	keyword:<Project or Host Name>:<value>
+                #
+                # (Filters contain ':' characters, like 'blob:none')
+
+                elif len(elements) == 3 and elements[0].strip().lower() == "clone_depth":
+                    self.cloneDepth[self.GetHostOrProjectKey(elements[1])] = self.ParseCount("configuration file", "clone_depth", elements[2].strip())
+
+                elif len(elements) >= 3 and elements[0].strip().lower() == "clone_filter":
+                    self.cloneFilter[self.GetHostOrProjectKey(elements[1])] = ':'.join(elements[2:]).strip()
+
+                elif len(elements) == 3 and elements[0].strip().lower() == "clone_reference":
+                    self.cloneReference[self.GetHostOrProjectKey(elements[1])] = elements[2].strip()
+
+                elif len(elements) == 3 and elements[0].strip().lower() == "make_jobs":
+                    self.makeJobs[self.GetHostOrProjectKey(elements[1])] = self.ParseCount("configuration file", "make_jobs", elements[2].strip())
+
                 else:
                     raise IOError('Bad configuration file - offending line: \'' + line.rstrip() + '\'')
 
@@ -383,6 +666,10 @@ class Configuration:
             # Include trailing "/" in path
             self.logfilePriorPrefix = os.path.join(self.logfilePriorPrefix, '')
 
+        # Handle override for max_parallel in the configuration file by command line
+        if self.options.max_parallel != None:
+            self.maxParallel = self.ParseCount("command line", "--max-parallel", self.options.max_parallel)
+
         # Handle override for settings in configuration file by command line
         # (As optimization, --nocurses forces no progress updates)
         if self.options.settings != None:
@@ -410,7 +697,7 @@ class Configuration:
             sys.stderr.write('No --select on command line and no \'select:\' tag in configuration\n')
             sys.exit(-1)
 
-        # Be sure we have at least one host to deal with ...
+        # Be sure we have at least one host to deal with (for each selector) ...
         if len(taglist) == 0:
             if self.GetSelectSpecification() != '':
                 sys.stderr.write('No host entries found for selector \''
@@ -421,45 +708,83 @@ class Configuration:
 
             sys.exit(-1)
 
+        for select in self.GetSelectList():
+            if len([key for key in self.machines.keys() if self.machines[key].GetSelect() == select]) == 0:
+                sys.stderr.write('No host entries found for selector \''
+                                 + select
+                                 + '\' in pbuild configuration file\n')
+                sys.exit(-1)
+
         # Final processing:
+        #   Set up the transports (SSH connections are opened as needed)
         #   Be sure that we have all of our SSH host keys set up
         #   Validate the host list
+        self.transports = { 'ssh': SSHTransport(self.GetSetting('SSHMultiplex')),
+                            'local': LocalTransport() }
         self.InitializeSSH()
         self.ValidateHostList()
 
 
     ##
-    # Initialize SSH known hosts
-    #
-    # We use file '~/.pbuild_init' to track when we were last initialized.
-    # If configuration file is newer than initialization file, we init again.
-    # This helps insure that we have SSH certificates for all of the hosts.
+    # Get the key that a host's verification is cached under.  If anything in
+    # the key changes, the host must be verified again.
     #
-    def InitializeSSH(self):
-        pbuildInitialized = False
-        if not self.GetSetting("CheckValidity"):
-            pbuildInitialized = True
+    def GetVerifyKey(self, hostname):
+        return '%d:%s' % (self.VERIFY_VERSION, self.GetTransportName(hostname))
 
-        initFilename = os.path.join(os.path.expanduser('~'), '.pbuild_init')
+    ##
+    # Load the host verification cache
+    #
+    # \returns
+    # Dictionary of host name -> { 'key': verify key, 'verified': time }
+    # (empty if the cache doesn't exist or isn't valid, like the empty marker
+    # file written by earlier versions of pbuild)
+    #
+    def LoadVerifyCache(self, filename):
         try:
-            initStat = os.stat(initFilename)
-            configStat = os.stat(self.GetConfigurationFilename())
+            f = open(filename, 'r')
+            try:
+                cache = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return {}
 
-            if configStat[stat.ST_MTIME] < initStat[stat.ST_MTIME]:
-                pbuildInitialized = True
-        except OSError:
-            pass
+        if not isinstance(cache, dict) or not isinstance(cache.get('hosts'), dict):
+            return {}
 
-        if pbuildInitialized and not self.options.initialize:
-            return True
+        return cache['hosts']
 
-        # Try and remove the file if it exists
+    ##
+    # Save the host verification cache
+    #
+    def SaveVerifyCache(self, filename, hosts):
         try:
-            os.remove(initFilename)
-        except OSError:
-            # If the file doesn't exist, that's fine
-            pass
+            f = open(filename, 'w')
+            try:
+                json.dump({ 'hosts': hosts }, f, indent=2, sort_keys=True)
+                f.write('\n')
+            finally:
+                f.close()
+        except IOError, e:
+            sys.stderr.write('Unable to write host verification cache %s: %s\n' % (filename, e.strerror))
+
+    ##
+    # Initialize SSH known hosts
+    #
+    # We use file '~/.pbuild_init' to cache which hosts have been verified
+    # (and when).  Hosts that are new to the configuration file, or whose
+    # verification key (see GetVerifyKey) changed, are verified again.  If
+    # 'verify_expiry' is set, hosts are also verified again after that many
+    # days.  This helps insure that we have SSH certificates for all of the
+    # hosts, without verifying every host when the configuration changes.
+    #
+    def InitializeSSH(self):
+        if not self.GetSetting("CheckValidity") and not self.options.initialize:
+            return True
 
+        initFilename = os.path.join(os.path.expanduser('~'), '.pbuild_init')
+        cache = self.LoadVerifyCache(initFilename)
 
         # We only need to check each machine once (not per project).
         # Thus, build a set of unique hostnames
@@ -468,6 +793,24 @@ class Configuration:
             host = self.machines_allselects[key].GetHost()
             uniqueHosts.add(host)
 
+        # Forget about hosts that are no longer configured
+        for host in cache.keys():
+            if host not in uniqueHosts:
+                del cache[host]
+
+        # Figure out which hosts need to be verified (all with --initialize)
+        now = time.time()
+        verifyHosts = set()
+        for host in uniqueHosts:
+            entry = cache.get(host)
+            if self.options.initialize or not isinstance(entry, dict) \
+                    or entry.get('key') != self.GetVerifyKey(host) \
+                    or (self.verifyExpiry and now - entry.get('verified', 0) > self.verifyExpiry * 24 * 60 * 60):
+                verifyHosts.add(host)
+
+        if len(verifyHosts) == 0:
+            return True
+
         # We use complete host list rather than hosts specified on command line
         # Using git doesn't require pre-setup as such (other than public/private
         # key to the host machine), but it DOES require an entry in .known_hosts
@@ -477,26 +820,76 @@ class Configuration:
         #   1) Connect to the machine in question with SSH auth forwarding
         #   2) Use grep to see if github.com is known in .known_hosts
         #   3) If not, issue ssh command to add entry to .known_hosts
-        hostsOK = True
-        for host in sorted(uniqueHosts):
-            print "Checking host:", host
-
-            process = subprocess.Popen(
-                [
-                    'ssh', '-A', host,
-                    'grep github.com, ~/.ssh/known_hosts > /dev/null 2> /dev/null || ssh -o StrictHostKeyChecking=no -o HashKnownHosts=no -T git@github.com; grep github.com, ~/.ssh/known_hosts > /dev/null 2> /dev/null || ssh -o StrictHostKeyChecking=no -T git@github.com'
-                ],
-                stdin=subprocess.PIPE
-                )
-            process.wait()
-
-            if process.returncode != 0:
-                hostsOK = False
+        #
+        # Hosts are checked in parallel (VERIFY_WORKERS at a time), so this
+        # takes about as long as the slowest host.  Since we can't prompt for
+        # several hosts at once, SSH runs in batch mode (no prompts).  With
+        # --initialize, hosts that failed because SSH needed to prompt (for an
+        # unknown host key, or a password) are then checked again, one at a
+        # time, with prompts.
+        for transport in self.GetTransports():
+            transport.Connect([host for host in verifyHosts if self.GetTransport(host) == transport])
+
+        print "Checking %d hosts ..." % len(verifyHosts)
+
+        pending = sorted(verifyHosts)
+        failures = {}
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                lock.acquire()
+                try:
+                    if len(pending) == 0:
+                        return
+                    host = pending.pop(0)
+                finally:
+                    lock.release()
+
+                reason = self.VerifyHost(host)
+                if reason != None:
+                    lock.acquire()
+                    failures[host] = reason
+                    lock.release()
+
+        workers = [ threading.Thread(target=worker) for i in range(min(self.VERIFY_WORKERS, len(pending))) ]
+        for thread in workers:
+            thread.daemon = True
+            thread.start()
+
+        # (Join with a timeout so that ^C is still recognized)
+        for thread in workers:
+            while thread.isAlive():
+                thread.join(1)
+
+        promptHosts = [ host for host in sorted(failures.keys()) if self.VERIFY_PROMPT_ERRORS.search(failures[host]) ]
+        if self.options.initialize:
+            for host in promptHosts:
+                reason = self.VerifyHostInteractively(host)
+                if reason == None:
+                    del failures[host]
+                else:
+                    failures[host] = reason
+
+        hostsOK = (len(failures) == 0)
+        if not hostsOK:
+            print "Host verification failed for %d of %d hosts:" % (len(failures), len(verifyHosts))
+            for host in sorted(failures.keys()):
+                print "  %-30s %s" % (host + ':', failures[host])
+
+            if not self.options.initialize and len(promptHosts):
+                print "(Use --initialize to verify hosts that need to prompt for host keys or passwords)"
+
+        # Remember the hosts that are okay (hosts that failed are checked again
+        # next time)
+        for host in verifyHosts:
+            if host in failures:
+                if host in cache:
+                    del cache[host]
+            else:
+                cache[host] = { 'key': self.GetVerifyKey(host), 'verified': now }
 
-        if hostsOK:
-            # If all hosts are okay, create marker file
-            initFile = open(initFilename, 'w')
-            initFile.close()
+        self.SaveVerifyCache(initFilename, cache)
 
         if self.options.initialize:
             print "Completed host verification pass"
@@ -504,6 +897,65 @@ class Configuration:
 
         return hostsOK
 
+    ##
+    # Verify a single host (see InitializeSSH), allowing VERIFY_TIMEOUT seconds
+    #
+    # \returns
+    # None if the host is okay, or the reason that the host failed
+    #
+    def VerifyHost(self, host):
+        # Output goes to a temporary file (not a pipe), so we can simply poll
+        # for completion without worrying about the pipe filling up
+        output = tempfile.TemporaryFile()
+        process = subprocess.Popen(
+            self.GetTransport(host).GetCommand(host, ['-A', '-o', 'BatchMode=yes'], self.VERIFY_COMMAND),
+            stdin=open(os.devnull, 'r'),
+            stdout=output,
+            stderr=subprocess.STDOUT
+            )
+
+        deadline = time.time() + self.VERIFY_TIMEOUT
+        while process.poll() == None and time.time() < deadline:
+            time.sleep(0.1)
+
+        if process.poll() == None:
+            process.kill()
+            process.wait()
+            output.close()
+            return 'No response after %d seconds' % self.VERIFY_TIMEOUT
+
+        output.seek(0)
+        output = output.read()
+
+        if process.returncode != 0:
+            lines = [line.strip() for line in output.splitlines() if line.strip()]
+            if len(lines):
+                return 'Exit status %d: %s' % (process.returncode, lines[-1])
+            else:
+                return 'Exit status %d' % process.returncode
+
+        return None
+
+    ##
+    # Verify a single host (see InitializeSSH) with SSH in the foreground, so
+    # that it can prompt (to accept the host key, or for a password)
+    #
+    # \returns
+    # None if the host is okay, or the reason that the host failed
+    #
+    def VerifyHostInteractively(self, host):
+        print "Checking host:", host
+
+        process = subprocess.Popen(
+            self.GetTransport(host).GetCommand(host, ['-A'], self.VERIFY_COMMAND)
+            )
+        process.wait()
+
+        if process.returncode != 0:
+            return 'Exit status %d' % process.returncode
+
+        return None
+
     ##
     # Normalize host specification
     #
@@ -512,18 +964,18 @@ class Configuration:
     # code in pbuild expects hosts to solely be in "tag" form.
     #
     # This function will "normalize" host specifications.  Input is any supported
-    # form, output is the associated tag.
+    # form, output is the list of associated machine keys.  If several selectors
+    # are being built, a host specification may refer to several machines (one
+    # per selector).
     #
     def NormalizeHostSpec(self, hostSpec):
-        try:
-            # Do the easy thing first: is the entry a hostname for a host?
-            if self.machines[hostSpec]:
-                return hostSpec;
-        except KeyError:
-            # Nope - so loop thorugh our list of hosts looking at tags that way
-            for key in self.machines:
-                if self.machines[key].GetTag() == hostSpec:
-                    return key;
+        keys = []
+        for key in sorted(self.machines.keys()):
+            if self.machines[key].GetHost() == hostSpec or self.machines[key].GetTag() == hostSpec:
+                keys.append(key)
+
+        if len(keys):
+            return keys
 
         sys.stderr.write('Failed to identify host \'%s\' in configuration\n' % hostSpec)
         sys.exit(-1)
@@ -537,11 +989,11 @@ class Configuration:
     def ValidateHostList(self):
         # Build a list of machines to process (if none, we simply process all hosts)
         for entry in self.args:
-            key = self.NormalizeHostSpec(entry)
-            if key in self.machineKeys:
-                sys.stderr.write('Duplicate host \'%s\' already in configuration\n' % key)
-                sys.exit(-1)
-            self.machineKeys.append(key)
+            for key in self.NormalizeHostSpec(entry):
+                if key in self.machineKeys:
+                    sys.stderr.write('Duplicate host \'%s\' already in configuration\n' % entry)
+                    sys.exit(-1)
+                self.machineKeys.append(key)
 
         # Support the list of machines to exclude if one was specified
         if len(self.excludeList):
@@ -554,14 +1006,13 @@ class Configuration:
 
             # Now exclude each of the hosts specified in the exclude list
             for entry in self.excludeList:
-                key = self.NormalizeHostSpec(entry)
-
-                # If host wasn't in our list, then must be specific list of
-                # hosts to build - that's not an error condition
-                #
-                # Don't remove host that's specifically included in include list
-                if key in self.machineKeys and fAllHosts:
-                    self.machineKeys.remove(key)
+                for key in self.NormalizeHostSpec(entry):
+                    # If host wasn't in our list, then must be specific list of
+                    # hosts to build - that's not an error condition
+                    #
+                    # Don't remove host that's specifically included in include list
+                    if key in self.machineKeys and fAllHosts:
+                        self.machineKeys.remove(key)
 
         # Verify if the subproject list is sensical for selected hosts
         # We validate based on the machines, we're actually building with
@@ -581,23 +1032,30 @@ class Configuration:
                 machineList = sorted(self.machines.keys())
 
             # We're probably building just one project, but in case we are not,
-            # validate the subproject list with every machine we're building.
-
-            for entry in machineList:
-                projectName = self.machines[entry].GetProject()
-                factory = ProjectFactory(projectName)
-                assert factory.Validate()
-                project = factory.Create()
-
-                subprojectList = self.options.subproject.split(',')
-                for subproject in subprojectList:
-                    # Subproject spec looks like: <dir>:<branch>
-                    subproject_dir, subproject_branch = subproject.split(':')
-
-                    if not project.ValidateSubproject(subproject_dir):
-                        sys.stderr.write('Invalid subproject \'%s\' for project \'%s\'\n'
-                                         % (subproject_dir, projectName) )
-                        sys.exit(-1)
+            # validate the subproject list with every project we're building.
+            # (When building several projects, a subproject only applies to the
+            # projects that have it, but it must apply to at least one.)
+
+            projectNames = sorted(set([ self.machines[entry].GetProject() for entry in machineList ]))
+
+            subprojectList = self.options.subproject.split(',')
+            for subproject in subprojectList:
+                # Subproject spec looks like: <dir>:<branch>
+                subproject_dir, subproject_branch = subproject.split(':')
+
+                subprojectValid = False
+                for projectName in projectNames:
+                    factory = ProjectFactory(projectName)
+                    assert factory.Validate()
+                    project = factory.Create()
+
+                    if project.ValidateSubproject(subproject_dir):
+                        subprojectValid = True
+
+                if not subprojectValid:
+                    sys.stderr.write('Invalid subproject \'%s\' for project \'%s\'\n'
+                                     % (subproject_dir, ','.join(projectNames)) )
+                    sys.exit(-1)
 
         # Okay, we're done.  State of the world:
         #
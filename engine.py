@@ -0,0 +1,298 @@
+# coding: utf-8
+#
+# Copyright (c) Microsoft Corporation.  All rights reserved.
+#
+##
+# Module containing the execution engines that run BuildHost objects
+#
+# Two engines are available:
+#
+#   ThreadEngine:     One thread per host (BuildHost.run), blocking on the
+#                     output of the 'scp' and 'ssh' processes.
+#   EventLoopEngine:  One thread for all hosts, driving the 'scp' and 'ssh'
+#                     processes and their output from a poll() loop.
+#
+# The event loop engine is selected with setting 'EventLoop'.  Both engines
+# use the same command scripts and log file handling (from BuildHost), and
+# post the same events to the display code.
+#
+
+import errno
+import os
+import select
+import subprocess
+import sys
+import threading
+import traceback
+
+from events import *
+
+##
+# ThreadEngine class - runs each host in its own thread
+#
+class ThreadEngine:
+    ##
+    # Start building a host
+    #
+    def Start(self, host):
+        host.start()
+
+    ##
+    # Wait for a host (that posted EVENT_FINISHED) to complete
+    #
+    def Join(self, host):
+        host.join()
+
+    ##
+    # Shut down the engine
+    #
+    def Shutdown(self):
+        pass
+
+##
+# EventLoopEngine class - runs all hosts from a single thread
+#
+class EventLoopEngine(threading.Thread):
+    # Phases that a host passes through
+    PHASE_COPY = 'copy'
+    PHASE_BUILD = 'build'
+
+    # Requests to the engine thread
+    REQUEST_START = 'start'
+    REQUEST_STOP = 'stop'
+
+    ##
+    # Ctor.
+    # \param[in] EventQueue class (to post activity and completion to)
+    #
+    def __init__(self, events):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.events = events
+        self.requests = EventQueue()
+
+        # Output streams that we're waiting on, by file descriptor.  Each entry
+        # is a dictionary describing the host and the phase it's in.
+        self.streams = {}
+
+        self.poller = select.poll()
+        self.poller.register(self.requests.GetWaitFd(), select.POLLIN)
+
+    ##
+    # Start building a host (may be called from any thread)
+    #
+    def Start(self, host):
+        if not self.isAlive():
+            self.start()
+
+        self.requests.Post(self.REQUEST_START, host)
+
+    ##
+    # Wait for a host (that posted EVENT_FINISHED) to complete
+    #
+    # Nothing to do; by the time EVENT_FINISHED is posted, we're done with it.
+    #
+    def Join(self, host):
+        pass
+
+    ##
+    # Shut down the engine
+    #
+    def Shutdown(self):
+        if self.isAlive():
+            self.requests.Post(self.REQUEST_STOP, None)
+            self.join()
+
+    ##
+    # Start watching the output of a process
+    #
+    def AddStream(self, host, phase, process, data):
+        stream = { 'host': host, 'phase': phase, 'process': process, 'data': data, 'partial': '' }
+        fd = process.stdout.fileno()
+        self.streams[fd] = stream
+        self.poller.register(fd, select.POLLIN)
+
+    ##
+    # Stop watching the output of a process (it's closed its output)
+    #
+    def RemoveStream(self, fd):
+        stream = self.streams[fd]
+        del self.streams[fd]
+        self.poller.unregister(fd)
+        stream['process'].stdout.close()
+
+        return stream
+
+    ##
+    # Begin processing a host: Copy the command script to the remote system
+    #
+    def StartCopy(self, host):
+        # Let the display code know we're starting up
+        self.events.Post(EVENT_ACTIVITY, host)
+
+        # With setting 'StreamScript', there's no command script to copy
+        if host.streamScript:
+            self.StartBuild(host)
+            return
+
+        # Keep the temporary file around until the copy completes
+        tmpfile = host.WriteCommandScript()
+
+        host.process = subprocess.Popen(
+            host.GetCopyCommand(tmpfile.name),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE
+            )
+
+        self.AddStream(host, self.PHASE_COPY, host.process, tmpfile)
+
+    ##
+    # Continue processing a host: Perform the build on the remote system
+    #
+    def StartBuild(self, host):
+        outf = host.OpenLogfile()
+        try:
+            host.StartBuildProcess()
+        except:
+            outf.close()
+            raise
+
+        self.AddStream(host, self.PHASE_BUILD, host.process, outf)
+
+    ##
+    # Handle output (or end of output) from a process
+    #
+    def HandleOutput(self, fd):
+        stream = self.streams[fd]
+        host = stream['host']
+
+        try:
+            data = os.read(fd, 65536)
+        except OSError, e:
+            if e.errno in [ errno.EAGAIN, errno.EINTR ]:
+                return
+            data = ''
+
+        if data:
+            # We don't care about output from the copy, just the build
+            if stream['phase'] == self.PHASE_BUILD:
+                lines = (stream['partial'] + data).split('\n')
+                stream['partial'] = lines.pop()
+
+                for line in lines:
+                    host.ProcessLine(stream['data'], line + '\n')
+
+            return
+
+        # End of output: The process has completed (or is about to)
+        self.RemoveStream(fd)
+        stream['process'].wait()
+
+        if stream['phase'] == self.PHASE_COPY:
+            # Temporary file deleted when closed ...
+            stream['data'].close()
+
+            if stream['process'].returncode == 0:
+                self.StartBuild(host)
+                return
+
+            host.WriteCopyFailure()
+        else:
+            if stream['partial']:
+                host.ProcessLine(stream['data'], stream['partial'])
+            host.CloseLogfile(stream['data'])
+
+        self.Finish(host)
+
+    ##
+    # Finish processing a host: Collect its artifacts (if configured), and
+    # let the display code know that it's done
+    #
+    # Collection is throttled to share bandwidth among the hosts (it blocks),
+    # so it runs in a thread of its own.
+    #
+    def Finish(self, host):
+        if host.collector == None:
+            self.events.Post(EVENT_FINISHED, host)
+            return
+
+        thread = threading.Thread(target=self.Collect, args=(host,))
+        thread.daemon = True
+        thread.start()
+
+    ##
+    # Collection thread: Collect the artifacts of a host
+    #
+    def Collect(self, host):
+        try:
+            host.CollectArtifacts()
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+
+        self.events.Post(EVENT_FINISHED, host)
+
+    ##
+    # Engine thread: Dispatch requests and process output until asked to stop
+    #
+    def run(self):
+        while True:
+            try:
+                ready = self.poller.poll()
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                ready = []
+
+            for (fd, flags) in ready:
+                if fd in self.streams:
+                    host = self.streams[fd]['host']
+                    try:
+                        self.HandleOutput(fd)
+                    except Exception:
+                        self.HandleFailure(host)
+
+            for (request, host) in self.requests.Collect():
+                if request == self.REQUEST_STOP:
+                    return
+
+                try:
+                    self.StartCopy(host)
+                except Exception:
+                    self.HandleFailure(host)
+
+    ##
+    # Handle an unexpected error while processing a host
+    #
+    # With the thread engine, such an error only takes down the thread for that
+    # host.  We do the same: give up on the host (stopping its process and
+    # closing its log file) and carry on with the others.  The host fails (see
+    # Builder.FinishHost), even if its process never started.
+    #
+    def HandleFailure(self, host):
+        traceback.print_exc(file=sys.stderr)
+
+        if host.process != None and host.process.poll() == None:
+            # Kill the remote build too (as --abortOnError does), but don't
+            # wait for that (the other hosts are waiting on us)
+            command = host.GetKillCommand()
+            if command != None:
+                devnull = open(os.devnull, 'r+')
+                subprocess.Popen(command, stdin=devnull, stdout=devnull, stderr=devnull)
+                devnull.close()
+
+            host.process.terminate()
+            host.process.wait()
+
+        for fd in self.streams.keys():
+            if self.streams[fd]['host'] == host:
+                stream = self.RemoveStream(fd)
+                try:
+                    if stream['phase'] == self.PHASE_COPY:
+                        stream['data'].close()
+                    else:
+                        host.CloseLogfile(stream['data'])
+                except Exception:
+                    traceback.print_exc(file=sys.stderr)
+
+        self.events.Post(EVENT_FINISHED, host)
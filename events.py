@@ -0,0 +1,110 @@
+# coding: utf-8
+#
+# Copyright (c) Microsoft Corporation.  All rights reserved.
+#
+##
+# Module containing the event queue that BuildHost objects post to
+#
+
+import errno
+import fcntl
+import os
+import select
+import threading
+
+# Events posted by a BuildHost:
+#   EVENT_ACTIVITY: New output (or a new stage) is available for display
+#   EVENT_FINISHED: The host has completed (successfully or not)
+
+EVENT_ACTIVITY = 'activity'
+EVENT_FINISHED = 'finished'
+
+##
+# EventQueue class - thread-safe queue of (event, host) pairs
+#
+# Posting an event writes a byte to a pipe, so the consumer can wait with
+# select() rather than polling.  This lets the consumer sleep until there's
+# actually something to do, wait on other file descriptors (like the keyboard)
+# at the same time, and still be interrupted with ^C (unlike Queue.get()).
+#
+class EventQueue:
+    ##
+    # Ctor.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = []
+
+        (self.readFd, self.writeFd) = os.pipe()
+        flags = fcntl.fcntl(self.readFd, fcntl.F_GETFL)
+        fcntl.fcntl(self.readFd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    ##
+    # Post an event (may be called from any thread)
+    #
+    def Post(self, event, host):
+        self.lock.acquire()
+        try:
+            # Only wake up the consumer if it doesn't already have work pending
+            if len(self.events) == 0:
+                os.write(self.writeFd, 'x')
+            self.events.append((event, host))
+        finally:
+            self.lock.release()
+
+    ##
+    # Wait for events to be posted
+    #
+    # \param[in] Timeout in seconds (None to wait forever)
+    # \param[in] Additional file descriptors to wait on (i.e. keyboard)
+    #
+    # \returns
+    # Tuple of (list of (event, host) pairs, list of ready file descriptors).
+    # Either list may be empty (on timeout, for example).
+    #
+    def Wait(self, timeout=None, fds=[]):
+        try:
+            ready = select.select([self.readFd] + fds, [], [], timeout)[0]
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            ready = []
+
+        return (self.Collect(), [fd for fd in ready if fd != self.readFd])
+
+    ##
+    # Collect the events posted so far without waiting.  This is useful if the
+    # caller waits on GetWaitFd() itself (along with other file descriptors).
+    #
+    # \returns
+    # List of (event, host) pairs (may be empty)
+    #
+    def Collect(self):
+        self.lock.acquire()
+        try:
+            events = self.events
+            self.events = []
+
+            # Drain the wakeup pipe (it's non-blocking, so this can't hang)
+            try:
+                while os.read(self.readFd, 4096):
+                    pass
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+        finally:
+            self.lock.release()
+
+        return events
+
+    ##
+    # Get the file descriptor that becomes readable when events are posted
+    #
+    def GetWaitFd(self):
+        return self.readFd
+
+    ##
+    # Close the event queue
+    #
+    def Close(self):
+        os.close(self.readFd)
+        os.close(self.writeFd)
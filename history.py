@@ -0,0 +1,117 @@
+# coding: utf-8
+#
+# Copyright (c) Microsoft Corporation.  All rights reserved.
+#
+##
+# Module containing the build history store
+#
+# The history is kept in an SQLite database in the log directory, and is used
+# to estimate how long each host will take to build.  For each build, we keep:
+#
+#   builds:   tag, host, project, selector, branch, start time, elapsed time
+#             and exit status
+#   stages:   the elapsed time of each stage of the build (as delimited by
+#             the "Performing" markers in the log)
+#
+
+try:
+    import sqlite3
+except ImportError:
+    # Some Python builds don't include sqlite3; we just won't keep history
+    sqlite3 = None
+
+##
+# BuildHistory class - records the builds performed by pbuild
+#
+class BuildHistory:
+    # Number of prior successful builds to base estimates on
+    ESTIMATE_BUILDS = 5
+
+    ##
+    # Ctor.
+    # \param[in] Configuration class (for pbuild configuration)
+    #
+    def __init__(self, config):
+        self.db = None
+        self.filename = config.GetLogfilePrefix() + '.pbuild_history.db'
+
+        if sqlite3 == None:
+            return
+
+        try:
+            self.db = sqlite3.connect(self.filename, timeout=30)
+            self.db.execute('CREATE TABLE IF NOT EXISTS builds ('
+                            '  tag TEXT, hostname TEXT, project TEXT, selector TEXT,'
+                            '  started REAL, elapsed REAL, status INTEGER)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS stages ('
+                            '  build INTEGER, sequence INTEGER, stage TEXT,'
+                            '  started REAL, elapsed REAL)')
+
+            # Databases from earlier versions of pbuild lack the branch
+            columns = [ row[1] for row in self.db.execute('PRAGMA table_info(builds)') ]
+            if 'branch' not in columns:
+                self.db.execute('ALTER TABLE builds ADD COLUMN branch TEXT')
+
+            self.db.commit()
+        except sqlite3.Error:
+            # History is a convenience; don't fail the build over it
+            self.db = None
+
+    ##
+    # Get the expected duration (in seconds) for a host, based on prior builds
+    #
+    # \returns
+    # Expected duration, or None if there is no history for the host
+    #
+    def GetExpectedDuration(self, tag, project):
+        if self.db == None:
+            return None
+
+        try:
+            rows = self.db.execute('SELECT elapsed FROM builds'
+                                   ' WHERE tag = ? AND project = ? AND status = 0'
+                                   ' ORDER BY started DESC LIMIT ?',
+                                   (tag, project, self.ESTIMATE_BUILDS)).fetchall()
+        except sqlite3.Error:
+            return None
+
+        if len(rows) == 0:
+            return None
+
+        return sum([row[0] for row in rows]) / len(rows)
+
+    ##
+    # Record a completed build
+    #
+    # \param[in] BuildHost that completed
+    # \param[in] Exit status of the build
+    # \param[in] Time the build started
+    # \param[in] Elapsed time of the build (in seconds)
+    # \param[in] List of (stage name, start time, end time) tuples
+    #
+    def RecordBuild(self, host, status, started, elapsed, stages):
+        if self.db == None:
+            return
+
+        try:
+            cursor = self.db.execute('INSERT INTO builds (tag, hostname, project, selector, branch, started, elapsed, status)'
+                                     ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                     (host.tag, host.hostname, host.project, host.select, host.branch,
+                                      started, elapsed, status))
+
+            for i in range(len(stages)):
+                (stage, stageStart, stageEnd) = stages[i]
+                self.db.execute('INSERT INTO stages VALUES (?, ?, ?, ?, ?)',
+                                (cursor.lastrowid, i, stage, stageStart, stageEnd - stageStart))
+
+            self.db.commit()
+        except sqlite3.Error:
+            pass
+
+    ##
+    # Close the history store
+    #
+    def Close(self):
+        if self.db != None:
+            self.db.close()
+            self.db = None
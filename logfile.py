@@ -0,0 +1,607 @@
+# coding: utf-8
+#
+# Copyright (c) Microsoft Corporation.  All rights reserved.
+#
+##
+# Module containing support for compressed log files (setting
+# 'CompressLogfiles')
+#
+# Compressed log files are written as they stream in, in the block-based
+# gzip format used by 'bgzip' (BGZF): a series of gzip members, each holding
+# up to 64 KB of the log, with the compressed size of the member in its
+# header.  Any gzip tool (zcat, zless, gunzip) reads them as usual, but since
+# each block stands alone (and its size is known without decompressing it):
+#
+#   1. The log can be read while it's being written (blocks are flushed
+#      every second, so an active log is never more than a second behind),
+#   2. The end of the log can be found without decompressing all of it.
+#
+# A log is complete once the empty end-of-file block is written.  Log files
+# can be viewed (and followed, like 'tail -f') with 'pbuild --follow', and the
+# first error in a log (see LogIndex) with 'pbuild --show-error'.
+#
+
+import os
+import re
+import struct
+import sys
+import threading
+import time
+import zlib
+
+from logindex import FindFirstError
+from logindex import LoadIndex
+
+# The empty block that ends every BGZF file
+BGZF_EOF = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+# Size of a BGZF block header (gzip header with the 'BC' extra field)
+BGZF_HEADER_SIZE = 18
+
+##
+# BlockGzipFile class - writes a log file in BGZF format
+#
+# Only the methods that BuildHost uses on a log file (write and close) are
+# provided.  Data is compressed a block at a time, as blocks fill up (or
+# every FLUSH_INTERVAL seconds, by the LogfileFlusher).
+#
+class BlockGzipFile:
+    # Maximum amount of data in a block (as for bgzip, this guarantees that
+    # the compressed block, which must not exceed 64 KB, fits)
+    BLOCK_SIZE = 65280
+
+    # Compression level (higher levels are much slower, for little gain)
+    COMPRESS_LEVEL = 6
+
+    ##
+    # Ctor.
+    # \param[in] File name
+    # \param[in] Mode to open the file with ('a' or 'w')
+    #
+    def __init__(self, filename, mode='a'):
+        self.lock = threading.Lock()
+        self.file = open(filename, mode + 'b')
+        self.buffer = []
+        self.size = 0
+        self.closed = False
+
+        flusher.Register(self)
+
+    ##
+    # Write a compressed block holding some data (the lock must be held)
+    #
+    def WriteBlock(self, data):
+        compressor = zlib.compressobj(self.COMPRESS_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+        deflated = compressor.compress(data) + compressor.flush()
+
+        # (Only incompressible data can overflow a block; split it up)
+        blockSize = BGZF_HEADER_SIZE + len(deflated) + 8
+        if blockSize > 65536:
+            self.WriteBlock(data[:len(data) / 2])
+            self.WriteBlock(data[len(data) / 2:])
+            return
+
+        self.file.write(struct.pack('<BBBBIBBHBBHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, blockSize - 1))
+        self.file.write(deflated)
+        self.file.write(struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data)))
+
+    ##
+    # Compress the buffered data (the lock must be held)
+    #
+    def FlushBuffer(self):
+        if self.size == 0:
+            return
+
+        data = ''.join(self.buffer)
+        self.buffer = []
+        self.size = 0
+
+        while len(data):
+            self.WriteBlock(data[:self.BLOCK_SIZE])
+            data = data[self.BLOCK_SIZE:]
+
+        self.file.flush()
+
+    ##
+    # Write data to the log file
+    #
+    def write(self, data):
+        self.lock.acquire()
+        try:
+            self.buffer.append(data)
+            self.size += len(data)
+
+            if self.size >= self.BLOCK_SIZE:
+                self.FlushBuffer()
+        finally:
+            self.lock.release()
+
+    ##
+    # Compress (and write) any buffered data
+    #
+    def flush(self):
+        self.lock.acquire()
+        try:
+            if not self.closed:
+                self.FlushBuffer()
+        finally:
+            self.lock.release()
+
+    ##
+    # Close the log file (marking it complete)
+    #
+    def close(self):
+        flusher.Unregister(self)
+
+        self.lock.acquire()
+        try:
+            if not self.closed:
+                self.FlushBuffer()
+                self.file.write(BGZF_EOF)
+                self.file.close()
+                self.closed = True
+        finally:
+            self.lock.release()
+
+##
+# LogfileFlusher class - flushes all open compressed log files periodically
+# (from one thread), so that active logs can be followed
+#
+class LogfileFlusher:
+    # Time (in seconds) between flushes
+    FLUSH_INTERVAL = 1.0
+
+    ##
+    # Ctor.
+    #
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = []
+        self.thread = None
+
+    ##
+    # Start flushing a file (starting the flusher thread if needed)
+    #
+    def Register(self, logfile):
+        self.lock.acquire()
+        try:
+            self.files.append(logfile)
+
+            if self.thread == None:
+                self.thread = threading.Thread(target=self.Run)
+                self.thread.daemon = True
+                self.thread.start()
+        finally:
+            self.lock.release()
+
+    ##
+    # Stop flushing a file
+    #
+    def Unregister(self, logfile):
+        self.lock.acquire()
+        try:
+            if logfile in self.files:
+                self.files.remove(logfile)
+        finally:
+            self.lock.release()
+
+    ##
+    # Flusher thread
+    #
+    def Run(self):
+        while True:
+            time.sleep(self.FLUSH_INTERVAL)
+
+            self.lock.acquire()
+            try:
+                files = list(self.files)
+            finally:
+                self.lock.release()
+
+            for logfile in files:
+                logfile.flush()
+
+# The flusher shared by all compressed log files
+flusher = LogfileFlusher()
+
+##
+# Compress an existing (uncompressed) log file, replacing it
+#
+# \param[in] Name of the uncompressed log file
+# \param[in] Name of the compressed log file
+#
+def CompressLogfile(source, destination):
+    inf = open(source, 'rb')
+    try:
+        outf = BlockGzipFile(destination, 'w')
+        try:
+            while True:
+                data = inf.read(BlockGzipFile.BLOCK_SIZE)
+                if data == '':
+                    break
+                outf.write(data)
+        finally:
+            outf.close()
+    finally:
+        inf.close()
+
+    # Keep the timestamp of the log (it tells when the build ran)
+    status = os.stat(source)
+    os.utime(destination, (status.st_atime, status.st_mtime))
+    os.remove(source)
+
+##
+# BlockGzipReader class - reads a log file in BGZF format (possibly while
+# it's being written)
+#
+class BlockGzipReader:
+    ##
+    # Ctor.
+    # \param[in] File name
+    #
+    def __init__(self, filename):
+        self.file = open(filename, 'rb')
+
+        # Offset of the next block to read
+        self.offset = 0
+
+        # True once the end-of-file block has been read
+        self.complete = False
+
+    ##
+    # Get the size of the block at an offset (without decompressing it)
+    #
+    # \returns
+    # Size of the block, or None if the block isn't completely written yet
+    #
+    def GetBlockSize(self, offset):
+        self.file.seek(offset)
+        header = self.file.read(BGZF_HEADER_SIZE)
+        if len(header) < BGZF_HEADER_SIZE:
+            return None
+
+        fields = struct.unpack('<BBBBIBBHBBHH', header)
+        if fields[0:4] != (31, 139, 8, 4) or fields[8:10] != (66, 67):
+            raise IOError('Not a compressed log file (bad block at offset %d)' % offset)
+
+        size = fields[11] + 1
+        self.file.seek(0, os.SEEK_END)
+        if self.file.tell() < offset + size:
+            return None
+
+        return size
+
+    ##
+    # Get the offsets of the complete blocks from the current offset on
+    # (reading just the block headers)
+    #
+    def GetBlockOffsets(self):
+        offsets = []
+        offset = self.offset
+        while True:
+            size = self.GetBlockSize(offset)
+            if size == None:
+                break
+            offsets.append(offset)
+            offset += size
+
+        return offsets
+
+    ##
+    # Decompress the block at an offset
+    #
+    # \returns
+    # Tuple of (data, size of the block)
+    #
+    def ReadBlock(self, offset):
+        size = self.GetBlockSize(offset)
+        self.file.seek(offset + BGZF_HEADER_SIZE)
+        deflated = self.file.read(size - BGZF_HEADER_SIZE - 8)
+
+        return (zlib.decompress(deflated, -zlib.MAX_WBITS), size)
+
+    ##
+    # Position the reader at the end of the log, less at least some number of
+    # lines (like 'tail')
+    #
+    # \returns
+    # The data of the log, from that position to its current end
+    #
+    def SeekTail(self, lines):
+        offsets = self.GetBlockOffsets()
+
+        # Work back from the last block until we have enough lines
+        data = ''
+        for offset in reversed(offsets):
+            (block, size) = self.ReadBlock(offset)
+            data = block + data
+            if data.count('\n') > lines:
+                break
+
+        if len(offsets):
+            size = self.GetBlockSize(offsets[-1])
+            self.offset = offsets[-1] + size
+            self.complete = (size == len(BGZF_EOF))
+
+        return '\n'.join(data.split('\n')[-(lines + 1):])
+
+    ##
+    # Read part of the log, by its offset in the uncompressed log
+    #
+    # The uncompressed size of each block is in its trailer, so we only
+    # decompress the blocks that hold the data we want.
+    #
+    # \param[in] Offset (in the uncompressed log)
+    # \param[in] Number of bytes to read
+    #
+    def ReadRange(self, start, length):
+        data = []
+        first = None
+        offset = 0
+        position = 0
+        while position < start + length:
+            size = self.GetBlockSize(offset)
+            if size == None:
+                break
+
+            self.file.seek(offset + size - 4)
+            blockLength = struct.unpack('<I', self.file.read(4))[0]
+            if position + blockLength > start:
+                if first == None:
+                    first = position
+                data.append(self.ReadBlock(offset)[0])
+
+            offset += size
+            position += blockLength
+
+        if first == None:
+            return ''
+
+        return ''.join(data)[start - first:start - first + length]
+
+    ##
+    # Read the data written since the last read
+    #
+    def Read(self):
+        data = []
+        while True:
+            size = self.GetBlockSize(self.offset)
+            if size == None:
+                break
+
+            (block, size) = self.ReadBlock(self.offset)
+            data.append(block)
+            self.offset += size
+
+            # (The end-of-file block is empty; an empty data block is not
+            # written)
+            if size == len(BGZF_EOF):
+                self.complete = True
+
+        return ''.join(data)
+
+    ##
+    # Close the log file
+    #
+    def close(self):
+        self.file.close()
+
+##
+# PlainReader class - reads an uncompressed log file (possibly while it's
+# being written), with the same interface as BlockGzipReader
+#
+class PlainReader:
+    ##
+    # Ctor.
+    # \param[in] File name
+    #
+    def __init__(self, filename):
+        self.file = open(filename, 'rb')
+
+        # An uncompressed log is complete once its index (see LogIndex) says
+        # so, and we've read all of it.  Logs without an index (or whose index
+        # went away as the log was renamed) aren't being written.
+        self.indexFilename = GetIndexFilename(filename)
+        self.complete = False
+
+    ##
+    # Position the reader at the end of the log, less at least some number of
+    # lines (like 'tail')
+    #
+    def SeekTail(self, lines):
+        data = self.file.read()
+        return '\n'.join(data.split('\n')[-(lines + 1):])
+
+    ##
+    # Read part of the log
+    #
+    # \param[in] Offset
+    # \param[in] Number of bytes to read
+    #
+    def ReadRange(self, start, length):
+        self.file.seek(start)
+        return self.file.read(length)
+
+    ##
+    # Read the data written since the last read
+    #
+    def Read(self):
+        data = self.file.read()
+
+        if data == '':
+            index = LoadIndex(self.indexFilename)
+            if index == None or (index['complete'] and self.file.tell() >= index['size']):
+                self.complete = True
+
+        return data
+
+    ##
+    # Close the log file
+    #
+    def close(self):
+        self.file.close()
+
+##
+# Get the name of the index file of a log file (compressed or not)
+#
+def GetIndexFilename(filename):
+    return re.sub(r'\.log(\.gz)?$', '.idx', filename)
+
+##
+# Open a log file for reading (compressed or not)
+#
+def OpenLogfileReader(filename):
+    if filename.endswith('.gz'):
+        return BlockGzipReader(filename)
+
+    return PlainReader(filename)
+
+##
+# LogViewer class - shows (and follows) the log file of a host (--follow)
+#
+class LogViewer:
+    # Number of lines of the log to show before following it
+    TAIL_LINES = 10
+
+    # Time (in seconds) between checks for more of the log
+    POLL_INTERVAL = 0.5
+
+    # Number of lines to show before and after an error (--show-error), and
+    # the most of the log to read on either side of it to find them
+    CONTEXT_BEFORE = 5
+    CONTEXT_AFTER = 20
+    CONTEXT_BYTES = 16384
+
+    ##
+    # Ctor.
+    # \param[in] Configuration class (for pbuild configuration)
+    #
+    def __init__(self, config):
+        self.config = config
+
+    ##
+    # Find the log file of a host: the most recent of its log files (in the
+    # log directory), compressed or not, with or without selector
+    #
+    # \param[in] Tag of the host (or 'selector:tag')
+    #
+    def FindLogfile(self, tag):
+        selectors = [ '' ] + [ '-' + select for select in self.config.GetSelectList() ]
+        if ':' in tag:
+            (select, tag) = tag.split(':', 1)
+            selectors = [ '-' + select ]
+
+        candidates = []
+        for prefix in [ '', 'active-', 'done-', 'failed-' ]:
+            for selectSpec in selectors:
+                for suffix in [ '.log', '.log.gz' ]:
+                    filename = '%s%s%s%s%s' % (self.config.GetLogfilePrefix(), prefix, tag, selectSpec, suffix)
+                    try:
+                        candidates.append((os.stat(filename).st_mtime, filename))
+                    except OSError:
+                        # If the file doesn't exist, that's fine
+                        pass
+
+        if len(candidates) == 0:
+            return None
+
+        return sorted(candidates)[-1][1]
+
+    ##
+    # Show the end of a host's log file, and then follow it (until it's
+    # complete, renamed, or ^C)
+    #
+    # \param[in] Tag of the host
+    #
+    # \returns
+    # Exit status
+    #
+    def Follow(self, tag):
+        filename = self.FindLogfile(tag)
+        if filename == None:
+            sys.stderr.write('No log file found for host %s in %s\n' % (tag, self.config.GetLogfilePrefix()))
+            return -1
+
+        print "==> %s <==" % filename
+        reader = OpenLogfileReader(filename)
+        try:
+            sys.stdout.write(reader.SeekTail(self.TAIL_LINES))
+            sys.stdout.flush()
+
+            while not reader.complete:
+                time.sleep(self.POLL_INTERVAL)
+
+                # (Once an active log is renamed, it's complete)
+                renamed = not os.path.exists(filename)
+
+                data = reader.Read()
+                sys.stdout.write(data)
+                sys.stdout.flush()
+
+                if renamed and data == '':
+                    break
+        except KeyboardInterrupt:
+            pass
+        finally:
+            reader.close()
+
+        return 0
+
+    ##
+    # Show the first error in a host's log file, with the lines around it
+    # (using the log's index, so the log isn't searched)
+    #
+    # \param[in] Tag of the host
+    #
+    # \returns
+    # Exit status
+    #
+    def ShowError(self, tag):
+        filename = self.FindLogfile(tag)
+        if filename == None:
+            sys.stderr.write('No log file found for host %s in %s\n' % (tag, self.config.GetLogfilePrefix()))
+            return -1
+
+        index = LoadIndex(GetIndexFilename(filename))
+        if index == None:
+            sys.stderr.write('No index found for log file %s\n' % filename)
+            return -1
+
+        error = FindFirstError(index)
+        if error == None:
+            print "No errors found in %s" % filename
+            return 0
+
+        print "==> %s (line %d, stage '%s') <==" % (filename, error['line'], error['stage'])
+
+        # Read enough of the log around the error for the context lines
+        start = max(0, error['offset'] - self.CONTEXT_BYTES)
+        reader = OpenLogfileReader(filename)
+        try:
+            data = reader.ReadRange(start, error['offset'] - start + self.CONTEXT_BYTES)
+        finally:
+            reader.close()
+
+        before = data[:error['offset'] - start].split('\n')[:-1][-self.CONTEXT_BEFORE:]
+        after = data[error['offset'] - start:].split('\n')[:self.CONTEXT_AFTER + 1]
+        if after[-1] == '':
+            # (The end of the log)
+            after.pop()
+
+        firstLine = error['line'] - len(before)
+        for i in range(len(before)):
+            print "%7d  %s" % (firstLine + i, before[i])
+        for i in range(len(after)):
+            if i == 0:
+                print "%7d> %s" % (error['line'], after[i])
+            else:
+                print "%7d  %s" % (error['line'] + i, after[i])
+
+        count = sum([ index['errors'][kind]['count'] for kind in index['errors'].keys() ])
+        if count > 1:
+            print "\n(%d errors in all: %s)" % (count, ', '.join([ '%d %s' % (index['errors'][kind]['count'], kind)
+                                                                  for kind in sorted(index['errors'].keys())
+                                                                  if index['errors'][kind]['count'] ]))
+
+        return 0
+
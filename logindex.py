@@ -0,0 +1,202 @@
+# coding: utf-8
+#
+# Copyright (c) Microsoft Corporation.  All rights reserved.
+#
+##
+# Module containing the log file index
+#
+# As the output of a build streams into its log file, a small index is built
+# alongside it (in JSON format, in '<tag>.idx' next to '<tag>.log'), so that
+# finding out where (and why) a build failed doesn't mean searching through
+# the whole log.  The index holds:
+#
+#   1. The offset (in bytes, in the uncompressed log) and line number of each
+#      stage of the build (the "Performing" markers),
+#   2. For each kind of error (compiler errors, test failures, and 'make'
+#      errors), the count and the first and last ERROR_LIMIT occurrences.
+#
+# The index is rewritten (at most every WRITE_INTERVAL seconds) as the build
+# runs, and once more when the log is closed ("complete" is then true).  The
+# first error of a failed build is shown in the summary screen, and can be
+# viewed in context with 'pbuild --show-error'.
+#
+
+import json
+import os
+import re
+import time
+
+##
+# LogIndex class - index of the stages and errors of a log file
+#
+class LogIndex:
+    # Number of occurrences of each kind of error to keep, at the start and
+    # at the end of the log
+    ERROR_LIMIT = 10
+
+    # Maximum length of the text kept for each error
+    TEXT_LENGTH = 200
+
+    # Time (in seconds) between writes of the index, as the build runs
+    WRITE_INTERVAL = 1.0
+
+    # Kinds of errors, and the patterns for each (compilers on each platform,
+    # CppUnit and other test runners, and make)
+    ERROR_PATTERNS = [
+        ('compiler', re.compile(r':\d+(:\d+)?: (fatal )?error\b'                     # gcc, clang
+                                r'|^"[^"]+", line \d+(\.\d+)?: (Error|error #\d+)'   # Sun, HP aCC 6
+                                r'|^"[^"]+", line \d+\.\d+: \d+-\d+ \([SU]\)'         # AIX xlC
+                                r'|^Error \d+: "[^"]+", line \d+'                    # HP aCC 3
+                                r'|: undefined reference to ')),                     # link errors
+        ('test',     re.compile(r'^!!!FAILURES!!!'
+                                r'|^\d+\) test: .* \([EF]\)'
+                                r'|^(FAIL|FAILED|ERROR): ')),
+        ('make',     re.compile(r'^g?make(\[\d+\])?: \*\*\* ')),
+        ]
+
+    # Stage markers in the log (see BuildHost.NoteActivity)
+    STAGE_MARKER = '========================= Performing '
+
+    ##
+    # Ctor.
+    # \param[in] Name of the index file
+    #
+    def __init__(self, filename):
+        self.filename = filename
+        self.offset = 0
+        self.lines = 0
+        self.stages = []
+        self.errors = {}
+        for (kind, pattern) in self.ERROR_PATTERNS:
+            self.errors[kind] = { 'count': 0, 'first': [], 'last': [] }
+
+        self.dirty = False
+        self.lastWrite = 0
+
+    ##
+    # Add a line of the log to the index (in the order they're written)
+    #
+    def AddLine(self, line):
+        offset = self.offset
+        self.offset += len(line)
+        self.lines += 1
+
+        if line.startswith(self.STAGE_MARKER):
+            stage = line.rstrip()[len(self.STAGE_MARKER):].split(';')[0].strip()
+            if len(self.stages) == 0 or self.stages[-1]['stage'] != stage:
+                self.stages.append({ 'stage': stage, 'offset': offset, 'line': self.lines })
+                self.dirty = True
+        else:
+            for (kind, pattern) in self.ERROR_PATTERNS:
+                if pattern.search(line):
+                    entry = { 'offset': offset, 'line': self.lines,
+                              'text': line.rstrip()[:self.TEXT_LENGTH] }
+                    errors = self.errors[kind]
+                    errors['count'] += 1
+                    if len(errors['first']) < self.ERROR_LIMIT:
+                        errors['first'].append(entry)
+                    errors['last'] = (errors['last'] + [ entry ])[-self.ERROR_LIMIT:]
+                    self.dirty = True
+                    break
+
+        if self.dirty and time.time() - self.lastWrite >= self.WRITE_INTERVAL:
+            self.Write(False)
+
+    ##
+    # Get the first error in the log (of any kind)
+    #
+    # \returns
+    # Dictionary with the kind, offset, line and text of the error, and the
+    # stage it occurred in (or None if there were no errors)
+    #
+    def GetFirstError(self):
+        return FindFirstError(self.GetIndex(True))
+
+    ##
+    # Get the contents of the index
+    #
+    def GetIndex(self, complete):
+        return { 'log': os.path.basename(self.filename)[:-len('.idx')],
+                 'complete': complete,
+                 'size': self.offset,
+                 'lines': self.lines,
+                 'stages': self.stages,
+                 'errors': self.errors }
+
+    ##
+    # Write the index (replacing the prior one at once, so readers never see
+    # a partial index)
+    #
+    # \param[in] True if the log is complete
+    #
+    def Write(self, complete):
+        self.dirty = False
+        self.lastWrite = time.time()
+
+        tmpfname = self.filename + '.tmp'
+        try:
+            outf = open(tmpfname, 'w')
+            try:
+                json.dump(self.GetIndex(complete), outf, sort_keys=True)
+                outf.write('\n')
+            finally:
+                outf.close()
+            os.rename(tmpfname, self.filename)
+        except (IOError, OSError):
+            # The index is a convenience; the log is what matters
+            pass
+
+    ##
+    # Close the index (once the log is complete), renaming it along with the
+    # log if needed
+    #
+    # \param[in] New name of the index file (or None)
+    #
+    def Close(self, filename=None):
+        if filename != None and filename != self.filename:
+            try:
+                os.rename(self.filename, filename)
+            except OSError:
+                pass
+            self.filename = filename
+
+        self.Write(True)
+
+##
+# Find the first error (of any kind) in an index
+#
+# \returns
+# Dictionary with the kind, offset, line and text of the error, and the stage
+# it occurred in (or None if there were no errors)
+#
+def FindFirstError(index):
+    first = None
+    for kind in index['errors'].keys():
+        for entry in index['errors'][kind]['first'][:1]:
+            if first == None or entry['offset'] < first['offset']:
+                first = dict(entry)
+                first['kind'] = kind
+
+    if first != None:
+        first['stage'] = ''
+        for stage in index['stages']:
+            if stage['offset'] <= first['offset']:
+                first['stage'] = stage['stage']
+
+    return first
+
+##
+# Load an index file
+#
+# \returns
+# Contents of the index (or None if it can't be read)
+#
+def LoadIndex(filename):
+    try:
+        inf = open(filename, 'r')
+        try:
+            return json.load(inf)
+        finally:
+            inf.close()
+    except (IOError, ValueError):
+        return None
@@ -12,6 +12,7 @@ from stat import *
 from config import Configuration
 from config import MachineItem
 from builder import Builder
+from logfile import LogViewer
 
 ##
 # Main program class
@@ -34,7 +35,7 @@ class pbuild:
 
         parser.add_option("", "--abortOnError",
                           action="store_true", dest="abort", default=False,
-                          help="Immediately aborts when the first remote build fails (for future - do not use yet)")
+                          help="Immediately aborts when the first remote build fails (killing the remote builds)")
 
         parser.add_option("", "--attributes",
                           type="string",
@@ -46,10 +47,18 @@ class pbuild:
                           dest="branch",
                           help="Selects the branch for the top level project or superproject")
 
+        parser.add_option("", "--bundle",
+                          action="store_true", dest="bundle", default=False,
+                          help="Ships git objects from your local clones (see 'local_clone') rather than fetching from GitHub on each host")
+
         parser.add_option("-d", "--debug",
                           action="store_true", dest="debug", default=False,
                           help="Build targets in DEBUG mode")
 
+        parser.add_option("", "--clear-configure-cache",
+                          action="store_true", dest="clear_configure_cache", default=False,
+                          help="Clears the configure cache on each host for the projects being built (see setting 'ConfigureCache')")
+
         parser.add_option("", "--clone",
                           action="store_true", dest="clone", default=False,
                           help="Forces a new clone of the repository, even if repository already exists")
@@ -64,6 +73,15 @@ class pbuild:
                           dest="exclude",
                           help="Overrides default exclude list from configuration file (if any); comma-separated list of hosts to exclude from the build")
 
+        parser.add_option("", "--follow",
+                          type="string",
+                          dest="follow",
+                          help="Shows the end of the log file for the specified host tag, and follows it as it grows (like 'tail -f'); works with compressed log files")
+
+        parser.add_option("", "--incremental",
+                          action="store_true", dest="incremental", default=False,
+                          help="Skips 'git clean' and 'configure' if nothing they depend on has changed since the last build on the host")
+
         parser.add_option("", "--initialize",
                           action="store_true", dest="initialize", default=False,
                           help="Verify public keys in known_hosts file")
@@ -82,6 +100,11 @@ class pbuild:
                           dest="logdir_prior",
                           help="Overrides 'logdir_prior' from configuration file")
 
+        parser.add_option("", "--max-parallel",
+                          type="string",
+                          dest="max_parallel",
+                          help="Overrides 'max_parallel' from configuration file; maximum number of hosts to build concurrently (0 for no limit)")
+
         parser.add_option("", "--nodebug",
                           action="store_true", dest="nodebug", default=False,
                           help="Build targets in NODEBUG mode")
@@ -90,16 +113,25 @@ class pbuild:
                           action="store_true", dest="nocurses", default=False,
                           help="Disable curses for dynamic screen updating (may be useful for diagnostic purposes)")
 
+        parser.add_option("", "--resume",
+                          action="store_true", dest="resume", default=False,
+                          help="Resumes a failed build on each host from the first stage that didn't finish (if the commits and configuration are unchanged)")
+
         parser.add_option("", "--select",
                           type="string",
                           dest="select",
-                          help="Select specification to build (only build hosts with this select specification)")
+                          help="Select specification to build (only build hosts with this select specification); may be a comma-separated list to build several selectors at once")
 
         parser.add_option("", "--settings",
                           type="string",
                           dest="settings",
                           help="Overrides default settings from program and configuration file (i.e. 'ShowSummary,LogFile')")
 
+        parser.add_option("", "--show-error",
+                          type="string",
+                          dest="show_error",
+                          help="Shows the first error (compiler error, test failure or make error) in the log file for the specified host tag, with the lines around it")
+
         parser.add_option("-s", "--subproject",
                           type="string",
                           dest="subproject",
@@ -155,18 +187,32 @@ class pbuild:
             print "Logfile Directory:", config.GetLogfilePrefix()
             print "Select:           ", config.GetSelectSpecification()
             print "Settings:         ", config.currentSettings
+            if config.GetMaxParallel():
+                print "Max Parallel:     ", config.GetMaxParallel()
             print "\n"
             print "%-20s %-10s %s" % ("Machine Tag", "Project", "Host Address")
             print "%-20s %-10s %s\n" % ("-----------", "-------", "------------")
 
             # We really prefer to list sorted by tags, so do so
+            # (If building several selectors, tags are qualified by selector)
             machines_byTag = {}
             for key in config.machines.keys():
-                machines_byTag[config.machines[key].GetTag()] = config.machines[key]
+                label = config.machines[key].GetTag()
+                if len(config.GetSelectList()) > 1:
+                    label = '%s:%s' % (config.machines[key].GetSelect(), label)
+                machines_byTag[label] = config.machines[key]
             for key in sorted(machines_byTag.keys()):
-                print "%-20s %-10s %s" % (machines_byTag[key].GetTag() + ':', machines_byTag[key].GetProject(), machines_byTag[key].GetHost())
+                print "%-20s %-10s %s" % (key + ':', machines_byTag[key].GetProject(), machines_byTag[key].GetHost())
             return 0
 
+        # Support for the --follow qualifier
+        if self.options.follow:
+            return LogViewer(config).Follow(self.options.follow)
+
+        # Support for the --show-error qualifier
+        if self.options.show_error:
+            return LogViewer(config).ShowError(self.options.show_error)
+
         # Go start the build process (and return resulting status)
         build = Builder(config)
         return build.StartBuild()
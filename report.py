@@ -0,0 +1,144 @@
+# coding: utf-8
+#
+# Copyright (c) Microsoft Corporation.  All rights reserved.
+#
+##
+# Module containing the stage timing report
+#
+# At the end of each run, the time spent in each stage of the build (as
+# delimited by the "Performing" markers in the log) is written, for every
+# host, to 'pbuild_stages.json' in the log directory.  A compact table of
+# the same information can be printed with the final status.
+#
+
+import json
+import time
+
+##
+# StageReport class - reports on the time spent in each stage of the build
+#
+class StageReport:
+    # Width of each stage column in the table (stage names are truncated)
+    COLUMN_WIDTH = 12
+
+    ##
+    # Ctor.
+    # \param[in] Configuration class (for pbuild configuration)
+    # \param[in] List of BuildHost objects (finished or not)
+    # \param[in] Time the run started
+    #
+    def __init__(self, config, hosts, startTime):
+        self.filename = config.GetLogfilePrefix() + 'pbuild_stages.json'
+        self.hosts = sorted(hosts, key=lambda host: host.label)
+        self.startTime = startTime
+        self.endTime = time.time()
+
+    ##
+    # Get the timing of each stage of a host
+    #
+    # \returns
+    # List of (stage name, start time, end time) tuples (empty if the host
+    # never started)
+    #
+    def GetStageTimes(self, host):
+        if host.startTime == None:
+            return []
+
+        if host.finished:
+            return host.stageTimes
+
+        # Aborted: stages run until now
+        return host.GetStageTimes(self.endTime)
+
+    ##
+    # Get the list of stage names, in the order that they were first seen
+    #
+    def GetStageNames(self):
+        names = []
+        for host in self.hosts:
+            for (stage, started, ended) in self.GetStageTimes(host):
+                if stage not in names:
+                    names.append(stage)
+
+        return names
+
+    ##
+    # Write the report (in JSON format) to the log directory
+    #
+    def Write(self):
+        report = { 'started': self.startTime,
+                   'elapsed': self.endTime - self.startTime,
+                   'hosts': [] }
+
+        for host in self.hosts:
+            entry = { 'tag': host.tag,
+                      'label': host.label,
+                      'hostname': host.hostname,
+                      'project': host.project,
+                      'select': host.select,
+                      'branch': host.branch,
+                      'status': host.completionStatus,
+                      'started': host.startTime,
+                      'latency': host.latency,
+                      'stages': [] }
+
+            if host.finished and host.process != None:
+                entry['exitstatus'] = host.process.returncode
+
+            for (stage, started, ended) in self.GetStageTimes(host):
+                entry['stages'].append({ 'stage': stage,
+                                         'started': started,
+                                         'ended': ended,
+                                         'elapsed': ended - started })
+
+            report['hosts'].append(entry)
+
+        try:
+            outf = open(self.filename, 'w')
+            try:
+                json.dump(report, outf, indent=2, sort_keys=True)
+                outf.write('\n')
+            finally:
+                outf.close()
+        except IOError, e:
+            print "Unable to write stage report %s: %s" % (self.filename, e.strerror)
+
+    ##
+    # Format a time (in seconds) for the table
+    #
+    def FormatTime(self, seconds):
+        seconds = int(seconds + 0.5)
+        if seconds >= 60 * 60:
+            return '%d:%02d:%02d' % (seconds / 3600, (seconds / 60) % 60, seconds % 60)
+        else:
+            return '%d:%02d' % (seconds / 60, seconds % 60)
+
+    ##
+    # Print a compact table of stage times (one line per host, one column per
+    # stage).  Stages that a host never performed are shown as '-'.
+    #
+    def PrintTable(self):
+        names = self.GetStageNames()
+        if len(names) == 0:
+            return
+
+        width = self.COLUMN_WIDTH
+        print "Stage times:\n"
+        print "%-19s %s" % ('', ' '.join(["%*.*s" % (width, width, name) for name in names]))
+
+        for host in self.hosts:
+            times = {}
+            for (stage, started, ended) in self.GetStageTimes(host):
+                times[stage] = times.get(stage, 0) + (ended - started)
+
+            columns = []
+            for name in names:
+                if name in times:
+                    columns.append("%*s" % (width, self.FormatTime(times[name])))
+                else:
+                    columns.append("%*s" % (width, '-'))
+
+            print "%-19s %s" % (host.label, ' '.join(columns))
+
+        print
+        print "Stage report written to %s\n" % self.filename
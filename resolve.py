@@ -0,0 +1,375 @@
+# coding: utf-8
+#
+# Copyright (c) Microsoft Corporation.  All rights reserved.
+#
+##
+# Module containing support for resolving branches to commits (setting
+# 'ResolveBranches')
+#
+# Rather than having each host check out branches by name (after its own
+# fetch), the branches to build are resolved to commits once, before any
+# host is started.  Every host then builds exactly the same commits (even if
+# someone pushes during the run), and unknown branches are caught up front.
+#
+# For each project, we resolve:
+#
+#   1. The project's branch (--branch, or master),
+#   2. The branch of each submodule named by --subproject, and
+#   3. Without --branch, master of each other submodule (with --branch, the
+#      project's commit determines the commits of the other submodules).
+#
+# Branches are resolved from GitHub or, with --bundle, from the local clone
+# (which is where the hosts get their commits from).  Branches named by
+# --branch or --subproject must exist; if master doesn't exist, that
+# repository is simply checked out by name (as it would be otherwise).
+#
+
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from project import ProjectFactory
+
+##
+# BranchResolver class - resolves the branches to build to commits
+#
+class BranchResolver:
+    # Time (in seconds) to wait for GitHub to answer
+    RESOLVE_TIMEOUT = 60
+
+    ##
+    # Ctor.
+    # \param[in] Configuration class (for pbuild configuration)
+    #
+    def __init__(self, config):
+        self.config = config
+
+        # Wrapper script for GIT_SSH (see GetEnvironment), created when needed
+        self.sshWrapper = None
+
+    ##
+    # Get the environment to run git commands in, so that credentials are
+    # never prompted for (over HTTPS, or over SSH for unknown host keys or
+    # key passphrases)
+    #
+    # Git 2.3 and later use GIT_SSH_COMMAND; older versions need GIT_SSH to
+    # name a program, so we write a small wrapper script.  If the user has set
+    # either of these, that's left alone.
+    #
+    def GetEnvironment(self):
+        environment = dict(os.environ)
+        environment['GIT_TERMINAL_PROMPT'] = '0'
+
+        if 'GIT_SSH' not in environment and 'GIT_SSH_COMMAND' not in environment:
+            if self.sshWrapper == None:
+                (fd, self.sshWrapper) = tempfile.mkstemp(prefix='pbuild', suffix='.sh')
+                os.write(fd, '#!/bin/sh\nexec ssh -o BatchMode=yes "$@"\n')
+                os.close(fd)
+                os.chmod(self.sshWrapper, 0755)
+
+            environment['GIT_SSH_COMMAND'] = 'ssh -o BatchMode=yes'
+            environment['GIT_SSH'] = self.sshWrapper
+
+        return environment
+
+    ##
+    # Run git commands (concurrently), but wait no longer than RESOLVE_TIMEOUT
+    # seconds for them to complete.  Credentials are never prompted for (see
+    # GetEnvironment).
+    #
+    # \param[in] Directory to run the commands in
+    # \param[in] List of git command lines (without 'git')
+    #
+    # \returns
+    # List of outputs of each command (None if the command failed)
+    #
+    def RunGitCommands(self, directory, commands):
+        environment = self.GetEnvironment()
+
+        devnull = open(os.devnull, 'r+')
+        processes = []
+        for arguments in commands:
+            # (Output goes to a file, so a large listing can't block the command)
+            output = tempfile.TemporaryFile()
+            try:
+                process = subprocess.Popen([ 'git' ] + arguments, cwd=directory, env=environment,
+                                           stdin=devnull, stdout=output, stderr=devnull)
+            except OSError:
+                process = None
+            processes.append((output, process))
+        devnull.close()
+
+        deadline = time.time() + self.RESOLVE_TIMEOUT
+        while time.time() < deadline and None in [ process.poll() for (output, process) in processes if process ]:
+            time.sleep(0.05)
+
+        results = []
+        for (output, process) in processes:
+            if process != None and process.poll() == None:
+                process.kill()
+                process.wait()
+
+            if process != None and process.returncode == 0:
+                output.seek(0)
+                results.append(output.read())
+            else:
+                results.append(None)
+
+            output.close()
+
+        return results
+
+    ##
+    # Run a git command (see RunGitCommands)
+    #
+    # \returns
+    # Output of the command (or None if the command failed)
+    #
+    def RunGit(self, directory, arguments):
+        return self.RunGitCommands(directory, [ arguments ])[0]
+
+    ##
+    # Resolve a submodule URL relative to the URL of its project (like
+    # '../pal.git'), as git does
+    #
+    def ResolveUrl(self, base, url):
+        if not (url.startswith('./') or url.startswith('../')):
+            return url
+
+        base = base.rstrip('/')
+        while True:
+            if url.startswith('./'):
+                url = url[2:]
+            elif url.startswith('../'):
+                url = url[3:]
+                separator = max(base.rfind('/'), base.rfind(':'))
+                if base[separator] == ':':
+                    # (As in 'git@github.com:pal.git')
+                    base = base[:separator + 1]
+                else:
+                    base = base[:separator]
+            else:
+                break
+
+        if base.endswith(':'):
+            return base + url
+
+        return base + '/' + url
+
+    ##
+    # Parse a .gitmodules file
+    #
+    # \returns
+    # List of (path, url) tuples, in file order
+    #
+    def ParseGitmodules(self, text):
+        submodules = []
+        entries = {}
+        names = []
+        name = None
+        for line in text.splitlines():
+            line = line.strip()
+            match = re.match(r'^\[submodule\s+"(.*)"\]$', line)
+            if match:
+                name = match.group(1)
+                names.append(name)
+                entries[name] = {}
+            elif name != None and '=' in line:
+                (key, value) = line.split('=', 1)
+                entries[name][key.strip().lower()] = value.strip()
+
+        for name in names:
+            if 'path' in entries[name] and 'url' in entries[name]:
+                submodules.append((entries[name]['path'], entries[name]['url']))
+
+        return submodules
+
+    ##
+    # Get the branches to resolve for a project
+    #
+    # \returns
+    # (project branch, dictionary of branches by submodule path, whether
+    # the project branch was named explicitly)
+    #
+    def GetBranches(self, projectDefs):
+        subprojects = {}
+        if self.config.options.subproject:
+            for subproject in self.config.options.subproject.split(','):
+                (subprojectDir, subprojectBranch) = subproject.split(':')
+                if projectDefs.ValidateSubproject(subprojectDir):
+                    subprojects[os.path.normpath(subprojectDir)] = subprojectBranch
+
+        if self.config.options.branch:
+            return (self.config.options.branch, subprojects, True)
+
+        return ('master', subprojects, False)
+
+    ##
+    # Resolve the branches for a project from its local clone (for --bundle)
+    #
+    # As with the bundles (see BundleShipper), a local branch named by
+    # --branch or --subproject wins over the 'origin' branch.
+    #
+    # \returns
+    # Tuple (commits, errors): commits is a dictionary of commits by
+    # repository path ('.' for the project); errors is a list of messages
+    #
+    def ResolveLocal(self, project, localClone, branch, subprojects, explicit):
+        commits = {}
+        errors = []
+
+        def resolve(directory, path, branch, required):
+            refs = [ 'refs/remotes/origin/' + branch ]
+            if required:
+                refs.insert(0, 'refs/heads/' + branch)
+
+            for ref in refs:
+                sha = self.RunGit(directory, [ 'rev-parse', '--verify', '-q', ref + '^{commit}' ])
+                if sha != None:
+                    commits[path] = sha.strip()
+                    return
+
+            if required:
+                errors.append("Unknown branch '%s' for %s in local clone %s" % (branch, project, directory))
+
+        resolve(localClone, '.', branch, explicit)
+        if '.' not in commits:
+            return (commits, errors)
+
+        gitmodules = self.RunGit(localClone, [ 'show', commits['.'] + ':.gitmodules' ]) or ''
+        for (path, url) in self.ParseGitmodules(gitmodules):
+            path = os.path.normpath(path)
+            if path in subprojects:
+                resolve(os.path.join(localClone, path), path, subprojects[path], True)
+            elif not explicit:
+                resolve(os.path.join(localClone, path), path, 'master', False)
+
+        return (commits, errors)
+
+    ##
+    # Resolve the branches for a project from GitHub
+    #
+    # We fetch the project's branch (just the one commit) to learn its commit
+    # and its submodules, and then ask each submodule for its branches.
+    #
+    # \returns
+    # Tuple (commits, errors), as for ResolveLocal
+    #
+    def ResolveRemote(self, project, url, branch, subprojects, explicit):
+        commits = {}
+        errors = []
+
+        directory = tempfile.mkdtemp(prefix='pbuild')
+        try:
+            self.RunGit(directory, [ 'init', '-q', '--bare' ])
+            self.RunGit(directory, [ 'remote', 'add', 'origin', url ])
+            output = self.RunGit(directory, [ 'fetch', '-q', '--depth', '1', 'origin',
+                                              'refs/heads/%s:refs/pbuild' % branch ])
+            sha = self.RunGit(directory, [ 'rev-parse', '--verify', '-q', 'refs/pbuild^{commit}' ])
+            if output == None or sha == None:
+                # Was the branch missing, or GitHub unreachable?
+                heads = self.RunGit(directory, [ 'ls-remote', '--heads', url ])
+                if heads == None:
+                    print "WARNING: Unable to resolve branches for project %s from %s" % (project, url)
+                elif explicit:
+                    errors.append("Unknown branch '%s' for project %s (%s)" % (branch, project, url))
+                return (commits, errors)
+
+            commits['.'] = sha.strip()
+            gitmodules = self.RunGit(directory, [ 'show', commits['.'] + ':.gitmodules' ]) or ''
+        finally:
+            shutil.rmtree(directory, True)
+
+        # Ask the submodules (at once) for their branches
+        submodules = []
+        for (path, submoduleUrl) in self.ParseGitmodules(gitmodules):
+            path = os.path.normpath(path)
+            if path in subprojects:
+                submodules.append((path, self.ResolveUrl(url, submoduleUrl), subprojects[path], True))
+            elif not explicit:
+                submodules.append((path, self.ResolveUrl(url, submoduleUrl), 'master', False))
+
+        outputs = self.RunGitCommands(None, [ [ 'ls-remote', '--heads', submoduleUrl ]
+                                              for (path, submoduleUrl, submoduleBranch, required) in submodules ])
+
+        for i in range(len(submodules)):
+            (path, submoduleUrl, submoduleBranch, required) = submodules[i]
+            if outputs[i] == None:
+                print "WARNING: Unable to resolve branches for %s from %s" % (path, submoduleUrl)
+                continue
+
+            for line in outputs[i].splitlines():
+                (sha, ref) = line.split(None, 1)
+                if ref == 'refs/heads/' + submoduleBranch:
+                    commits[path] = sha
+                    break
+            else:
+                if required:
+                    errors.append("Unknown branch '%s' for subproject %s of project %s (%s)"
+                                  % (submoduleBranch, path, project, submoduleUrl))
+
+        return (commits, errors)
+
+    ##
+    # Resolve the branches to build for a list of projects.  If any branch
+    # named by --branch or --subproject doesn't exist, we exit with an error.
+    #
+    # \returns
+    # Dictionary (by project) of dictionaries of commits by repository path
+    # ('.' for the project)
+    #
+    def Resolve(self, projects):
+        print "Resolving branches for %d projects ..." % len(projects)
+
+        try:
+            (resolved, errors) = self.ResolveProjects(projects)
+        finally:
+            if self.sshWrapper != None:
+                os.remove(self.sshWrapper)
+                self.sshWrapper = None
+
+        if len(errors):
+            for error in errors:
+                sys.stderr.write(error + '\n')
+            sys.exit(-1)
+
+        return resolved
+
+    ##
+    # Resolve the branches to build for each project (see Resolve)
+    #
+    # \returns
+    # Tuple (resolved, errors): resolved is as for Resolve; errors is a list
+    # of messages
+    #
+    def ResolveProjects(self, projects):
+        resolved = {}
+        errors = []
+        for project in sorted(projects):
+            factory = ProjectFactory(project)
+            assert factory.Validate()
+            projectDefs = factory.Create()
+
+            (branch, subprojects, explicit) = self.GetBranches(projectDefs)
+
+            if self.config.options.bundle and self.config.GetLocalClone(project) != '':
+                (commits, projectErrors) = self.ResolveLocal(project, self.config.GetLocalClone(project),
+                                                             branch, subprojects, explicit)
+            else:
+                (commits, projectErrors) = self.ResolveRemote(project, projectDefs.GetCloneSource(),
+                                                              branch, subprojects, explicit)
+
+            resolved[project] = commits
+            errors += projectErrors
+
+            for path in sorted(commits.keys()):
+                if path == '.':
+                    print "  %-10s %-20s %s" % (project, branch, commits[path][:12])
+                else:
+                    print "  %-10s %-20s %s" % (project + ':' + path, subprojects.get(path, 'master'), commits[path][:12])
+
+        return (resolved, errors)
@@ -0,0 +1,157 @@
+# coding: utf-8
+#
+# Copyright (c) Microsoft Corporation.  All rights reserved.
+#
+##
+# Module containing the scheduler that decides when each host may start
+#
+
+##
+# Scheduler class - bounds the number of concurrently running hosts
+#
+# Hosts are started in the order they were handed to us.  A host may start
+# when both of the following are true:
+#
+#   1. Fewer than 'max_parallel' hosts are running (zero means no limit)
+#   2. The physical host (by host name, not by tag) has a free slot, as
+#      configured by 'host_slots' (zero or unconfigured means no limit)
+#
+# A host that can't start yet stays queued and is started as soon as a
+# running host releases its slot.
+#
+class Scheduler:
+    ##
+    # Ctor.
+    # \param[in] Configuration class (for pbuild configuration)
+    # \param[in] List of BuildHost objects, in the order they should start
+    #
+    def __init__(self, config, hosts):
+        self.config = config
+        self.maxParallel = config.GetMaxParallel()
+
+        self.pending = list(hosts)
+        self.running = []
+        self.slotsInUse = {}
+
+    ##
+    # Is the host still waiting to be started?
+    #
+    def IsPending(self, host):
+        return host in self.pending
+
+    ##
+    # Return the number of hosts that are currently running
+    #
+    def GetRunningCount(self):
+        return len(self.running)
+
+    ##
+    # Check if a host may start right now
+    #
+    def CanStart(self, host):
+        return self.CanStartWith(host, len(self.running), self.slotsInUse)
+
+    ##
+    # Check if a host may start, given the number of running hosts and the
+    # slots in use on each physical host
+    #
+    def CanStartWith(self, host, runningCount, slotsInUse):
+        if self.maxParallel and runningCount >= self.maxParallel:
+            return False
+
+        slots = self.config.GetHostSlots(host.hostname)
+        if slots and slotsInUse.get(host.hostname, 0) >= slots:
+            return False
+
+        return True
+
+    ##
+    # Determine the hosts that may be started now.  The caller is responsible
+    # for actually starting them; we just account for them as running.
+    #
+    # \returns
+    # List of hosts to start (may be empty)
+    #
+    def Dispatch(self):
+        started = []
+
+        for host in list(self.pending):
+            # Once the global limit is reached, nobody else can start
+            if self.maxParallel and len(self.running) >= self.maxParallel:
+                break
+
+            if self.CanStart(host):
+                self.pending.remove(host)
+                self.running.append(host)
+                self.slotsInUse[host.hostname] = self.slotsInUse.get(host.hostname, 0) + 1
+                started.append(host)
+
+        return started
+
+    ##
+    # Release the slot held by a host that has completed
+    #
+    def Release(self, host):
+        if host in self.running:
+            self.running.remove(host)
+            self.slotsInUse[host.hostname] -= 1
+
+    ##
+    # Estimate how long it will take for all hosts to complete
+    #
+    # We simulate the rest of the run: running hosts complete after their
+    # remaining time, and queued hosts start (in order) as slots free up and
+    # take their expected duration (BuildHost.expectedDuration).
+    #
+    # \param[in] Dictionary of remaining time (in seconds) for each running host
+    #
+    # \returns
+    # Estimated time (in seconds) until all hosts complete, or None if any
+    # host has no estimate
+    #
+    def EstimateCompletion(self, remaining):
+        for host in self.running:
+            if remaining.get(host) == None:
+                return None
+
+        for host in self.pending:
+            if host.expectedDuration == None:
+                return None
+
+        # Completions are (time, host) pairs
+        completions = [ (remaining[host], host) for host in self.running ]
+        runningCount = len(self.running)
+        slotsInUse = dict(self.slotsInUse)
+        pending = list(self.pending)
+        now = 0
+
+        while len(pending):
+            # Start everything that can start now
+            for host in list(pending):
+                if self.CanStartWith(host, runningCount, slotsInUse):
+                    pending.remove(host)
+                    runningCount += 1
+                    slotsInUse[host.hostname] = slotsInUse.get(host.hostname, 0) + 1
+                    completions.append((now + host.expectedDuration, host))
+
+            if len(pending) == 0 or len(completions) == 0:
+                break
+
+            # Then advance to the next completion
+            completions.sort(key=lambda completion: completion[0])
+            (now, host) = completions.pop(0)
+            runningCount -= 1
+            slotsInUse[host.hostname] -= 1
+
+        return max([ 0 ] + [ completion[0] for completion in completions ] + [ now ])
+
+    ##
+    # Cancel all hosts that haven't been started yet
+    #
+    # \returns
+    # List of hosts that were waiting to start
+    #
+    def Cancel(self):
+        cancelled = self.pending
+        self.pending = []
+        return cancelled
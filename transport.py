@@ -0,0 +1,227 @@
+# coding: utf-8
+#
+# Copyright (c) Microsoft Corporation.  All rights reserved.
+#
+##
+# Module containing the transports used to run commands on build hosts
+#
+# A transport provides the command lines to run a command on a host and to
+# copy a file to a host.  Each host uses one transport, selected in the
+# configuration file with 'transport : <host name> : <transport>':
+#
+#   SSHTransport:    Run commands with 'ssh', copy files with 'scp' (default)
+#   LocalTransport:  Run commands on this system (host name is ignored)
+#
+# SSH connection sharing (multiplexing):
+#
+# Without connection sharing, each 'ssh' and 'scp' command that pbuild issues
+# opens a new connection to the host, paying for a full handshake each time.
+# With setting 'SSHMultiplex', pbuild opens one master connection to each
+# host (OpenSSH 'ControlMaster'), and all later commands to that host are
+# carried over the master connection.  The master connections are closed
+# when pbuild exits (including on ^C).  Should pbuild be killed outright, an
+# idle master connection closes itself after PERSIST_TIMEOUT seconds.
+#
+# If a master connection can't be opened (or isn't open yet, or has closed),
+# commands simply connect to the host directly.
+#
+
+import atexit
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+##
+# SSHTransport class - runs commands with 'ssh', and manages the master
+# connection to each host
+#
+class SSHTransport:
+    # Time (in seconds) to wait for master connections to be established
+    CONNECT_TIMEOUT = 15
+
+    # Time (in seconds) that a master connection stays open with no commands
+    # using it (so connections aren't left behind if pbuild is killed)
+    PERSIST_TIMEOUT = 60
+
+    ##
+    # Ctor.
+    # \param[in] True if connection sharing is enabled
+    #
+    def __init__(self, enabled):
+        self.enabled = enabled
+
+        # Master connection for each host: (ControlPath, 'ssh' process)
+        self.masters = {}
+        self.controlDir = None
+
+        if self.enabled:
+            # UNIX domain socket paths are quite limited in length, so keep
+            # the control directory short (and name the sockets by number)
+            self.controlDir = tempfile.mkdtemp(prefix='pbuild', dir='/tmp')
+            atexit.register(self.Close)
+
+    ##
+    # Get the SSH options needed to use the master connection to a host
+    #
+    def GetOptions(self, hostname):
+        if hostname not in self.masters:
+            return []
+
+        # If the master connection failed, just connect directly
+        (controlPath, process) = self.masters[hostname]
+        if process.poll() not in [ None, 0 ]:
+            return []
+
+        return [ '-o', 'ControlMaster=no', '-o', 'ControlPath=' + controlPath ]
+
+    ##
+    # Get the command line to run a command on a host
+    #
+    # \param[in] Host name
+    # \param[in] List of additional 'ssh' options
+    # \param[in] Remote command to run
+    # \param[in] False to connect directly (not over the master connection)
+    #
+    def GetCommand(self, hostname, options, command, shared=True):
+        if not shared:
+            return [ 'ssh' ] + options + [ hostname, command ]
+
+        return [ 'ssh' ] + self.GetOptions(hostname) + options + [ hostname, command ]
+
+    ##
+    # Get the command line to copy a local file to a host
+    #
+    def GetCopyCommand(self, hostname, source, destination):
+        return [ 'scp', '-q' ] + self.GetOptions(hostname) + [ source, hostname + ':' + destination ]
+
+    ##
+    # Get the function to call in the child process before running a command
+    # (for subprocess.Popen).  Remote commands need no special handling.
+    #
+    def GetPreexecFunction(self):
+        return None
+
+    ##
+    # Open master connections (in parallel) to each host that doesn't have one
+    # (or whose master connection closed after being idle)
+    #
+    # We wait (for a while) for the connections to be established, so that
+    # subsequent commands use them.  Agent forwarding is enabled on the master
+    # connection, since that's needed for commands that request it.  Since
+    # several connections are opened at once, SSH runs in batch mode (if SSH
+    # would need to prompt, commands to the host just connect directly).
+    #
+    # \param[in] List of host names
+    #
+    def Connect(self, hostnames):
+        if not self.enabled:
+            return
+
+        devnull = open(os.devnull, 'r+')
+        started = []
+        for hostname in sorted(set(hostnames)):
+            if hostname in self.masters:
+                # (The socket goes away when the master connection closes)
+                (controlPath, process) = self.masters[hostname]
+                if process.poll() != 0 or os.path.exists(controlPath):
+                    continue
+            else:
+                controlPath = os.path.join(self.controlDir, str(len(self.masters)))
+
+            # The master forks into the background once connected ('-f'); be
+            # sure it doesn't hold on to any of our pipes
+            process = subprocess.Popen(
+                [ 'ssh', '-A', '-M', '-N', '-f',
+                  '-o', 'ControlPath=' + controlPath,
+                  '-o', 'ControlPersist=%d' % self.PERSIST_TIMEOUT,
+                  '-o', 'BatchMode=yes',
+                  '-o', 'ConnectTimeout=%d' % self.CONNECT_TIMEOUT,
+                  hostname ],
+                stdin=devnull,
+                stdout=devnull,
+                stderr=devnull
+                )
+
+            self.masters[hostname] = (controlPath, process)
+            started.append(process)
+
+        devnull.close()
+
+        deadline = time.time() + self.CONNECT_TIMEOUT
+        for process in started:
+            while process.poll() == None and time.time() < deadline:
+                time.sleep(0.05)
+
+    ##
+    # Close all master connections (in parallel)
+    #
+    def Close(self):
+        if not self.enabled:
+            return
+
+        devnull = open(os.devnull, 'r+')
+        closers = []
+        for hostname in self.masters.keys():
+            (controlPath, process) = self.masters[hostname]
+
+            if process.poll() == None:
+                # Never finished connecting; just give up on it
+                process.terminate()
+                process.wait()
+            elif process.returncode == 0:
+                closers.append(subprocess.Popen(
+                        [ 'ssh', '-O', 'exit', '-o', 'ControlPath=' + controlPath, hostname ],
+                        stdin=devnull,
+                        stdout=devnull,
+                        stderr=devnull
+                        ))
+
+        for closer in closers:
+            closer.wait()
+
+        devnull.close()
+
+        self.masters = {}
+        shutil.rmtree(self.controlDir, True)
+        self.enabled = False
+
+##
+# LocalTransport class - runs commands on this system
+#
+# This allows building on the system running pbuild without any SSH overhead
+# (the host entry's directory is local), and is handy for testing pbuild.
+#
+class LocalTransport:
+    ##
+    # Get the command line to run a command (host name and options are ignored)
+    #
+    def GetCommand(self, hostname, options, command, shared=True):
+        return [ 'bash', '-c', command ]
+
+    ##
+    # Get the command line to copy a file
+    #
+    def GetCopyCommand(self, hostname, source, destination):
+        return [ 'cp', source, destination ]
+
+    ##
+    # Get the function to call in the child process before running a command
+    # (for subprocess.Popen).  Commands run in their own session so that, like
+    # remote commands, their process group can be killed without killing us.
+    #
+    def GetPreexecFunction(self):
+        return os.setsid
+
+    ##
+    # Nothing to connect to
+    #
+    def Connect(self, hostnames):
+        pass
+
+    ##
+    # Nothing to close
+    #
+    def Close(self):
+        pass